@@ -1,10 +1,15 @@
+import collections
 import sys
 import time
 
 
 class Dbg():
-    def __init__(self, verbose, bar_length=40):
+    DEBUG_LEVEL = 3
+
+    def __init__(self, verbose, bar_length=40, trace_length=10000):
         self._verbose = verbose
+        # debug messages are stored in ring buffer, see dump_trace()
+        self._trace = collections.deque(maxlen=trace_length)
         self._bargraph_msg = None
         self._bargraph_min = None
         self._bargraph_max = None
@@ -21,8 +26,29 @@ class Dbg():
             sys.stderr.write('%s\n' % msg)
             sys.stderr.flush()
 
-    def debug(self, msg, level=3):
-        self._msg(msg, level)
+    @property
+    def debug_enabled(self):
+        # guard for debug messages which are expensive to prepare
+        return self._verbose >= Dbg.DEBUG_LEVEL
+
+    def debug(self, msg, *args, level=DEBUG_LEVEL):
+        # message is formatted with args only if debug level is enabled
+        if self._verbose < level:
+            return
+        if args:
+            msg = msg % args
+        self._trace.append(msg)
+
+    def dump_trace(self):
+        if not self._trace:
+            return
+        if not self._newline:
+            sys.stderr.write('\n')
+            self._newline = True
+        sys.stderr.write('\n'.join(self._trace))
+        sys.stderr.write('\n')
+        sys.stderr.flush()
+        self._trace.clear()
 
     def verbose(self, msg, level=2):
         self._msg(msg, level)
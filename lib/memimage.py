@@ -0,0 +1,143 @@
+import bisect
+import hashlib
+import struct
+import lib.stlinkex
+
+
+# Sparse memory image
+#
+# sorted list of non overlapping extents (address, bytearray), touching
+# extents are joined, so image of file is usually one extent. Extents of
+# address or region are found by bisect of start addresses. Image is built
+# once by file loader and shared by writing, FLASH planning and verifying.
+
+
+class MemoryImage():
+    def __init__(self, segments=None):
+        # segments are list of (address, data), overlapping must have same data
+        self._addrs = []
+        self._extents = []
+        for addr, data in segments or []:
+            self.merge(addr, data)
+
+    def __len__(self):
+        # count of extents
+        return len(self._addrs)
+
+    def __iter__(self):
+        # (address, bytearray) of all extents
+        return iter(list(zip(self._addrs, self._extents)))
+
+    @property
+    def size(self):
+        return sum(len(data) for data in self._extents)
+
+    @property
+    def start(self):
+        return self._addrs[0] if self._addrs else None
+
+    @property
+    def end(self):
+        return self._addrs[-1] + len(self._extents[-1]) if self._addrs else None
+
+    def _touching(self, addr, end):
+        # range of indexes of extents overlapping or touching region
+        first = bisect.bisect_right(self._addrs, addr) - 1
+        if first < 0 or self._addrs[first] + len(self._extents[first]) < addr:
+            first += 1
+        return first, bisect.bisect_right(self._addrs, end)
+
+    def find(self, addr):
+        # (address, bytearray) of extent containing address or None
+        index = bisect.bisect_right(self._addrs, addr) - 1
+        if index < 0 or self._addrs[index] + len(self._extents[index]) <= addr:
+            return None
+        return self._addrs[index], self._extents[index]
+
+    def _add(self, addr, data, overlay):
+        if not len(data):
+            return
+        end = addr + len(data)
+        first, last = self._touching(addr, end)
+        if first == last:
+            self._addrs.insert(first, addr)
+            self._extents.insert(first, bytearray(data))
+            return
+        if not overlay:
+            for index in range(first, last):
+                extent_addr, extent = self._addrs[index], self._extents[index]
+                start = max(addr, extent_addr)
+                stop = min(end, extent_addr + len(extent))
+                if start < stop and extent[start - extent_addr:stop - extent_addr] != data[start - addr:stop - addr]:
+                    raise lib.stlinkex.StlinkException('Segments overlap with different data at address 0x%08x' % start)
+        merged_addr = min(addr, self._addrs[first])
+        merged_end = max(end, self._addrs[last - 1] + len(self._extents[last - 1]))
+        if self._addrs[first] == merged_addr:
+            # first extent grows in place
+            merged = self._extents[first]
+            merged.extend(bytes(merged_end - merged_addr - len(merged)))
+            others = range(first + 1, last)
+        else:
+            merged = bytearray(merged_end - merged_addr)
+            others = range(first, last)
+        for index in others:
+            offset = self._addrs[index] - merged_addr
+            merged[offset:offset + len(self._extents[index])] = self._extents[index]
+        merged[addr - merged_addr:end - merged_addr] = data
+        self._addrs[first:last] = [merged_addr]
+        self._extents[first:last] = [merged]
+
+    def merge(self, addr, data):
+        # data overlapping image must be same
+        self._add(addr, data, overlay=False)
+
+    def overlay(self, addr, data):
+        # data replace overlapped part of image
+        self._add(addr, data, overlay=True)
+
+    def fill_gaps(self, value=0xff, max_gap=None):
+        # join extents with gap up to max_gap (or all) filled by value
+        index = 0
+        while index + 1 < len(self._addrs):
+            extent = self._extents[index]
+            gap = self._addrs[index + 1] - self._addrs[index] - len(extent)
+            if max_gap is not None and gap > max_gap:
+                index += 1
+                continue
+            extent.extend(bytes((value, )) * gap)
+            extent.extend(self._extents[index + 1])
+            del self._addrs[index + 1]
+            del self._extents[index + 1]
+
+    def align(self, geometry, value=0xff):
+        # new image with extents covering whole sectors of geometry
+        # (lib.stm32geometry.FlashGeometry), rest of sectors is value
+        aligned = MemoryImage()
+        for addr, data in self:
+            for sector_addr, sector_size in geometry.sectors(addr, len(data)):
+                if aligned.end is None or aligned.end <= sector_addr:
+                    aligned.overlay(sector_addr, bytes((value, )) * sector_size)
+        for addr, data in self:
+            aligned.overlay(addr, data)
+        return aligned
+
+    def slice(self, addr, size):
+        # new image with part of image in region
+        sliced = MemoryImage()
+        first, last = self._touching(addr, addr + size)
+        for index in range(first, last):
+            extent_addr, extent = self._addrs[index], self._extents[index]
+            start = max(addr, extent_addr)
+            stop = min(addr + size, extent_addr + len(extent))
+            if start < stop:
+                sliced._addrs.append(start)
+                sliced._extents.append(extent[start - extent_addr:stop - extent_addr])
+        return sliced
+
+    def digest(self):
+        # SHA-256 of addresses and data of all extents
+        sha = hashlib.sha256()
+        for addr, data in self:
+            sha.update(struct.pack('<II', addr, len(data)))
+            sha.update(data)
+        return sha.hexdigest()
@@ -59,32 +59,21 @@ class Srec():
         record = srec[:2]
         if record not in Srec.ADDR_SIZE:
             raise SrecExceptionWrongType(record)
-        data = []
-        srec = srec[2:]
-        while srec:
-            data.append(int(srec[:2], 16))
-            srec = srec[2:]
-        # validate checksum + remove checksum byte
-        checksum = 0x00
-        for i in data:
-            checksum += i
-        checksum &= 0xff
+        try:
+            data = bytes.fromhex(srec[2:])
+        except ValueError:
+            raise SrecException('Wrong hex digits in record')
+        # validate checksum
+        checksum = sum(data) & 0xff
         if checksum != 0xff:
             raise SrecExceptionWrongChecksum(checksum)
-        data = data[:-1]
-        # validate length + remove length byte
-        if data[0] != len(data):
+        # validate length (without length and checksum byte)
+        if data[0] != len(data) - 1:
             raise SrecExceptionWrongLength()
-        data = data[1:]
-        # read address + remove address bytes
+        # read address, data are between address and checksum
         addr_size = Srec.ADDR_SIZE[record]
-        addr = 0
-        while addr_size:
-            addr <<= 8
-            addr |= data[0]
-            data = data[1:]
-            addr_size -= 1
-        return record, addr, data
+        addr = int.from_bytes(data[1:1 + addr_size], 'big')
+        return record, addr, data[1 + addr_size:-1]
 
     def process_record(self, srec):
         record, addr, data = self.encode_record(srec)
@@ -93,13 +82,14 @@ class Srec():
         elif record in ('S1', 'S2', 'S3') and data:
             if self._buffer_addr is None:
                 self._buffer_addr = addr
-                self._buffer_data = data
+                self._buffer_data = bytearray(data)
             elif self._buffer_addr + len(self._buffer_data) == addr:
+                # bytearray grows in place
                 self._buffer_data += data
-            elif self._buffer_addr + len(self._buffer_data) != addr:
+            else:
                 self._buffers.append((self._buffer_addr, self._buffer_data))
                 self._buffer_addr = addr
-                self._buffer_data = data
+                self._buffer_data = bytearray(data)
 
     def encode_lines(self, srec_lines):
         self._buffers = []
@@ -110,13 +100,14 @@ class Srec():
             self.process_record(srec)
         if self._buffer_addr is not None:
             self._buffers.append((self._buffer_addr, self._buffer_data))
-        # return self._buffers
+        return self._buffers
 
     @property
     def buffers(self):
         return self._buffers
 
     def encode_file(self, filename):
+        # file is parsed line by line
         with open(filename) as srec_file:
             self.encode_lines(srec_file)
 
@@ -150,6 +141,10 @@ class TestSrec(unittest.TestCase):
         with self.assertRaises(SrecExceptionWrongChecksum):
             self.srec.encode_record('S012345678901234567890')
 
+    def testEncodeSrecWrongHex(self):
+        with self.assertRaises(SrecException):
+            self.srec.encode_record('S0030000XX')
+
     def testEncodeSrecShortLine(self):
         with self.assertRaises(SrecExceptionWrongLength):
             self.srec.encode_record('S0000000ff')
@@ -164,23 +159,23 @@ class TestSrec(unittest.TestCase):
 
     def testEncodeSrecEmptyHeader(self):
         ret = self.srec.encode_record('S0030000FC')
-        self.assertEqual(ret, ('S0', 0x0000, []))
+        self.assertEqual(ret, ('S0', 0x0000, b''))
 
     def testEncodeSrecHeader(self):
         ret = self.srec.encode_record('S0060000766C6BAC')
-        self.assertEqual(ret, ('S0', 0x0000, [0x76, 0x6c, 0x6b]))
+        self.assertEqual(ret, ('S0', 0x0000, b'\x76\x6c\x6b'))
 
     def testEncodeSrecDataAddr16(self):
         ret = self.srec.encode_record('S1060000766C6BAC')
-        self.assertEqual(ret, ('S1', 0x0000, [0x76, 0x6c, 0x6b]))
+        self.assertEqual(ret, ('S1', 0x0000, b'\x76\x6c\x6b'))
 
     def testEncodeSrecDataAddr24(self):
         ret = self.srec.encode_record('S207000000766C6BAB')
-        self.assertEqual(ret, ('S2', 0x000000, [0x76, 0x6c, 0x6b]))
+        self.assertEqual(ret, ('S2', 0x000000, b'\x76\x6c\x6b'))
 
     def testEncodeSrecDataAddr32(self):
         ret = self.srec.encode_record('S30800000000766C6BAA')
-        self.assertEqual(ret, ('S3', 0x00000000, [0x76, 0x6c, 0x6b]))
+        self.assertEqual(ret, ('S3', 0x00000000, b'\x76\x6c\x6b'))
 
     def testEncodeLines1Buffer(self):
         ret = self.srec.encode_lines([
@@ -188,7 +183,7 @@ class TestSrec(unittest.TestCase):
             'S309000000045566778838',
             'S309000000089ABCDEF0CA',
         ])
-        self.assertEqual(ret, [(0x00000000, [0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88, 0x9a, 0xbc, 0xde, 0xf0])])
+        self.assertEqual(ret, [(0x00000000, bytes.fromhex('11223344556677889abcdef0'))])
 
     def testEncodeLines2Buffer(self):
         ret = self.srec.encode_lines([
@@ -196,7 +191,7 @@ class TestSrec(unittest.TestCase):
             'S309000000045566778838',
             'S309000008009ABCDEF0CA',
         ])
-        self.assertEqual(ret, [(0x00000000, [0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88]), (2048, [0x9a, 0xbc, 0xde, 0xf0])])
+        self.assertEqual(ret, [(0x00000000, bytes.fromhex('1122334455667788')), (2048, bytes.fromhex('9abcdef0'))])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1195 @@
+import struct
+import threading
+import time
+import lib.stlinkex
+import lib.stlinkusb
+import lib.stlinkv2
+import lib.stm32
+import lib.stm32devices
+
+
+# Simulated ST-Link with STM32 target connected, for running and profiling
+# without hardware. Target is modeled on level of memory map, debug
+# registers and FLASH controllers, timing is scaled by time_scale. Core
+# executes only subset of Thumb instructions used by loaders in SRAM.
+
+
+class SimFlash():
+    ERASED = 0xff
+    # typical times in seconds
+    PROGRAM_TIME = 0.00005
+    ERASE_TIME = 0.02
+    MASS_ERASE_TIME = 0.04
+
+    def __init__(self, target):
+        self._target = target
+        self._busy_until = 0
+        self._pending = False
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def is_busy(self):
+        # state latched by last update(), so BSY and EOP are never read
+        # from different instants
+        return self._pending
+
+    def start(self, duration, count=1):
+        # operations are serialized, next one start after previous is done
+        duration *= self._target.time_scale
+        now = self._target.time()
+        self._busy_until = max(now, self._busy_until) + duration * count
+        self._pending = True
+        # writing into FLASH while busy stalls the bus, so the transfer
+        # returns only when the last operation is started
+        stall = self._busy_until - duration - now
+        if stall > 0:
+            time.sleep(stall)
+
+    def end_of_operation(self):
+        # is called only once when operation is finished
+        pass
+
+    def update(self):
+        # clock is read only here, once per access
+        if self._pending and self._target.time() >= self._busy_until:
+            self._pending = False
+            self.end_of_operation()
+
+    def erase(self, addr, size):
+        offset = addr - self._target.flash_start
+        self._target.flash[offset:offset + size] = bytes((self.ERASED, )) * size
+
+    def is_register(self, addr):
+        return False
+
+    def read_reg(self, addr):
+        return 0
+
+    def write_reg(self, addr, value):
+        pass
+
+    def program(self, addr, data, width):
+        # return False if write is not accepted
+        return False
+
+
+# STM32F0, STM32F1 and STM32F3 with page erase
+class SimFlashFP(SimFlash):
+    REG_BASE = 0x40022000
+    REG_BASE_STEP = 0x40
+    KEYR = 0x04
+    SR = 0x0c
+    CR = 0x10
+    AR = 0x14
+
+    CR_PG = 1 << 0
+    CR_PER = 1 << 1
+    CR_MER = 1 << 2
+    CR_STRT = 1 << 6
+    CR_LOCK = 1 << 7
+    SR_BSY = 1 << 0
+    SR_PGERR = 1 << 2
+    SR_WRPRTERR = 1 << 4
+    SR_EOP = 1 << 5
+
+    PROGRAM_TIME = 0.0000525
+    ERASE_TIME = 0.02
+    MASS_ERASE_TIME = 0.02
+
+    BANK_SIZE = 512 * 1024
+
+    def reset(self):
+        banks = 2 if len(self._target.flash) > SimFlashFP.BANK_SIZE else 1
+        self._banks = [{'cr': SimFlashFP.CR_LOCK, 'sr': 0, 'ar': 0, 'key': 0, 'busy': None} for i in range(banks)]
+        self._page_size = self._target.erase_sizes[0] if self._target.erase_sizes else 1024
+
+    def _bank_by_reg(self, addr):
+        bank = (addr - SimFlashFP.REG_BASE) // SimFlashFP.REG_BASE_STEP
+        if 0 <= bank < len(self._banks):
+            return self._banks[bank], (addr - SimFlashFP.REG_BASE) % SimFlashFP.REG_BASE_STEP
+        return None, None
+
+    def is_register(self, addr):
+        bank, reg = self._bank_by_reg(addr)
+        return bank is not None
+
+    def end_of_operation(self):
+        for bank in self._banks:
+            if bank['busy']:
+                bank['busy'] = None
+                bank['sr'] |= SimFlashFP.SR_EOP
+
+    def read_reg(self, addr):
+        bank, reg = self._bank_by_reg(addr)
+        if reg == SimFlashFP.SR:
+            return bank['sr'] | (SimFlashFP.SR_BSY if bank['busy'] and self.is_busy() else 0)
+        if reg == SimFlashFP.CR:
+            return bank['cr']
+        if reg == SimFlashFP.AR:
+            return bank['ar']
+        return 0
+
+    def write_reg(self, addr, value):
+        bank, reg = self._bank_by_reg(addr)
+        if reg == SimFlashFP.KEYR:
+            if bank['key'] == 0 and value == 0x45670123:
+                bank['key'] = 1
+            elif bank['key'] == 1 and value == 0xcdef89ab:
+                bank['key'] = 0
+                bank['cr'] &= ~SimFlashFP.CR_LOCK
+            else:
+                bank['key'] = 0
+        elif reg == SimFlashFP.SR:
+            bank['sr'] &= ~(value & (SimFlashFP.SR_PGERR | SimFlashFP.SR_WRPRTERR | SimFlashFP.SR_EOP))
+        elif reg == SimFlashFP.AR:
+            bank['ar'] = value
+        elif reg == SimFlashFP.CR:
+            if bank['cr'] & SimFlashFP.CR_LOCK:
+                return
+            bank['cr'] = value & 0x1ff7
+            if value & SimFlashFP.CR_STRT:
+                bank['busy'] = True
+                if value & SimFlashFP.CR_MER:
+                    index = self._banks.index(bank)
+                    size = min(SimFlashFP.BANK_SIZE, len(self._target.flash) - index * SimFlashFP.BANK_SIZE)
+                    self.erase(self._target.flash_start + index * SimFlashFP.BANK_SIZE, size)
+                    self.start(SimFlashFP.MASS_ERASE_TIME)
+                elif value & SimFlashFP.CR_PER:
+                    page_addr = bank['ar'] - bank['ar'] % self._page_size
+                    self.erase(page_addr, self._page_size)
+                    self.start(SimFlashFP.ERASE_TIME)
+
+    def program(self, addr, data, width):
+        bank = self._banks[(addr - self._target.flash_start) // SimFlashFP.BANK_SIZE]
+        if bank['cr'] & SimFlashFP.CR_LOCK or not bank['cr'] & SimFlashFP.CR_PG:
+            return False
+        if width != 2:
+            bank['sr'] |= SimFlashFP.SR_PGERR
+            return True
+        flash = self._target.flash
+        offset = addr - self._target.flash_start
+        for i in range(0, len(data), 2):
+            value = data[i] | data[i + 1] << 8
+            if value and (flash[offset + i] != 0xff or flash[offset + i + 1] != 0xff):
+                bank['sr'] |= SimFlashFP.SR_PGERR
+                continue
+            flash[offset + i:offset + i + 2] = data[i:i + 2]
+        bank['busy'] = True
+        self.start(SimFlashFP.PROGRAM_TIME, len(data) // 2)
+        return True
+
+
+# STM32F2, STM32F4 and STM32F7 with sector erase
+class SimFlashFS(SimFlash):
+    REG_BASE = 0x40023c00
+    KEYR = REG_BASE + 0x04
+    SR = REG_BASE + 0x0c
+    CR = REG_BASE + 0x10
+
+    CR_PG = 1 << 0
+    CR_SER = 1 << 1
+    CR_MER = 1 << 2
+    CR_STRT = 1 << 16
+    CR_LOCK = 1 << 31
+    SR_WRPERR = 1 << 4
+    SR_PGAERR = 1 << 5
+    SR_PGPERR = 1 << 6
+    SR_PGSERR = 1 << 7
+    SR_BSY = 1 << 16
+    SR_CLEAR_MASK = 0xf3
+
+    PROGRAM_TIME = 0.000016
+    # erase time by sector size in KB
+    ERASE_TIMES = {16: .4, 32: .6, 64: 1.2, 128: 2, 256: 2}
+    MASS_ERASE_TIME = 8
+
+    def reset(self):
+        self._cr = SimFlashFS.CR_LOCK
+        self._sr = 0
+        self._key = 0
+
+    def is_register(self, addr):
+        return SimFlashFS.REG_BASE <= addr < SimFlashFS.REG_BASE + 0x20
+
+    def read_reg(self, addr):
+        if addr == SimFlashFS.SR:
+            return self._sr | (SimFlashFS.SR_BSY if self.is_busy() else 0)
+        if addr == SimFlashFS.CR:
+            return self._cr
+        return 0
+
+    def write_reg(self, addr, value):
+        if addr == SimFlashFS.KEYR:
+            if self._key == 0 and value == 0x45670123:
+                self._key = 1
+            elif self._key == 1 and value == 0xcdef89ab:
+                self._key = 0
+                self._cr &= ~SimFlashFS.CR_LOCK
+            else:
+                self._key = 0
+        elif addr == SimFlashFS.SR:
+            self._sr &= ~(value & SimFlashFS.SR_CLEAR_MASK)
+        elif addr == SimFlashFS.CR:
+            if self._cr & SimFlashFS.CR_LOCK:
+                return
+            self._cr = value & ~SimFlashFS.CR_STRT
+            if value & SimFlashFS.CR_STRT:
+                if value & SimFlashFS.CR_MER:
+                    self.erase(self._target.flash_start, len(self._target.flash))
+                    self.start(SimFlashFS.MASS_ERASE_TIME)
+                elif value & SimFlashFS.CR_SER:
+                    sector = (value >> 3) & 0x1f
+                    if sector >= len(self._target.erase_sizes):
+                        self._sr |= SimFlashFS.SR_PGSERR
+                        return
+                    sector_addr = self._target.flash_start + sum(self._target.erase_sizes[:sector])
+                    sector_size = self._target.erase_sizes[sector]
+                    self.erase(sector_addr, sector_size)
+                    self.start(SimFlashFS.ERASE_TIMES[sector_size // 1024])
+
+    def program(self, addr, data, width):
+        if self._cr & SimFlashFS.CR_LOCK or not self._cr & SimFlashFS.CR_PG:
+            return False
+        if width != 1 << ((self._cr >> 8) & 3):
+            self._sr |= SimFlashFS.SR_PGPERR
+            return True
+        flash = self._target.flash
+        offset = addr - self._target.flash_start
+        for i, value in enumerate(data):
+            # programing can only clear bits
+            flash[offset + i] &= value
+        self.start(SimFlashFS.PROGRAM_TIME, len(data) // width)
+        return True
+
+
+# STM32L0 and STM32L1 with page erase and half page programming
+class SimFlashL0(SimFlash):
+    ERASED = 0x00
+    PECR = 0x04
+    PEKEYR = 0x0c
+    PRGKEYR = 0x10
+    SR = 0x18
+
+    PECR_PELOCK = 1 << 0
+    PECR_PRGLOCK = 1 << 1
+    PECR_OPTLOCK = 1 << 2
+    PECR_PRG = 1 << 3
+    PECR_ERASE = 1 << 9
+    PECR_FPRG = 1 << 10
+    PECR_LOCKS = PECR_PELOCK | PECR_PRGLOCK | PECR_OPTLOCK
+    SR_BSY = 1 << 0
+    SR_EOP = 1 << 1
+    SR_WRPERR = 1 << 8
+    SR_PGAERR = 1 << 9
+    SR_SIZERR = 1 << 10
+    SR_CLEAR_MASK = SR_EOP | SR_WRPERR | SR_PGAERR | SR_SIZERR
+
+    PROGRAM_TIME = 0.0032
+    ERASE_TIME = 0.0032
+
+    def reset(self):
+        if self._target.part_no == 0xc60:
+            self._base = 0x40022000
+            self._page_size = 128
+        else:
+            self._base = 0x40023c00
+            self._page_size = 256
+        self._pecr = SimFlashL0.PECR_LOCKS
+        self._sr = 0
+        self._key = 0
+
+    def is_register(self, addr):
+        return self._base <= addr < self._base + 0x20
+
+    def end_of_operation(self):
+        self._sr |= SimFlashL0.SR_EOP
+
+    def read_reg(self, addr):
+        if addr == self._base + SimFlashL0.SR:
+            return self._sr | (SimFlashL0.SR_BSY if self.is_busy() else 0)
+        if addr == self._base + SimFlashL0.PECR:
+            return self._pecr
+        return 0
+
+    def write_reg(self, addr, value):
+        if addr == self._base + SimFlashL0.PEKEYR:
+            if self._key == 0 and value == 0x89abcdef:
+                self._key = 1
+            elif self._key == 1 and value == 0x02030405:
+                self._key = 0
+                self._pecr &= ~SimFlashL0.PECR_PELOCK
+            else:
+                self._key = 0
+        elif addr == self._base + SimFlashL0.PRGKEYR:
+            if self._pecr & SimFlashL0.PECR_PELOCK:
+                return
+            if self._key == 0 and value == 0x8c9daebf:
+                self._key = 1
+            elif self._key == 1 and value == 0x13141516:
+                self._key = 0
+                self._pecr &= ~SimFlashL0.PECR_PRGLOCK
+            else:
+                self._key = 0
+        elif addr == self._base + SimFlashL0.SR:
+            self._sr &= ~(value & SimFlashL0.SR_CLEAR_MASK)
+        elif addr == self._base + SimFlashL0.PECR:
+            if value & SimFlashL0.PECR_PELOCK:
+                self._pecr = SimFlashL0.PECR_LOCKS
+            elif not self._pecr & SimFlashL0.PECR_PELOCK:
+                # lock bits can be only set by writing
+                self._pecr = (self._pecr & SimFlashL0.PECR_LOCKS) | (value & ~SimFlashL0.PECR_LOCKS)
+
+    def program(self, addr, data, width):
+        if self._pecr & (SimFlashL0.PECR_PELOCK | SimFlashL0.PECR_PRGLOCK):
+            self._sr |= SimFlashL0.SR_WRPERR
+            return True
+        offset = addr - self._target.flash_start
+        if self._pecr & SimFlashL0.PECR_ERASE:
+            page_addr = addr - (addr - self._target.flash_start) % self._page_size
+            self.erase(page_addr, self._page_size)
+            self.start(SimFlashL0.ERASE_TIME)
+            return True
+        if width != 4:
+            self._sr |= SimFlashL0.SR_SIZERR
+            return True
+        if self._pecr & SimFlashL0.PECR_FPRG:
+            half_page = self._page_size // 2
+            if offset % half_page or len(data) % half_page:
+                self._sr |= SimFlashL0.SR_PGAERR
+                return True
+            self._target.flash[offset:offset + len(data)] = data
+            self.start(SimFlashL0.PROGRAM_TIME, len(data) // half_page)
+            return True
+        self._target.flash[offset:offset + len(data)] = data
+        self.start(SimFlashL0.PROGRAM_TIME, len(data) // 4)
+        return True
+
+
+# STM32L4, STM32G0, STM32G4 and STM32WB with page erase and double word
+# programming
+class SimFlashL4(SimFlash):
+    REG_BASE = 0x40022000
+    KEYR = REG_BASE + 0x08
+    SR = REG_BASE + 0x10
+    CR = REG_BASE + 0x14
+    OPTR = REG_BASE + 0x20
+
+    CR_PG = 1 << 0
+    CR_PER = 1 << 1
+    CR_MER1 = 1 << 2
+    CR_BKER = 1 << 11
+    CR_MER2 = 1 << 15
+    CR_STRT = 1 << 16
+    CR_OPTLOCK = 1 << 30
+    CR_LOCK = 1 << 31
+    SR_EOP = 1 << 0
+    SR_PROGERR = 1 << 3
+    SR_PGAERR = 1 << 5
+    SR_PGSERR = 1 << 7
+    SR_BSY = 1 << 16
+    SR_CLEAR_MASK = 0xc3fb
+    OPTR_DUALBANK = 1 << 21
+    OPTR_DBANK = 1 << 22
+    # STM32L47x/L48x and L49x/L4Ax, both options are set
+    DUAL_BANK_DEV_IDS = (0x415, 0x461)
+
+    PROGRAM_TIME = 0.0000817
+    ERASE_TIME = 0.022
+    MASS_ERASE_TIME = 0.022
+
+    def reset(self):
+        self._cr = SimFlashL4.CR_LOCK | SimFlashL4.CR_OPTLOCK
+        self._sr = 0
+        self._key = 0
+        self._page_size = 2048
+
+    def is_register(self, addr):
+        return SimFlashL4.REG_BASE <= addr < SimFlashL4.REG_BASE + 0x100
+
+    def read_reg(self, addr):
+        if addr == SimFlashL4.SR:
+            return self._sr | (SimFlashL4.SR_BSY if self.is_busy() else 0)
+        if addr == SimFlashL4.CR:
+            return self._cr
+        if addr == SimFlashL4.OPTR:
+            return SimFlashL4.OPTR_DUALBANK | SimFlashL4.OPTR_DBANK
+        return 0
+
+    def write_reg(self, addr, value):
+        if addr == SimFlashL4.KEYR:
+            if self._key == 0 and value == 0x45670123:
+                self._key = 1
+            elif self._key == 1 and value == 0xcdef89ab:
+                self._key = 0
+                self._cr &= ~SimFlashL4.CR_LOCK
+            else:
+                self._key = 0
+        elif addr == SimFlashL4.SR:
+            self._sr &= ~(value & SimFlashL4.SR_CLEAR_MASK)
+        elif addr == SimFlashL4.CR:
+            if self._cr & SimFlashL4.CR_LOCK:
+                return
+            # OPTLOCK can be cleared only by option keys
+            self._cr = (value & ~SimFlashL4.CR_STRT) | (self._cr & SimFlashL4.CR_OPTLOCK)
+            if value & SimFlashL4.CR_STRT:
+                flash_size = len(self._target.flash)
+                bank_size = flash_size // 2 if self._target.dev_id in SimFlashL4.DUAL_BANK_DEV_IDS else flash_size
+                if value & (SimFlashL4.CR_MER1 | SimFlashL4.CR_MER2):
+                    if value & SimFlashL4.CR_MER1:
+                        self.erase(self._target.flash_start, bank_size)
+                    if value & SimFlashL4.CR_MER2 and bank_size < flash_size:
+                        self.erase(self._target.flash_start + bank_size, bank_size)
+                    self.start(SimFlashL4.MASS_ERASE_TIME)
+                elif value & SimFlashL4.CR_PER:
+                    # page number is in bank selected by BKER
+                    page = (value >> 3) & 0xff
+                    bank = 1 if value & SimFlashL4.CR_BKER else 0
+                    if (page + 1) * self._page_size > bank_size or bank * bank_size >= flash_size:
+                        self._sr |= SimFlashL4.SR_PGSERR
+                        return
+                    self.erase(self._target.flash_start + bank * bank_size + page * self._page_size, self._page_size)
+                    self.start(SimFlashL4.ERASE_TIME)
+
+    def program(self, addr, data, width):
+        if self._cr & SimFlashL4.CR_LOCK or not self._cr & SimFlashL4.CR_PG:
+            return False
+        offset = addr - self._target.flash_start
+        if width != 4 or offset % 8 or len(data) % 8:
+            self._sr |= SimFlashL4.SR_PGAERR
+            return True
+        flash = self._target.flash
+        for i in range(offset, offset + len(data), 8):
+            if flash[i:i + 8] != b'\xff' * 8:
+                self._sr |= SimFlashL4.SR_PROGERR
+                continue
+            flash[i:i + 8] = data[i - offset:i - offset + 8]
+        self.start(SimFlashL4.PROGRAM_TIME, len(data) // 8)
+        return True
+
+
+# STM32H7 with two banks and 256 bit FLASH word
+class SimFlashH7(SimFlash):
+    BANK_BASES = (0x52002000, 0x52002100)
+    OPTCR = 0x52002018
+    KEYR = 0x04
+    CR = 0x0c
+    SR = 0x10
+    CCR = 0x14
+
+    CR_LOCK = 1 << 0
+    CR_PG = 1 << 1
+    CR_SER = 1 << 2
+    CR_BER = 1 << 3
+    CR_START = 1 << 7
+    SR_BSY = 1 << 0
+    SR_QW = 1 << 2
+    SR_EOP = 1 << 16
+    SR_PGSERR = 1 << 18
+    OPTCR_MER = 1 << 4
+
+    BANK_SIZE = 1024 * 1024
+    SECTOR_SIZE = 128 * 1024
+    WORD_SIZE = 32
+    PROGRAM_TIME = 0.0001
+    ERASE_TIME = 1.0
+    BANK_ERASE_TIME = 7
+    MASS_ERASE_TIME = 14
+
+    def reset(self):
+        self._banks = [{'cr': SimFlashH7.CR_LOCK, 'sr': 0, 'key': 0, 'busy': None} for i in range(2)]
+
+    def is_register(self, addr):
+        return SimFlashH7.BANK_BASES[0] <= addr < SimFlashH7.BANK_BASES[1] + 0x100
+
+    def _bank_by_reg(self, addr):
+        index = 1 if addr >= SimFlashH7.BANK_BASES[1] else 0
+        return self._banks[index], addr - SimFlashH7.BANK_BASES[index]
+
+    def end_of_operation(self):
+        for bank in self._banks:
+            if bank['busy']:
+                bank['busy'] = None
+                bank['sr'] |= SimFlashH7.SR_EOP
+
+    def read_reg(self, addr):
+        bank, reg = self._bank_by_reg(addr)
+        if reg == SimFlashH7.SR:
+            busy = SimFlashH7.SR_BSY | SimFlashH7.SR_QW if bank['busy'] and self.is_busy() else 0
+            return bank['sr'] | busy
+        if reg == SimFlashH7.CR:
+            return bank['cr']
+        return 0
+
+    def write_reg(self, addr, value):
+        if addr == SimFlashH7.OPTCR:
+            if value & SimFlashH7.OPTCR_MER:
+                self.erase(self._target.flash_start, len(self._target.flash))
+                for bank in self._banks:
+                    bank['busy'] = True
+                self.start(SimFlashH7.MASS_ERASE_TIME)
+            return
+        bank, reg = self._bank_by_reg(addr)
+        if reg == SimFlashH7.KEYR:
+            if bank['key'] == 0 and value == 0x45670123:
+                bank['key'] = 1
+            elif bank['key'] == 1 and value == 0xcdef89ab:
+                bank['key'] = 0
+                bank['cr'] &= ~SimFlashH7.CR_LOCK
+            else:
+                bank['key'] = 0
+        elif reg == SimFlashH7.CCR:
+            bank['sr'] &= ~value
+        elif reg == SimFlashH7.CR:
+            if bank['cr'] & SimFlashH7.CR_LOCK:
+                return
+            bank['cr'] = value & ~SimFlashH7.CR_START
+            if value & SimFlashH7.CR_START:
+                bank_addr = self._target.flash_start + self._banks.index(bank) * SimFlashH7.BANK_SIZE
+                if value & SimFlashH7.CR_BER:
+                    self.erase(bank_addr, SimFlashH7.BANK_SIZE)
+                    bank['busy'] = True
+                    self.start(SimFlashH7.BANK_ERASE_TIME)
+                elif value & SimFlashH7.CR_SER:
+                    sector = (value >> 8) & 0x7
+                    self.erase(bank_addr + sector * SimFlashH7.SECTOR_SIZE, SimFlashH7.SECTOR_SIZE)
+                    bank['busy'] = True
+                    self.start(SimFlashH7.ERASE_TIME)
+
+    def erase(self, addr, size):
+        offset = addr - self._target.flash_start
+        size = max(0, min(size, len(self._target.flash) - offset))
+        super().erase(addr, size)
+
+    def program(self, addr, data, width):
+        offset = addr - self._target.flash_start
+        bank = self._banks[offset // SimFlashH7.BANK_SIZE]
+        if bank['cr'] & SimFlashH7.CR_LOCK or not bank['cr'] & SimFlashH7.CR_PG:
+            return False
+        if offset % SimFlashH7.WORD_SIZE or len(data) % SimFlashH7.WORD_SIZE:
+            bank['sr'] |= SimFlashH7.SR_PGSERR
+            return True
+        flash = self._target.flash
+        for i, value in enumerate(data):
+            flash[offset + i] &= value
+        bank['busy'] = True
+        self.start(SimFlashH7.PROGRAM_TIME, len(data) // SimFlashH7.WORD_SIZE)
+        return True
+
+
+class SimFault(Exception):
+    pass
+
+
+class SimCore():
+    # Thumb instructions common to all CortexM cores, any other instruction
+    # or access outside of memory map stops the core in lockup
+    N = 1 << 31
+    Z = 1 << 30
+    C = 1 << 29
+    V = 1 << 28
+    MASK = 0xffffffff
+
+    # load/store with immediate offset: (size, load) by bits 15..11
+    LOAD_STORE_IMM = {
+        0x0c: (4, False), 0x0d: (4, True),
+        0x0e: (1, False), 0x0f: (1, True),
+        0x10: (2, False), 0x11: (2, True),
+    }
+    # load/store with register offset: (size, load) by bits 11..9
+    LOAD_STORE_REG = {
+        0: (4, False), 1: (2, False), 2: (1, False),
+        4: (4, True), 5: (2, True), 6: (1, True),
+    }
+
+    def __init__(self, target):
+        self._target = target
+        self.lockup = False
+
+    def _r(self, index):
+        return self._target.regs.get(index, 0)
+
+    def _set_flags(self, result, carry=None, overflow=None):
+        psr = self._r(16) & ~(SimCore.N | SimCore.Z)
+        if result & SimCore.N:
+            psr |= SimCore.N
+        if not result:
+            psr |= SimCore.Z
+        if carry is not None:
+            psr = (psr & ~SimCore.C) | (SimCore.C if carry else 0)
+        if overflow is not None:
+            psr = (psr & ~SimCore.V) | (SimCore.V if overflow else 0)
+        self._target.regs[16] = psr
+
+    def _add(self, a, b):
+        result = a + b
+        self._set_flags(result & SimCore.MASK, result >> 32, ~(a ^ b) & (a ^ result) & SimCore.N)
+        return result & SimCore.MASK
+
+    def _sub(self, a, b):
+        result = (a - b) & SimCore.MASK
+        self._set_flags(result, a >= b, (a ^ b) & (a ^ result) & SimCore.N)
+        return result
+
+    def _condition(self, cond):
+        psr = self._r(16)
+        n, z, c, v = bool(psr & SimCore.N), bool(psr & SimCore.Z), bool(psr & SimCore.C), bool(psr & SimCore.V)
+        result = [z, c, n, v, c and not z, n == v, not z and n == v][cond >> 1]
+        return result != bool(cond & 1)
+
+    def _load(self, addr, size):
+        if addr % size:
+            raise SimFault()
+        return self._target.core_read(addr, size)
+
+    def _store(self, addr, value, size):
+        if addr % size:
+            raise SimFault()
+        self._target.core_write(addr, value & ((1 << size * 8) - 1), size)
+
+    def _shift(self, kind, value, amount):
+        # return result and carry, kind 0 LSL, 1 LSR
+        carry = bool(self._r(16) & SimCore.C)
+        if not amount:
+            return value, carry
+        if kind == 0:
+            return (value << amount) & SimCore.MASK, bool((value << amount) >> 32 & 1)
+        return value >> amount, bool(value >> (amount - 1) & 1)
+
+    def step(self):
+        regs = self._target.regs
+        pc = self._r(15)
+        op = self._target.core_read(pc, 2, fetch=True)
+        next_pc = pc + 2
+        rd = op & 7
+        rn = (op >> 3) & 7
+        if op < 0x1000:
+            # LSLS, LSRS by immediate
+            amount = (op >> 6) & 0x1f
+            if op & 0x0800 and not amount:
+                amount = 32
+            regs[rd], carry = self._shift(op >> 11, self._r(rn), amount)
+            self._set_flags(regs[rd], carry)
+        elif op < 0x1800:
+            raise SimFault()
+        elif op < 0x2000:
+            # ADDS, SUBS register or 3 bit immediate
+            operand = (op >> 6) & 7
+            if not op & 0x0400:
+                operand = self._r(operand)
+            if op & 0x0200:
+                regs[rd] = self._sub(self._r(rn), operand)
+            else:
+                regs[rd] = self._add(self._r(rn), operand)
+        elif op < 0x4000:
+            # MOVS, CMP, ADDS, SUBS 8 bit immediate
+            rdn = (op >> 8) & 7
+            imm = op & 0xff
+            kind = (op >> 11) & 3
+            if kind == 0:
+                regs[rdn] = imm
+                self._set_flags(imm)
+            elif kind == 1:
+                self._sub(self._r(rdn), imm)
+            elif kind == 2:
+                regs[rdn] = self._add(self._r(rdn), imm)
+            else:
+                regs[rdn] = self._sub(self._r(rdn), imm)
+        elif op < 0x4400:
+            self._data_processing((op >> 6) & 0xf, rd, self._r(rd), self._r(rn))
+        elif op < 0x4700:
+            # ADD, CMP, MOV with high registers
+            rd = rd | (op >> 4) & 8
+            rm = (op >> 3) & 0xf
+            value = pc + 4 if rm == 15 else self._r(rm)
+            kind = (op >> 8) & 3
+            if kind == 1:
+                self._sub(self._r(rd), value)
+            else:
+                if kind == 0:
+                    value = (value + (pc + 4 if rd == 15 else self._r(rd))) & SimCore.MASK
+                if rd == 15:
+                    next_pc = value & ~1
+                else:
+                    regs[rd] = value
+        elif op < 0x4800:
+            raise SimFault()
+        elif op < 0x5000:
+            # LDR literal
+            regs[(op >> 8) & 7] = self._load(((pc + 4) & ~3) + (op & 0xff) * 4, 4)
+        elif op < 0x6000:
+            size, load = SimCore.LOAD_STORE_REG.get((op >> 9) & 7, (None, None))
+            if size is None:
+                raise SimFault()
+            self._load_store(load, rd, (self._r(rn) + self._r((op >> 6) & 7)) & SimCore.MASK, size)
+        elif op < 0x9000:
+            size, load = SimCore.LOAD_STORE_IMM[op >> 11]
+            self._load_store(load, rd, self._r(rn) + ((op >> 6) & 0x1f) * size, size)
+        elif op & 0xff00 == 0xbe00:
+            # BKPT halts core with PC on breakpoint
+            self._target.halted = True
+            return
+        elif op == 0xbf00:
+            # NOP
+            pass
+        elif 0xd000 <= op < 0xde00:
+            if self._condition((op >> 8) & 0xf):
+                next_pc = pc + 4 + ((op & 0xff) ^ 0x80) * 2 - 0x100
+        elif 0xe000 <= op < 0xe800:
+            next_pc = pc + 4 + ((op & 0x7ff) ^ 0x400) * 2 - 0x800
+        else:
+            raise SimFault()
+        regs[15] = next_pc & SimCore.MASK
+
+    def _load_store(self, load, rt, addr, size):
+        if load:
+            self._target.regs[rt] = self._load(addr, size)
+        else:
+            self._store(addr, self._r(rt), size)
+
+    def _data_processing(self, kind, rd, a, b):
+        regs = self._target.regs
+        if kind in (0, 8):
+            # ANDS, TST
+            result = a & b
+            self._set_flags(result)
+            if kind == 8:
+                return
+        elif kind == 1:
+            result = a ^ b
+            self._set_flags(result)
+        elif kind in (2, 3):
+            # LSLS, LSRS by register
+            amount = b & 0xff
+            if amount >= 32:
+                carry = amount == 32 and bool((a >> 31 if kind == 3 else a) & 1)
+                result = 0
+            else:
+                result, carry = self._shift(kind - 2, a, amount)
+            self._set_flags(result, carry)
+        elif kind == 9:
+            result = self._sub(0, b)
+        elif kind == 0xa:
+            self._sub(a, b)
+            return
+        elif kind == 0xc:
+            result = a | b
+            self._set_flags(result)
+        elif kind == 0xd:
+            result = (a * b) & SimCore.MASK
+            self._set_flags(result)
+        elif kind == 0xe:
+            result = a & ~b & SimCore.MASK
+            self._set_flags(result)
+        elif kind == 0xf:
+            result = ~b & SimCore.MASK
+            self._set_flags(result)
+        else:
+            raise SimFault()
+        regs[rd] = result
+
+
+class SimTarget():
+    CPUID_REG = 0xe000ed00
+    DCRSR_REG = 0xe000edf4
+    DCRDR_REG = 0xe000edf8
+
+    DHCSR_S_REGRDY = 1 << 16
+    DHCSR_S_HALT = 1 << 17
+    DHCSR_S_LOCKUP = 1 << 19
+    DHCSR_S_RESET_ST = 1 << 25
+    DHCSR_CTRL_MASK = 0x2f
+    AIRCR_VECTKEY = 0x05fa0000
+    AIRCR_VECTKEYSTAT = 0xfa050000
+    AIRCR_SYSRESETREQ = 1 << 2
+    DEMCR_VC_CORERESET = 1 << 0
+
+    FLASH_DRIVERS = {
+        'STM32FP': SimFlashFP,
+        'STM32FPXL': SimFlashFP,
+        'STM32FS': SimFlashFS,
+        'STM32L0': SimFlashL0,
+        'STM32L4': SimFlashL4,
+        'STM32H7': SimFlashH7,
+    }
+
+    COREIDS = {
+        0xc20: 0x0bb11477,
+        0xc60: 0x0bc11477,
+        0xc27: 0x5ba02477,
+    }
+
+    # FPU on CortexM4 and CortexM7
+    MVFR0_REG = 0xe000ef40
+    MVFR0 = {
+        0xc24: 0x10110021,
+        0xc27: 0x10110221,
+    }
+
+    H7_AXI_SRAM_START = 0x24000000
+    H7_AXI_SRAM_SIZE = 512 * 1024
+
+    # core can access memory, peripherals and private peripheral bus
+    PERIPH_START = 0x40000000
+    PERIPH_END = 0x60000000
+    PPB_START = 0xe0000000
+    # instructions executed while holding lock
+    CORE_BATCH = 64
+
+    def __init__(self, cpu_type, time_scale=1.0):
+        self.time_scale = time_scale
+        self._find_device(cpu_type)
+        self.flash_start = lib.stm32.Stm32.FLASH_START
+        self.flash = bytearray(self.flash_size * 1024)
+        self._regions = [
+            (self.flash_start, self.flash),
+            (lib.stm32.Stm32.SRAM_START, bytearray(self.sram_size * 1024)),
+        ]
+        if self.flash_driver == 'STM32H7':
+            self._regions.append((SimTarget.H7_AXI_SRAM_START, bytearray(SimTarget.H7_AXI_SRAM_SIZE)))
+        self._flash = SimTarget.FLASH_DRIVERS.get(self.flash_driver, SimFlash)(self)
+        self.flash[:] = bytes((self._flash.ERASED, )) * len(self.flash)
+        self._registers = {
+            SimTarget.CPUID_REG: 0x410f0000 | (self.part_no << 4),
+            self.idcode_reg: 0x10000000 | self.dev_id,
+            SimTarget.MVFR0_REG: SimTarget.MVFR0.get(self.part_no, 0),
+        }
+        # FLASH size register is 16 bit wide
+        flash_size_word = self.flash_size_reg & 0xfffffffc
+        self._registers[flash_size_word] = self.flash_size << ((self.flash_size_reg & 2) * 8)
+        self.coreid = SimTarget.COREIDS.get(self.part_no, 0x2ba01477)
+        # running core is executed by thread, every access from ST-Link
+        # and every batch of instructions is done while holding lock
+        self.lock = threading.RLock()
+        self._core = SimCore(self)
+        self._core_thread = None
+        self.rw_error = False
+        self._dhcsr = 0
+        self._demcr = 0
+        self._reset_status = True
+        self.halted = False
+        self.regs = {}
+        self.core_reset()
+
+    def _find_device(self, cpu_type):
+        for mcu_core in lib.stm32devices.DEVICES:
+            for mcu_devid in mcu_core['devices']:
+                for mcu in mcu_devid['devices']:
+                    if mcu['type'].startswith(cpu_type):
+                        self.type = mcu['type']
+                        self.part_no = mcu_core['part_no']
+                        idcode_reg = mcu_core['idcode_reg']
+                        self.idcode_reg = idcode_reg if isinstance(idcode_reg, int) else idcode_reg[-1]
+                        self.dev_id = mcu_devid['dev_id']
+                        self.flash_size_reg = mcu_devid['flash_size_reg']
+                        self.flash_driver = mcu_devid['flash_driver']
+                        self.erase_sizes = mcu_devid['erase_sizes']
+                        self.flash_size = mcu['flash_size']
+                        self.sram_size = mcu['sram_size']
+                        return
+        raise lib.stlinkex.StlinkException('Simulated CPU "%s" is not known' % cpu_type)
+
+    def time(self):
+        return time.time()
+
+    def core_reset(self):
+        self._flash.reset()
+        self._reset_status = True
+        self.regs = {}
+        self.regs[15] = self.read32(self.flash_start + 4) & 0xfffffffe
+        self.regs[13] = self.regs[17] = self.read32(self.flash_start)
+        self.regs[16] = 0x01000000
+        self._core.lockup = False
+        if self._demcr & SimTarget.DEMCR_VC_CORERESET and self._dhcsr & lib.stm32.Stm32.DHCSR_DEBUGEN_BIT:
+            self.halted = True
+        else:
+            self.core_run()
+
+    def core_run(self):
+        self.halted = False
+        if self._core_thread is None:
+            self._core_thread = threading.Thread(target=self._run_core, daemon=True)
+            self._core_thread.start()
+
+    def core_step(self):
+        try:
+            self._core.step()
+        except SimFault:
+            self._core.lockup = True
+
+    def _run_core(self):
+        while True:
+            with self.lock:
+                if self.halted or self._core.lockup:
+                    self._core_thread = None
+                    return
+                for i in range(SimTarget.CORE_BATCH):
+                    self.core_step()
+                    if self.halted or self._core.lockup:
+                        break
+            # let ST-Link access target between batches
+            time.sleep(0)
+
+    def _region(self, addr, size):
+        for start, data in self._regions:
+            if start <= addr and addr + size <= start + len(data):
+                return start, data
+        return None, None
+
+    def _is_peripheral(self, addr):
+        return SimTarget.PERIPH_START <= addr < SimTarget.PERIPH_END or addr >= SimTarget.PPB_START
+
+    def core_read(self, addr, size, fetch=False):
+        # access from core, instructions can be fetched only from memory
+        start, data = self._region(addr, size)
+        if data is not None:
+            return int.from_bytes(data[addr - start:addr - start + size], 'little')
+        if fetch or not self._is_peripheral(addr):
+            raise SimFault()
+        return int.from_bytes(self.read(addr, size), 'little')
+
+    def core_write(self, addr, value, size):
+        if self._region(addr, size)[1] is None and not self._is_peripheral(addr):
+            raise SimFault()
+        self.write(addr, value.to_bytes(size, 'little'), size)
+
+    def _read_reg(self, addr):
+        self._flash.update()
+        if self._flash.is_register(addr):
+            return self._flash.read_reg(addr)
+        if addr == lib.stm32.Stm32.DHCSR_REG:
+            value = self._dhcsr | SimTarget.DHCSR_S_REGRDY
+            if self.halted:
+                value |= SimTarget.DHCSR_S_HALT
+            if self._core.lockup:
+                value |= SimTarget.DHCSR_S_LOCKUP
+            if self._reset_status:
+                value |= SimTarget.DHCSR_S_RESET_ST
+                self._reset_status = False
+            return value
+        if addr == lib.stm32.Stm32.DEMCR_REG:
+            return self._demcr
+        if addr == lib.stm32.Stm32.AIRCR_REG:
+            return SimTarget.AIRCR_VECTKEYSTAT
+        return self._registers.get(addr, 0)
+
+    def _write_reg(self, addr, value):
+        self._flash.update()
+        if self._flash.is_register(addr):
+            self._flash.write_reg(addr, value)
+        elif addr == lib.stm32.Stm32.DHCSR_REG:
+            if value & 0xffff0000 != lib.stm32.Stm32.DHCSR_KEY:
+                return
+            self._dhcsr = value & SimTarget.DHCSR_CTRL_MASK
+            if not value & lib.stm32.Stm32.DHCSR_DEBUGEN_BIT:
+                self.core_run()
+            elif value & lib.stm32.Stm32.DHCSR_HALT_BIT:
+                # core in lockup enters debug state and leaves lockup
+                self._core.lockup = False
+                self.halted = True
+            elif value & lib.stm32.Stm32.DHCSR_STEP_BIT:
+                if self.halted:
+                    self.core_step()
+                self.halted = True
+            elif self.halted:
+                self.core_run()
+        elif addr == lib.stm32.Stm32.DEMCR_REG:
+            self._demcr = value
+        elif addr == lib.stm32.Stm32.AIRCR_REG:
+            if value & 0xffff0000 == SimTarget.AIRCR_VECTKEY and value & SimTarget.AIRCR_SYSRESETREQ:
+                self.core_reset()
+        else:
+            self._registers[addr] = value
+
+    def read32(self, addr):
+        return struct.unpack('<I', self.read(addr, 4))[0]
+
+    def write32(self, addr, value):
+        self.write(addr, struct.pack('<I', value), 4)
+
+    def read(self, addr, size):
+        start, data = self._region(addr, size)
+        if data is not None:
+            return bytes(data[addr - start:addr - start + size])
+        # registers are always accessed as whole words
+        out = bytearray()
+        for word_addr in range(addr & 0xfffffffc, addr + size, 4):
+            out += struct.pack('<I', self._read_reg(word_addr))
+        return bytes(out[addr & 3:(addr & 3) + size])
+
+    def write(self, addr, data, width):
+        self._flash.update()
+        start, region = self._region(addr, len(data))
+        if region is self.flash:
+            if not self._flash.program(addr, data, width):
+                self.rw_error = True
+            return
+        if region is not None:
+            region[addr - start:addr - start + len(data)] = data
+            return
+        for i in range(0, len(data) - 3, 4):
+            self._write_reg(addr + i, struct.unpack_from('<I', data, i)[0])
+
+    def get_reg(self, index):
+        return self.regs.get(index, 0)
+
+    def set_reg(self, index, value):
+        self.regs[index] = value
+
+    def nrst(self, level):
+        if level:
+            self.core_reset()
+
+
+class StlinkSimConnector():
+    STLINK_VERSION = (2 << 12) | (37 << 6) | 7
+    STLINK_OK = 0x80
+    STLINK_SWD_AP_FAULT = 0x10
+    STLINK_UNKNOWN_COMMAND = 0x01
+    # target voltage is calculated as 2 * A1 * 1.2 / A0
+    TARGET_VOLTAGE_ADC = (2400, 3300)
+
+    # with SWD frequency over max_swd_freq every SWD_ERROR_PERIOD read
+    # is corrupted and transfer error is reported
+    SWD_ERROR_PERIOD = 5
+
+    def __init__(self, dbg=None, cpu_type='STM32F103x8', time_scale=1.0, latency=0, readallregs=True, max_swd_freq=None):
+        self._dbg = dbg
+        self._readallregs = readallregs
+        self._max_swd_freq = max_swd_freq
+        self._swd_freq = 1800000
+        self._swd_reads = 0
+        self._target = SimTarget(cpu_type, time_scale=time_scale)
+        self._latency = latency
+        self._xfer_counter = 0
+        self._mode = lib.stlinkv2.Stlink.STLINK_MODE_DFU
+        self._transfer_policy = lib.stlinkusb.TransferPolicy()
+        self._dbg.verbose("Connected to simulated ST-Link/V2 with %s" % self._target.type)
+
+    @property
+    def version(self):
+        return 'V2'
+
+    @property
+    def xfer_counter(self):
+        return self._xfer_counter
+
+    @property
+    def transfer_policy(self):
+        return self._transfer_policy
+
+    @property
+    def target(self):
+        return self._target
+
+    def sync(self):
+        pass
+
+    def unmount_discovery(self):
+        pass
+
+    def _status(self):
+        status = StlinkSimConnector.STLINK_OK
+        if self._target.rw_error:
+            status = StlinkSimConnector.STLINK_SWD_AP_FAULT
+        self._target.rw_error = False
+        return status
+
+    def _swd_error(self):
+        if self._max_swd_freq is None or self._swd_freq <= self._max_swd_freq:
+            return False
+        self._swd_reads += 1
+        if self._swd_reads % StlinkSimConnector.SWD_ERROR_PERIOD:
+            return False
+        self._target.rw_error = True
+        return True
+
+    def _debug_command(self, cmd, data):
+        Stlink = lib.stlinkv2.Stlink
+        sub = cmd[1]
+        addr, size = struct.unpack_from('<II', cmd, 2)
+        if sub == Stlink.STLINK_DEBUG_APIV2_ENTER:
+            self._mode = Stlink.STLINK_MODE_DEBUG
+            return bytes((StlinkSimConnector.STLINK_OK, 0))
+        if sub == Stlink.STLINK_DEBUG_EXIT:
+            self._mode = Stlink.STLINK_MODE_DFU
+            return b''
+        if sub == Stlink.STLINK_DEBUG_READCOREID:
+            return struct.pack('<I', self._target.coreid)
+        if sub in (Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ, Stlink.STLINK_DEBUG_APIV2_DRIVE_NRST,
+                   Stlink.STLINK_DEBUG_APIV2_RESETSYS):
+            if sub == Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ:
+                for freq, divisor in Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ_MAP.items():
+                    if divisor == cmd[2]:
+                        self._swd_freq = freq
+            elif sub == Stlink.STLINK_DEBUG_APIV2_DRIVE_NRST:
+                self._target.nrst(cmd[2])
+            elif sub == Stlink.STLINK_DEBUG_APIV2_RESETSYS:
+                self._target.core_reset()
+            return bytes((StlinkSimConnector.STLINK_OK, 0))
+        if sub == Stlink.STLINK_DEBUG_APIV2_READDEBUGREG:
+            value = self._target.read32(addr)
+            if self._swd_error():
+                value ^= 1
+            return struct.pack('<BxxxI', self._status(), value)
+        if sub == Stlink.STLINK_DEBUG_APIV2_WRITEDEBUGREG:
+            self._target.write32(addr, size)
+            return bytes((self._status(), 0))
+        if sub == Stlink.STLINK_DEBUG_APIV2_READREG:
+            return struct.pack('<BxxxI', StlinkSimConnector.STLINK_OK, self._target.get_reg(cmd[2]))
+        if sub == Stlink.STLINK_DEBUG_APIV2_WRITEREG:
+            self._target.set_reg(cmd[2], struct.unpack_from('<I', cmd, 3)[0])
+            return bytes((StlinkSimConnector.STLINK_OK, 0))
+        if sub == Stlink.STLINK_DEBUG_APIV2_READALLREGS:
+            if not self._readallregs:
+                return bytes((StlinkSimConnector.STLINK_UNKNOWN_COMMAND, 0))
+            return struct.pack('<Bxxx21I', StlinkSimConnector.STLINK_OK, *[self._target.get_reg(i) for i in range(21)])
+        if sub == Stlink.STLINK_DEBUG_APIV2_GETLASTRWSTATUS:
+            return bytes((self._status(), 0))
+        size &= 0xffff
+        if sub in (Stlink.STLINK_DEBUG_READMEM_32BIT, Stlink.STLINK_DEBUG_APIV2_READMEM_16BIT,
+                   Stlink.STLINK_DEBUG_READMEM_8BIT):
+            rx = self._target.read(addr, size)
+            if size and self._swd_error():
+                rx = bytes((rx[0] ^ 1, )) + rx[1:]
+            return rx
+        widths = {
+            Stlink.STLINK_DEBUG_WRITEMEM_32BIT: 4,
+            Stlink.STLINK_DEBUG_APIV2_WRITEMEM_16BIT: 2,
+            Stlink.STLINK_DEBUG_WRITEMEM_8BIT: 1,
+        }
+        if sub in widths:
+            self._target.write(addr, bytes(data[:size]), widths[sub])
+            return b''
+        raise lib.stlinkex.StlinkException('Simulated ST-Link does not support debug command 0x%02x' % sub)
+
+    def _command(self, cmd, data):
+        Stlink = lib.stlinkv2.Stlink
+        if cmd[0] == Stlink.STLINK_GET_VERSION:
+            return struct.pack('>H', self.STLINK_VERSION) + struct.pack('<HH', 0x0483, 0x3748)
+        if cmd[0] == Stlink.STLINK_GET_CURRENT_MODE:
+            return bytes((self._mode, 0))
+        if cmd[0] == Stlink.STLINK_GET_TARGET_VOLTAGE:
+            return struct.pack('<II', *StlinkSimConnector.TARGET_VOLTAGE_ADC)
+        if cmd[0] in (Stlink.STLINK_DFU_COMMAND, Stlink.STLINK_SWIM_COMMAND):
+            self._mode = Stlink.STLINK_MODE_MASS
+            return b''
+        if cmd[0] == Stlink.STLINK_DEBUG_COMMAND:
+            return self._debug_command(cmd, data)
+        raise lib.stlinkex.StlinkException('Simulated ST-Link does not support command 0x%02x' % cmd[0])
+
+    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None, wait=True):
+        cmd = bytes(cmd) + bytes(lib.stlinkusb.StlinkUsbConnector.STLINK_CMD_SIZE_V2 - len(cmd))
+        self._xfer_counter += 1
+        if self._latency:
+            time.sleep(self._latency)
+        with self._target.lock:
+            rx = self._command(cmd, data)
+        if not rx_len:
+            return None
+        rx = rx[:rx_len].ljust(rx_len, b'\x00')
+        if rx_buf is None:
+            return rx
+        rx_buf[:rx_len] = rx
+        return rx_buf
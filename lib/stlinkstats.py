@@ -0,0 +1,200 @@
+import collections
+import functools
+import threading
+import time
+import lib.stlinkv2
+
+
+# Statistics of transfers to ST-Link
+#
+# counts calls, bytes and latency histogram per ST-Link command and
+# attributes time to methods decorated with @operation
+
+
+def operation(method):
+    # time spent in decorated method and its transfers is accounted to method
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = getattr(getattr(self, '_stlink', self), 'stats', None)
+        if stats is None:
+            return method(self, *args, **kwargs)
+        stats.operation_enter(name)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.operation_leave()
+    return wrapper
+
+
+class StlinkStats():
+    # upper bounds of histogram buckets in ns, last bucket is unlimited
+    HISTOGRAM_BUCKETS = [2 ** i * 1000 for i in range(4, 17)]
+    SYNC = 'SYNC'
+    NO_OPERATION = '-'
+
+    def __init__(self):
+        self.commands = {}
+        self.operations = {}
+        self._stack = []
+        # queued transfers are recorded from pipeline thread
+        self._lock = threading.Lock()
+        Stlink = lib.stlinkv2.Stlink
+        self._names = {
+            (Stlink.STLINK_GET_VERSION, ): 'GET_VERSION',
+            (Stlink.STLINK_GET_CURRENT_MODE, ): 'GET_CURRENT_MODE',
+            (Stlink.STLINK_GET_TARGET_VOLTAGE, ): 'GET_TARGET_VOLTAGE',
+            (Stlink.STLINK_APIV3_GET_VERSION_EX, ): 'GET_VERSION_EX',
+            (Stlink.STLINK_DFU_COMMAND, ): 'DFU_EXIT',
+            (Stlink.STLINK_SWIM_COMMAND, ): 'SWIM_EXIT',
+        }
+        for name in (
+                'READMEM_32BIT', 'WRITEMEM_32BIT', 'READMEM_8BIT', 'WRITEMEM_8BIT',
+                'EXIT', 'READCOREID', 'APIV2_ENTER', 'APIV2_RESETSYS', 'APIV2_READREG',
+                'APIV2_WRITEREG', 'APIV2_WRITEDEBUGREG', 'APIV2_READDEBUGREG',
+                'APIV2_READALLREGS', 'APIV2_GETLASTRWSTATUS', 'APIV2_DRIVE_NRST',
+                'APIV2_SWD_SET_FREQ', 'APIV2_READMEM_16BIT', 'APIV2_WRITEMEM_16BIT',
+                'APIV3_SET_COM_FREQ', 'APIV3_GET_COM_FREQ'):
+            value = getattr(Stlink, 'STLINK_DEBUG_' + name)
+            self._names[(Stlink.STLINK_DEBUG_COMMAND, value)] = name.replace('APIV2_', '')
+
+    def command_name(self, cmd):
+        if cmd[0] == lib.stlinkv2.Stlink.STLINK_DEBUG_COMMAND:
+            return self._names.get((cmd[0], cmd[1]), 'DEBUG_0x%02x' % cmd[1])
+        return self._names.get((cmd[0], ), '0x%02x' % cmd[0])
+
+    def _operation_stats(self, name):
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = {'calls': 0, 'time': 0, 'xfers': 0, 'xfer_time': 0}
+            self.operations[name] = stats
+        return stats
+
+    def current_operation(self):
+        return self._stack[-1][0] if self._stack else StlinkStats.NO_OPERATION
+
+    def operation_enter(self, name):
+        self._stack.append((name, time.perf_counter_ns()))
+
+    def operation_leave(self):
+        name, start = self._stack.pop()
+        stats = self._operation_stats(name)
+        stats['calls'] += 1
+        # recursive calls are accounted only once
+        if name not in [n for n, s in self._stack]:
+            stats['time'] += time.perf_counter_ns() - start
+
+    def record(self, name, tx_bytes, rx_bytes, duration, operation=None):
+        # transfer time belongs to innermost operation, unless it is given
+        if operation is None:
+            operation = self.current_operation()
+        with self._lock:
+            self._record(name, tx_bytes, rx_bytes, duration, operation)
+
+    def _record(self, name, tx_bytes, rx_bytes, duration, operation):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = {
+                'calls': 0, 'tx_bytes': 0, 'rx_bytes': 0, 'time': 0,
+                'histogram': [0] * (len(StlinkStats.HISTOGRAM_BUCKETS) + 1),
+            }
+            self.commands[name] = stats
+        stats['calls'] += 1
+        stats['tx_bytes'] += tx_bytes
+        stats['rx_bytes'] += rx_bytes
+        stats['time'] += duration
+        bucket = 0
+        while bucket < len(StlinkStats.HISTOGRAM_BUCKETS) and duration > StlinkStats.HISTOGRAM_BUCKETS[bucket]:
+            bucket += 1
+        stats['histogram'][bucket] += 1
+        operation = self._operation_stats(operation)
+        operation['xfers'] += 1
+        operation['xfer_time'] += duration
+
+    @staticmethod
+    def percentile(histogram, percent):
+        # upper bound of bucket in ns where is given percentile of calls
+        # None for the last unlimited bucket
+        limit = sum(histogram) * percent / 100
+        count = 0
+        for bucket, bucket_count in enumerate(histogram):
+            count += bucket_count
+            if count >= limit and bucket_count:
+                break
+        if bucket < len(StlinkStats.HISTOGRAM_BUCKETS):
+            return StlinkStats.HISTOGRAM_BUCKETS[bucket]
+        return None
+
+    def report(self):
+        def fmt_bucket(ns):
+            return '>%dms' % (StlinkStats.HISTOGRAM_BUCKETS[-1] // 1000000) if ns is None else '<%dus' % (ns // 1000)
+        lines = []
+        lines.append('%-20s %7s %9s %9s %9s %8s %8s' % ('COMMAND', 'CALLS', 'TX', 'RX', 'TIME ms', 'P50', 'P90'))
+        for name, stats in sorted(self.commands.items(), key=lambda i: -i[1]['time']):
+            lines.append('%-20s %7d %9d %9d %9.1f %8s %8s' % (
+                name, stats['calls'], stats['tx_bytes'], stats['rx_bytes'], stats['time'] / 1e6,
+                fmt_bucket(StlinkStats.percentile(stats['histogram'], 50)),
+                fmt_bucket(StlinkStats.percentile(stats['histogram'], 90))))
+        lines.append('%-40s %7s %9s %7s %9s' % ('OPERATION', 'CALLS', 'TIME ms', 'XFERS', 'XFER ms'))
+        for name, stats in sorted(self.operations.items(), key=lambda i: -i[1]['time']):
+            lines.append('%-40s %7d %9.1f %7d %9.1f' % (
+                name, stats['calls'], stats['time'] / 1e6, stats['xfers'], stats['xfer_time'] / 1e6))
+        return lines
+
+
+class StlinkStatsConnector():
+    def __init__(self, connector, stats=None):
+        self._connector = connector
+        self.stats = stats if stats is not None else StlinkStats()
+        # queued transfers executed later by connector are timed when they
+        # are executed, others are executed already by xfer()
+        self._queued = None
+        set_observer = getattr(connector, 'set_xfer_observer', None)
+        if set_observer is not None and set_observer(self._xfer_done):
+            # operations which queued transfers, in order of execution
+            self._queued = collections.deque()
+
+    @property
+    def version(self):
+        return self._connector.version
+
+    @property
+    def xfer_counter(self):
+        return self._connector.xfer_counter
+
+    @property
+    def transfer_policy(self):
+        return self._connector.transfer_policy
+
+    def sync(self):
+        # time of waiting for queued transfers, it overlaps their own time
+        start = time.perf_counter_ns()
+        self._connector.sync()
+        self.stats.record(StlinkStats.SYNC, 0, 0, time.perf_counter_ns() - start)
+
+    def _xfer_done(self, cmd, data, rx_len, duration):
+        operation = self._queued.popleft()
+        if duration is not None:
+            self.stats.record(self.stats.command_name(cmd), len(data) if data else 0, rx_len or 0, duration, operation=operation)
+
+    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None, wait=True):
+        if not wait and self._queued is not None:
+            self._queued.append(self.stats.current_operation())
+            try:
+                return self._connector.xfer(cmd, data=data, rx_len=rx_len, retry=retry, tout=tout, rx_buf=rx_buf, wait=False)
+            except Exception:
+                # transfer was not queued
+                self._queued.pop()
+                raise
+        start = time.perf_counter_ns()
+        try:
+            return self._connector.xfer(cmd, data=data, rx_len=rx_len, retry=retry, tout=tout, rx_buf=rx_buf, wait=wait)
+        finally:
+            self.stats.record(self.stats.command_name(cmd), len(data) if data else 0, rx_len or 0, time.perf_counter_ns() - start)
+
+    def unmount_discovery(self):
+        self._connector.unmount_discovery()
+
+    def close(self):
+        self._connector.close()
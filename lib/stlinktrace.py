@@ -0,0 +1,242 @@
+import struct
+import time
+import lib.stlinkex
+import lib.stlinkusb
+
+
+# Binary trace of all transfers to ST-Link
+#
+# file starts with MAGIC and HEADER, then follow records, each record is
+# RECORD header with times in ns relative to start of recording, for
+# transfer then follows command (16 bytes), transmitted data and received
+# data, for error received data contains error message
+
+
+class StlinkTrace():
+    MAGIC = b'STLTRACE'
+    HEADER = struct.Struct('<B4sB')
+    RECORD = struct.Struct('<BQQII')
+    VERSION = 1
+    CMD_SIZE = 16
+
+    RECORD_XFER = 0x01
+    RECORD_SYNC = 0x02
+    RECORD_ERROR = 0x80
+
+    POLICIES = [
+        lib.stlinkusb.TransferPolicy,
+        lib.stlinkusb.TransferPolicyDarwin,
+    ]
+
+
+class StlinkTraceRecorder():
+    def __init__(self, connector, filename):
+        self._connector = connector
+        self._file = open(filename, 'wb')
+        self._pending = []
+        self._start = time.perf_counter_ns()
+        policy = StlinkTrace.POLICIES.index(type(connector.transfer_policy))
+        self._file.write(StlinkTrace.MAGIC)
+        self._file.write(StlinkTrace.HEADER.pack(StlinkTrace.VERSION, connector.version.encode(), policy))
+
+    @property
+    def version(self):
+        return self._connector.version
+
+    @property
+    def xfer_counter(self):
+        return self._connector.xfer_counter
+
+    @property
+    def transfer_policy(self):
+        return self._connector.transfer_policy
+
+    def set_xfer_observer(self, observer):
+        set_observer = getattr(self._connector, 'set_xfer_observer', None)
+        return set_observer is not None and set_observer(observer)
+
+    def _record(self, kind, timestamp, duration, cmd=b'', data=b'', rx=b''):
+        self._file.write(StlinkTrace.RECORD.pack(kind, timestamp - self._start, duration, len(data), len(rx)))
+        self._file.write(cmd)
+        self._file.write(data)
+        self._file.write(rx)
+
+    def _pad_cmd(self, cmd):
+        return bytes(cmd) + bytes(StlinkTrace.CMD_SIZE - len(cmd))
+
+    def sync(self):
+        if not self._pending:
+            return
+        timestamp = time.perf_counter_ns()
+        try:
+            self._connector.sync()
+        except lib.stlinkex.StlinkException as e:
+            # received data of dropped transfers are not valid
+            self._flush_pending()
+            self._record(StlinkTrace.RECORD_SYNC | StlinkTrace.RECORD_ERROR, timestamp, time.perf_counter_ns() - timestamp, rx=str(e).encode())
+            raise e
+        duration = time.perf_counter_ns() - timestamp
+        self._flush_pending()
+        self._record(StlinkTrace.RECORD_SYNC, timestamp, duration)
+
+    def _flush_pending(self):
+        # queued transfers have received data available only after sync
+        for timestamp, cmd, data, rx_len, rx_buf in self._pending:
+            rx = bytes(rx_buf[:rx_len]) if rx_len else b''
+            self._record(StlinkTrace.RECORD_XFER, timestamp, 0, cmd, data, rx)
+        self._pending = []
+
+    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None, wait=True):
+        cmd = self._pad_cmd(cmd)
+        data = bytes(data) if data else b''
+        if not wait:
+            timestamp = time.perf_counter_ns()
+            rx_buf = self._connector.xfer(cmd, data=data, rx_len=rx_len, retry=retry, tout=tout, rx_buf=rx_buf, wait=False)
+            self._pending.append((timestamp, cmd, data, rx_len, rx_buf))
+            return rx_buf
+        self.sync()
+        timestamp = time.perf_counter_ns()
+        try:
+            rx = self._connector.xfer(cmd, data=data, rx_len=rx_len, retry=retry, tout=tout, rx_buf=rx_buf)
+        except lib.stlinkex.StlinkException as e:
+            self._record(StlinkTrace.RECORD_XFER | StlinkTrace.RECORD_ERROR, timestamp, time.perf_counter_ns() - timestamp, cmd, data, str(e).encode())
+            raise e
+        duration = time.perf_counter_ns() - timestamp
+        self._record(StlinkTrace.RECORD_XFER, timestamp, duration, cmd, data, bytes(rx[:rx_len]) if rx_len else b'')
+        return rx
+
+    def unmount_discovery(self):
+        self._connector.unmount_discovery()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class StlinkTraceReader():
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            trace = f.read()
+        if not trace.startswith(StlinkTrace.MAGIC):
+            raise lib.stlinkex.StlinkException('File "%s" is not ST-Link trace' % filename)
+        offset = len(StlinkTrace.MAGIC)
+        version, stlink_version, policy = StlinkTrace.HEADER.unpack_from(trace, offset)
+        if version != StlinkTrace.VERSION:
+            raise lib.stlinkex.StlinkException('Unsupported ST-Link trace version %d' % version)
+        offset += StlinkTrace.HEADER.size
+        self.version = stlink_version.rstrip(b'\x00').decode()
+        self.transfer_policy = StlinkTrace.POLICIES[policy]()
+        self.records = []
+        view = memoryview(trace)
+        while offset < len(trace):
+            kind, timestamp, duration, data_len, rx_len = StlinkTrace.RECORD.unpack_from(trace, offset)
+            offset += StlinkTrace.RECORD.size
+            cmd = b''
+            if kind & StlinkTrace.RECORD_XFER:
+                cmd = bytes(view[offset:offset + StlinkTrace.CMD_SIZE])
+                offset += StlinkTrace.CMD_SIZE
+            data = bytes(view[offset:offset + data_len])
+            offset += data_len
+            rx = bytes(view[offset:offset + rx_len])
+            offset += rx_len
+            self.records.append({
+                'kind': kind,
+                'timestamp': timestamp,
+                'duration': duration,
+                'cmd': cmd,
+                'data': data,
+                'rx': rx,
+            })
+
+    @property
+    def xfer_count(self):
+        return len([r for r in self.records if r['kind'] & StlinkTrace.RECORD_XFER])
+
+    @property
+    def duration(self):
+        # time from start of recording to end of last record in ns
+        if not self.records:
+            return 0
+        return max(r['timestamp'] + r['duration'] for r in self.records)
+
+    @property
+    def busy_time(self):
+        # sum of time waiting for ST-Link in ns
+        return sum(r['duration'] for r in self.records)
+
+
+class StlinkTraceReplayConnector():
+    def __init__(self, filename, dbg=None, time_scale=None):
+        # time_scale None replay as fast as possible, 1.0 in original timing
+        self._dbg = dbg
+        self._trace = StlinkTraceReader(filename)
+        self._time_scale = time_scale
+        self._index = 0
+        self._pending = 0
+        self._xfer_counter = 0
+        if self._dbg:
+            self._dbg.verbose("Replaying %d transfers from %s" % (self._trace.xfer_count, filename))
+
+    @property
+    def version(self):
+        return self._trace.version
+
+    @property
+    def xfer_counter(self):
+        return self._xfer_counter
+
+    @property
+    def transfer_policy(self):
+        return self._trace.transfer_policy
+
+    def _next_record(self, kind):
+        if self._index >= len(self._trace.records):
+            raise lib.stlinkex.StlinkException('Trace replay reached end of trace')
+        record = self._trace.records[self._index]
+        if record['kind'] & ~StlinkTrace.RECORD_ERROR != kind:
+            raise lib.stlinkex.StlinkException('Trace replay mismatch in record %d' % self._index)
+        self._index += 1
+        if self._time_scale:
+            time.sleep(record['duration'] * self._time_scale / 1e9)
+        return record
+
+    def _raise_error(self, record):
+        if record['kind'] & StlinkTrace.RECORD_ERROR:
+            raise lib.stlinkex.StlinkException(record['rx'].decode())
+
+    def sync(self):
+        if not self._pending:
+            return
+        self._pending = 0
+        self._raise_error(self._next_record(StlinkTrace.RECORD_SYNC))
+
+    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None, wait=True):
+        if wait:
+            self.sync()
+        record = self._next_record(StlinkTrace.RECORD_XFER)
+        cmd = bytes(cmd) + bytes(StlinkTrace.CMD_SIZE - len(cmd))
+        if cmd != record['cmd'] or bytes(data or b'') != record['data']:
+            raise lib.stlinkex.StlinkException('Trace replay mismatch in record %d: command %s' % (
+                self._index - 1, ' '.join(['%02x' % i for i in cmd])))
+        self._xfer_counter += 1
+        self._raise_error(record)
+        if not wait:
+            self._pending += 1
+        if not rx_len:
+            return None
+        rx = record['rx']
+        if rx_buf is None:
+            return rx
+        rx_buf[:rx_len] = rx
+        return rx_buf
+
+    def unmount_discovery(self):
+        pass
+
+
+if __name__ == '__main__':
+    import sys
+    for filename in sys.argv[1:]:
+        trace = StlinkTraceReader(filename)
+        print('%s: ST-Link/%s, %d transfers, %.3fs total, %.3fs waiting for ST-Link' % (
+            filename, trace.version, trace.xfer_count, trace.duration / 1e9, trace.busy_time / 1e9))
@@ -1,11 +1,41 @@
+import array
+import platform
+import queue
+import threading
+import time
 import usb.core
 import usb.util
 import lib.stlinkex
 import re
 
 
+class TransferPolicy():
+    # ST-Link accept any count of transfers of any size
+    even_transfer_count = False
+
+    def split(self, size, max_size):
+        # sizes of 32 bit transfers for next block of remaining size
+        size = min(size & 0xfffffffc, max_size)
+        return (size, ) if size else ()
+
+
+class TransferPolicyDarwin(TransferPolicy):
+    # WORKAROUND for OS/X 10.11+
+    # ... transfers more than 64 bytes and all reads from ST-Link
+    # must be performed even times
+    even_transfer_count = True
+
+    def split(self, size, max_size):
+        size = min(size & 0xfffffff8, max_size * 2)
+        if size > 64:
+            return (size // 2, size // 2)
+        return (size, ) if size else ()
+
+
 class StlinkUsbConnector():
     STLINK_CMD_SIZE_V2 = 16
+    # maximum of transfers waiting in queue for I/O thread
+    PIPELINE_DEPTH = 8
 
     DEV_TYPES = [
         {
@@ -64,6 +94,14 @@ class StlinkUsbConnector():
         self._dbg = dbg
         self._dev_type = None
         self._xfer_counter = 0
+        self._rx_buffers = {}
+        self._pipeline = None
+        self._pipeline_error = None
+        self._xfer_observer = None
+        if platform.system() == 'Darwin':
+            self._transfer_policy = TransferPolicyDarwin()
+        else:
+            self._transfer_policy = TransferPolicy()
         devices = usb.core.find(find_all=True)
         multiple_devices = False
         self._dev = None
@@ -102,36 +140,59 @@ class StlinkUsbConnector():
     def xfer_counter(self):
         return self._xfer_counter
 
+    @property
+    def transfer_policy(self):
+        return self._transfer_policy
+
     def _write(self, data, tout=200):
-        self._dbg.debug("  USB > %s" % ' '.join(['%02x' % i for i in data]))
+        if self._dbg.debug_enabled:
+            self._dbg.debug("  USB > %s", ' '.join(['%02x' % i for i in data]))
         self._xfer_counter += 1
+        if not isinstance(data, array.array):
+            # pyusb copies anything else element by element
+            buffer = array.array('B')
+            buffer.frombytes(data)
+            data = buffer
         count = self._dev.write(self._dev_type['outPipe'], data, tout)
         if count != len(data):
             raise lib.stlinkex.StlinkException("Error, only %d Bytes was transmitted to ST-Link instead of expected %d" % (count, len(data)))
 
-    def _read(self, size, tout=200):
+    def _read(self, size, tout=200, buf=None):
         read_size = size
         if read_size < 64:
             read_size = 64
         elif read_size % 4:
             read_size += 3
             read_size &= 0xffc
-        data = self._dev.read(self._dev_type['inPipe'], read_size, tout).tolist()
-        self._dbg.debug("  USB < %s" % ' '.join(['%02x' % i for i in data]))
-        return data[:size]
+        # receive buffers are reused, pyusb fills only array.array in place
+        rx_buffer = self._rx_buffers.get(read_size)
+        if rx_buffer is None:
+            rx_buffer = array.array('B', bytes(read_size))
+            self._rx_buffers[read_size] = rx_buffer
+        count = self._dev.read(self._dev_type['inPipe'], rx_buffer, tout)
+        data = memoryview(rx_buffer)[:min(count, size)]
+        if self._dbg.debug_enabled:
+            self._dbg.debug("  USB < %s", ' '.join(['%02x' % i for i in data]))
+        if buf is None:
+            return bytes(data)
+        if len(data) != size:
+            raise lib.stlinkex.StlinkException("Error, only %d Bytes was received from ST-Link instead of expected %d" % (len(data), size))
+        buf[:size] = data
+        return buf
 
-    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200):
+    def _xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None):
         while (True):
             try:
                 if len(cmd) > self.STLINK_CMD_SIZE_V2:
                     raise lib.stlinkex.StlinkException("Error too many Bytes in command: %d, maximum is %d" % (len(cmd), self.STLINK_CMD_SIZE_V2))
                 # pad to 16 bytes
-                cmd += [0] * (self.STLINK_CMD_SIZE_V2 - len(cmd))
+                if len(cmd) < self.STLINK_CMD_SIZE_V2:
+                    cmd = bytes(cmd) + bytes(self.STLINK_CMD_SIZE_V2 - len(cmd))
                 self._write(cmd, tout)
                 if data:
                     self._write(data, tout)
                 if rx_len:
-                    return self._read(rx_len)
+                    return self._read(rx_len, buf=rx_buf)
             except usb.core.USBError as e:
                 if retry:
                     retry -= 1
@@ -139,6 +200,56 @@ class StlinkUsbConnector():
                 raise lib.stlinkex.StlinkException("USB Error: %s" % e)
             return None
 
+    def _pipeline_worker(self):
+        while True:
+            request = self._pipeline.get()
+            duration = None
+            try:
+                try:
+                    # after error all queued transfers are dropped until sync
+                    if self._pipeline_error is None:
+                        start = time.perf_counter_ns()
+                        self._xfer(*request)
+                        duration = time.perf_counter_ns() - start
+                finally:
+                    if self._xfer_observer is not None:
+                        self._xfer_observer(request[0], request[1], request[2], duration)
+            except Exception as e:
+                # worker must survive any error, else sync waits forever
+                self._pipeline_error = e
+            finally:
+                self._pipeline.task_done()
+
+    def set_xfer_observer(self, observer):
+        # observer(cmd, data, rx_len, duration) is called from pipeline thread
+        # for every queued transfer when it is executed, duration in ns is
+        # None for failed or dropped transfer
+        self._xfer_observer = observer
+        return True
+
+    def sync(self):
+        # wait until all queued transfers are done
+        if self._pipeline is None:
+            return
+        self._pipeline.join()
+        if self._pipeline_error is not None:
+            e = self._pipeline_error
+            self._pipeline_error = None
+            raise e
+
+    def xfer(self, cmd, data=None, rx_len=None, retry=0, tout=200, rx_buf=None, wait=True):
+        if wait:
+            self.sync()
+            return self._xfer(cmd, data=data, rx_len=rx_len, retry=retry, tout=tout, rx_buf=rx_buf)
+        # queued transfer, received data are available in rx_buf after sync
+        if rx_len and rx_buf is None:
+            raise lib.stlinkex.StlinkException("Queued transfer need buffer for received data")
+        if self._pipeline is None:
+            self._pipeline = queue.Queue(self.PIPELINE_DEPTH)
+            threading.Thread(target=self._pipeline_worker, daemon=True).start()
+        self._pipeline.put((cmd, data, rx_len, retry, tout, rx_buf))
+        return rx_buf
+
     def unmount_discovery(self):
         import platform
         if platform.system() != 'Darwin' or self.version != 'V2-1':
@@ -1,4 +1,6 @@
+import struct
 import lib.stlinkex
+import lib.stlinkstats
 
 
 class Stlink():
@@ -84,32 +86,102 @@ class Stlink():
     }
 
     STLINK_MAXIMUM_TRANSFER_SIZE = 1024
+    STLINK_MAXIMUM_TRANSFER_SIZE8 = 64
+
+    # first matching entry is used, 'max_transfer_size' is for 32 and 16 bit
+    # access, 'max_transfer_size8' is for 8 bit access
+    STLINK_CAPABILITIES = [
+        {
+            'api': 3,
+            'min_jtag': 0,
+            'max_transfer_size': 4096,
+            'max_transfer_size8': 512,
+            'mem16': True,
+        }, {
+            'api': 2,
+            'min_jtag': 26,
+            'max_transfer_size': STLINK_MAXIMUM_TRANSFER_SIZE,
+            'max_transfer_size8': STLINK_MAXIMUM_TRANSFER_SIZE8,
+            'mem16': True,
+        }, {
+            'api': 2,
+            'min_jtag': 0,
+            'max_transfer_size': STLINK_MAXIMUM_TRANSFER_SIZE,
+            'max_transfer_size8': STLINK_MAXIMUM_TRANSFER_SIZE8,
+            'mem16': False,
+        }
+    ]
+
+    # pre-encoded 16 bytes command templates
+    CMD = struct.Struct('<B15x')
+    CMD_SUB = struct.Struct('<BB14x')
+    CMD_SUB_BYTE = struct.Struct('<BBB13x')
+    CMD_SUB_ADDR = struct.Struct('<BBI10x')
+    CMD_SUB_ADDR_VALUE = struct.Struct('<BBII6x')
+    CMD_SUB_BYTE_VALUE = struct.Struct('<BBBI9x')
+    CMD_SUB_FREQ = struct.Struct('<BBxxI8x')
+    U32 = struct.Struct('<I')
+
+    # READALLREGS answer status (4 bytes) and registers R0 .. PSP and
+    # two other words
+    STLINK_READALLREGS_SIZE = 88
+    READALLREGS = struct.Struct('<19I')
+
+    # SWD frequency is tuned by readback test of DCRDR register
+    SWD_FREQ_AUTO = 'auto'
+    SWD_TEST_REG = 0xe000edf8
+    SWD_TEST_PATTERNS = (0x00000000, 0xffffffff, 0x55555555, 0xaaaaaaaa, 0x0f0f0f0f, 0xf0f0f0f0, 0x12345678, 0xedcba987)
+    SWD_TEST_ITERATIONS = 32
+    # passing frequency is confirmed by longer test
+    SWD_TEST_MARGIN = 4
 
     def __init__(self, connector, dbg, swd_frequency=4000000):
         self._connector = connector
         self._dbg = dbg
+        # transfer statistics, available only if connector collect them
+        self.stats = getattr(connector, 'stats', None)
+        self._capabilities = Stlink.STLINK_CAPABILITIES[-1]
+        self._has_readallregs = True
+        self._swd_auto = swd_frequency == Stlink.SWD_FREQ_AUTO
+        self._swd_freq = None
         self.read_version()
         self.leave_state()
         self.read_target_voltage()
-        if self._ver_api == 3:
-            self.set_swd_freq_v3(swd_frequency)
-        if self._ver_jtag >= 22:
-            self.set_swd_freq(swd_frequency)
+        if self._swd_auto:
+            swd_freqs = self.get_swd_freqs()
+            if not swd_freqs:
+                # firmware can not change SWD frequency, so it is not tuned
+                # and transfer errors are not handled by lowering it
+                self._dbg.warning("SWD frequency of ST-Link/%s can not be set, it is not tuned" % self._ver_str, level=2)
+                self._swd_auto = False
+            swd_frequency = max(swd_freqs or [4000000])
+        self.set_swd_frequency(swd_frequency)
         self.enter_debug_swd()
         self.read_coreid()
+        if self._swd_auto:
+            self.tune_swd_freq()
+
+    def sync(self):
+        # wait for all transfers queued with wait=False
+        self._connector.sync()
+
+    @property
+    def transfer_policy(self):
+        return self._connector.transfer_policy
 
     def clean_exit(self):
         # WORKAROUND for OS/X 10.11+
         # ... read from ST-Link, must be performed even times
         # call this function after last send command
-        if self._connector.xfer_counter & 1:
-            self._connector.xfer([Stlink.STLINK_GET_CURRENT_MODE], rx_len=2)
+        self._connector.sync()
+        if self.transfer_policy.even_transfer_count and self._connector.xfer_counter & 1:
+            self._connector.xfer(Stlink.CMD.pack(Stlink.STLINK_GET_CURRENT_MODE), rx_len=2)
 
     def read_version(self):
         # WORKAROUNF for OS/X 10.11+
         # ... retry XFER if first is timeout.
         # only during this command it is necessary
-        rx = self._connector.xfer([Stlink.STLINK_GET_VERSION, 0x80], rx_len=6, retry=2, tout=200)
+        rx = self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_GET_VERSION, 0x80), rx_len=6, retry=2, tout=200)
         ver = int.from_bytes(rx[:2], byteorder='big')
         dev_ver = self._connector.version
         self._ver_stlink = (ver >> 12) & 0xf
@@ -118,7 +190,7 @@ class Stlink():
         self._ver_mass = ver & 0x3f if dev_ver == 'V2-1' else None
         self._ver_api = 3 if dev_ver[0:2] == 'V3' else 2 if self._ver_jtag > 11 else 1
         if dev_ver[0:2] == 'V3':
-            rx_v3 = self._connector.xfer([Stlink.STLINK_APIV3_GET_VERSION_EX, 0x80], rx_len=16)
+            rx_v3 = self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_APIV3_GET_VERSION_EX, 0x80), rx_len=16)
             self._ver_swim = int(rx_v3[1])
             self._ver_jtag = int(rx_v3[2])
             self._ver_mass = int(rx_v3[3])
@@ -140,6 +212,26 @@ class Stlink():
             self._dbg.warning("ST-Link/%s is not recent firmware, please upgrade first - functionality is not guaranteed." % self._ver_str)
         if self.ver_jtag < 3 and self._ver_api == 3:
             self._dbg.warning("ST-Link/%s is not recent firmware, please upgrade first - functionality is not guaranteed." % self._ver_str)
+        self.read_capabilities()
+
+    def read_capabilities(self):
+        for capabilities in Stlink.STLINK_CAPABILITIES:
+            if self._ver_api == capabilities['api'] and self._ver_jtag >= capabilities['min_jtag']:
+                self._capabilities = capabilities
+                break
+        self._dbg.verbose("Maximum transfer size %d Bytes (%d Bytes for 8 bit access)" % (self.maximum_transfer_size, self.maximum_transfer_size8))
+
+    @property
+    def maximum_transfer_size(self):
+        return self._capabilities['max_transfer_size']
+
+    @property
+    def maximum_transfer_size8(self):
+        return self._capabilities['max_transfer_size8']
+
+    @property
+    def has_mem16(self):
+        return self._capabilities['mem16']
 
     @property
     def ver_stlink(self):
@@ -170,9 +262,9 @@ class Stlink():
         return self._ver_str
 
     def read_target_voltage(self):
-        rx = self._connector.xfer([Stlink.STLINK_GET_TARGET_VOLTAGE], rx_len=8)
-        a0 = int.from_bytes(rx[:4], byteorder='little')
-        a1 = int.from_bytes(rx[4:8], byteorder='little')
+        rx = self._connector.xfer(Stlink.CMD.pack(Stlink.STLINK_GET_TARGET_VOLTAGE), rx_len=8)
+        a0, = Stlink.U32.unpack_from(rx, 0)
+        a1, = Stlink.U32.unpack_from(rx, 4)
         self._target_voltage = 2 * a1 * 1.2 / a0 if a0 != 0 else None
 
     @property
@@ -180,74 +272,155 @@ class Stlink():
         return self._target_voltage
 
     def read_coreid(self):
-        rx = self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READCOREID], rx_len=4)
+        rx = self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READCOREID), rx_len=4)
         if len(rx) < 4:
             self._coreid = 0
         else:
-            self._coreid = int.from_bytes(rx[:4], byteorder='little')
+            self._coreid, = Stlink.U32.unpack_from(rx, 0)
 
     @property
     def coreid(self):
         return self._coreid
 
     def leave_state(self):
-        rx = self._connector.xfer([Stlink.STLINK_GET_CURRENT_MODE], rx_len=2)
+        rx = self._connector.xfer(Stlink.CMD.pack(Stlink.STLINK_GET_CURRENT_MODE), rx_len=2)
         if rx[0] == Stlink.STLINK_MODE_DFU:
-            self._connector.xfer([Stlink.STLINK_DFU_COMMAND, Stlink.STLINK_DFU_EXIT])
+            self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_DFU_COMMAND, Stlink.STLINK_DFU_EXIT))
         if rx[0] == Stlink.STLINK_MODE_DEBUG:
-            self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_EXIT])
+            self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_EXIT))
         if rx[0] == Stlink.STLINK_MODE_SWIM:
-            self._connector.xfer([Stlink.STLINK_SWIM_COMMAND, Stlink.STLINK_SWIM_EXIT])
+            self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_SWIM_COMMAND, Stlink.STLINK_SWIM_EXIT))
 
     def set_swd_freq(self, freq=1800000):
         for f, d in Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ_MAP.items():
             if freq >= f:
-                rx = self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ, d], rx_len=2)
+                rx = self._connector.xfer(Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ, d), rx_len=2)
                 if rx[0] != 0x80:
                     raise lib.stlinkex.StlinkException("Error switching SWD frequency")
                 return
         raise lib.stlinkex.StlinkException("Selected SWD frequency is too low")
 
+    def get_swd_freqs_v3(self):
+        # list of supported frequencies in kHz from the highest
+        rx = self._connector.xfer(Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV3_GET_COM_FREQ, 0), rx_len=52)
+        return [int.from_bytes(rx[12 + 4 * i: 15 + 4 * i], byteorder='little') for i in range(rx[8])]
+
     def set_swd_freq_v3(self, freq=1800000):
-        rx = self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV3_GET_COM_FREQ, 0], rx_len=52)
-        i = 0
         freq_khz = 0
-        while i < rx[8] :
-            freq_khz =  int.from_bytes(rx[12 + 4 * i: 15 + 4 * i], byteorder='little')
+        for freq_khz in self.get_swd_freqs_v3():
             if freq / 1000 >= freq_khz:
-                break;
-            i = i + 1
-        self._dbg.verbose("Using %d khz for %d kHz requested" % (freq_khz, freq/ 1000))
-        if i == rx[8]:
+                break
+        else:
             raise lib.stlinkex.StlinkException("Selected SWD frequency is too low")
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV3_SET_COM_FREQ]
-        cmd.extend([0x0] * 2)
-        cmd.extend(list(freq_khz.to_bytes(4, byteorder='little')))
+        self._dbg.verbose("Using %d khz for %d kHz requested" % (freq_khz, freq/ 1000))
+        cmd = Stlink.CMD_SUB_FREQ.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV3_SET_COM_FREQ, freq_khz)
         rx = self._connector.xfer(cmd, rx_len=2)
         if rx[0] != 0x80:
             raise lib.stlinkex.StlinkException("Error switching SWD frequency")
 
+    def get_swd_freqs(self):
+        # frequencies in Hz supported by ST-Link from the highest
+        if self._ver_api == 3:
+            return [freq_khz * 1000 for freq_khz in self.get_swd_freqs_v3()]
+        if self._ver_jtag >= 22:
+            return sorted(Stlink.STLINK_DEBUG_APIV2_SWD_SET_FREQ_MAP, reverse=True)
+        return []
+
+    def set_swd_frequency(self, freq):
+        if self._ver_api == 3:
+            self.set_swd_freq_v3(freq)
+        if self._ver_jtag >= 22:
+            self.set_swd_freq(freq)
+        self._swd_freq = freq
+
+    @property
+    def swd_frequency(self):
+        return self._swd_freq
+
+    def swd_test(self, iterations):
+        # write patterns into DCRDR and read them back
+        try:
+            for i in range(iterations):
+                pattern = Stlink.SWD_TEST_PATTERNS[i % len(Stlink.SWD_TEST_PATTERNS)] ^ (i << 24)
+                rx = self.set_debugreg32(Stlink.SWD_TEST_REG, pattern & 0xffffffff)
+                if rx[0] != 0x80:
+                    return False
+                rx = self._connector.xfer(Stlink.CMD_SUB_ADDR.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READDEBUGREG, Stlink.SWD_TEST_REG), rx_len=8)
+                if rx[0] != 0x80 or Stlink.U32.unpack_from(rx, 4)[0] != pattern & 0xffffffff:
+                    return False
+            return self.get_last_rw_status() == 0x80
+        except lib.stlinkex.StlinkException:
+            return False
+
+    def tune_swd_freq(self):
+        for freq in self.get_swd_freqs():
+            if freq > self._swd_freq:
+                continue
+            self.set_swd_frequency(freq)
+            if self.swd_test(Stlink.SWD_TEST_ITERATIONS) and self.swd_test(Stlink.SWD_TEST_ITERATIONS * Stlink.SWD_TEST_MARGIN):
+                self._dbg.verbose("SWD frequency tuned to %d kHz" % (freq // 1000))
+                return freq
+        raise lib.stlinkex.StlinkException("SWD communication is not reliable on any frequency")
+
+    def get_last_rw_status(self):
+        cmd = Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_GETLASTRWSTATUS)
+        return self._connector.xfer(cmd, rx_len=2)[0]
+
+    def queue_rw_status(self, statuses):
+        # only with automatic SWD frequency, status reports only the last
+        # memory transfer, so it is queued after each block and its buffer
+        # is appended to statuses
+        if not self._swd_auto:
+            return
+        status = bytearray(2)
+        cmd = Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_GETLASTRWSTATUS)
+        self._connector.xfer(cmd, rx_len=2, rx_buf=status, wait=False)
+        statuses.append(status)
+
+    def check_rw_status(self, statuses=None):
+        # only with automatic SWD frequency, return False if memory transfers
+        # failed and SWD frequency was lowered, statuses are queued by
+        # queue_rw_status() and synced, without them only last is checked
+        if not self._swd_auto:
+            return True
+        if statuses is None:
+            status = self.get_last_rw_status()
+        else:
+            status = next((status[0] for status in statuses if status[0] != 0x80), 0x80)
+        if status == 0x80:
+            return True
+        self._dbg.warning("SWD transfer error %02x at %d kHz" % (status, self._swd_freq // 1000), level=2)
+        lower_freqs = [freq for freq in self.get_swd_freqs() if freq < self._swd_freq]
+        if not lower_freqs:
+            raise lib.stlinkex.StlinkException("SWD transfer error %02x on lowest frequency" % status)
+        self._swd_freq = lower_freqs[0]
+        self.tune_swd_freq()
+        return False
+
     def enter_debug_swd(self):
-        self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_ENTER, Stlink.STLINK_DEBUG_ENTER_SWD], rx_len=2)
+        self._connector.xfer(Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_ENTER, Stlink.STLINK_DEBUG_ENTER_SWD), rx_len=2)
 
     def debug_resetsys(self):
-        self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_RESETSYS], rx_len=2)
+        self._connector.xfer(Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_RESETSYS), rx_len=2)
 
-    def set_debugreg32(self, addr, data):
+    def set_debugreg32(self, addr, data, wait=True):
         if addr % 4:
             raise lib.stlinkex.StlinkException('get_mem address %08x is not in multiples of 4' % addr)
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEDEBUGREG]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(data.to_bytes(4, byteorder='little')))
-        return self._connector.xfer(cmd, rx_len=2)
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEDEBUGREG, addr, data)
+        return self._connector.xfer(cmd, rx_len=2, rx_buf=None if wait else bytearray(2), wait=wait)
 
-    def get_debugreg32(self, addr):
+    def get_debugreg32(self, addr, buf=None, wait=True):
+        # queued read (wait=False) store response into buf, value is at offset 4
         if addr % 4:
             raise lib.stlinkex.StlinkException('get_mem address %08xis not in multiples of 4' % addr)
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READDEBUGREG]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        rx = self._connector.xfer(cmd, rx_len=8)
-        return int.from_bytes(rx[4:8], byteorder='little')
+        cmd = Stlink.CMD_SUB_ADDR.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READDEBUGREG, addr)
+        rx = self._connector.xfer(cmd, rx_len=8, rx_buf=buf, wait=wait)
+        if not wait:
+            return None
+        return Stlink.U32.unpack_from(rx, 4)[0]
+
+    def transaction(self):
+        return StlinkTransaction(self)
 
     def get_debugreg16(self, addr):
         if addr % 2:
@@ -263,80 +436,170 @@ class Stlink():
         return val & 0xff
 
     def get_reg(self, reg):
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READREG, reg]
+        cmd = Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READREG, reg)
         rx = self._connector.xfer(cmd, rx_len=8)
-        return int.from_bytes(rx[4:8], byteorder='little')
+        return Stlink.U32.unpack_from(rx, 4)[0]
+
+    def get_regs(self, regs):
+        # READREG commands are queued, so all registers cost one round trip
+        rx = bytearray(8 * len(regs))
+        view = memoryview(rx)
+        for i, reg in enumerate(regs):
+            cmd = Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READREG, reg)
+            self._connector.xfer(cmd, rx_len=8, rx_buf=view[i * 8:i * 8 + 8], wait=False)
+        self._connector.sync()
+        return [Stlink.U32.unpack_from(rx, i * 8 + 4)[0] for i in range(len(regs))]
+
+    def read_all_regs(self):
+        # return registers R0 .. PSP in one transfer or None if ST-Link
+        # firmware does not support READALLREGS
+        if not self._has_readallregs:
+            return None
+        cmd = Stlink.CMD_SUB.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READALLREGS)
+        rx = self._connector.xfer(cmd, rx_len=Stlink.STLINK_READALLREGS_SIZE)
+        if rx[0] != 0x80:
+            self._dbg.verbose("ST-Link does not support READALLREGS, status %02x" % rx[0])
+            self._has_readallregs = False
+            return None
+        return list(Stlink.READALLREGS.unpack_from(rx, 4))
 
-    def set_reg(self, reg, data):
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEREG, reg]
-        cmd.extend(list(data.to_bytes(4, byteorder='little')))
-        self._connector.xfer(cmd, rx_len=2)
+    def set_reg(self, reg, data, wait=True):
+        cmd = Stlink.CMD_SUB_BYTE_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEREG, reg, data)
+        self._connector.xfer(cmd, rx_len=2, rx_buf=None if wait else bytearray(2), wait=wait)
 
-    def get_mem32(self, addr, size):
+    @lib.stlinkstats.operation
+    def get_mem32(self, addr, size, buf=None, wait=True):
         if addr % 4:
             raise lib.stlinkex.StlinkException('get_mem32: Address must be in multiples of 4')
         if size % 4:
             raise lib.stlinkex.StlinkException('get_mem32: Size must be in multiples of 4')
-        if size > Stlink.STLINK_MAXIMUM_TRANSFER_SIZE:
-            raise lib.stlinkex.StlinkException('get_mem32: Size for reading is %d but maximum can be %d' % (size, Stlink.STLINK_MAXIMUM_TRANSFER_SIZE))
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READMEM_32BIT]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(size.to_bytes(4, byteorder='little')))
-        return self._connector.xfer(cmd, rx_len=size)
-
-    def set_mem32(self, addr, data):
+        if size > self.maximum_transfer_size:
+            raise lib.stlinkex.StlinkException('get_mem32: Size for reading is %d but maximum can be %d' % (size, self.maximum_transfer_size))
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READMEM_32BIT, addr, size)
+        return self._connector.xfer(cmd, rx_len=size, rx_buf=buf, wait=wait)
+
+    @lib.stlinkstats.operation
+    def set_mem32(self, addr, data, wait=True):
         if addr % 4:
             raise lib.stlinkex.StlinkException('set_mem32: Address must be in multiples of 4')
         if len(data) % 4:
             raise lib.stlinkex.StlinkException('set_mem32: Size must be in multiples of 4')
-        if len(data) > Stlink.STLINK_MAXIMUM_TRANSFER_SIZE:
-            raise lib.stlinkex.StlinkException('set_mem32: Size for writing is %d but maximum can be %d' % (len(data), Stlink.STLINK_MAXIMUM_TRANSFER_SIZE))
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_WRITEMEM_32BIT]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(len(data).to_bytes(4, byteorder='little')))
-        self._connector.xfer(cmd, data=data)
-
-    def get_mem8(self, addr, size):
-        if size > 64:
-            raise lib.stlinkex.StlinkException('get_mem8: Size for reading is %d but maximum can be 64' % size)
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READMEM_8BIT]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(size.to_bytes(4, byteorder='little')))
-        return self._connector.xfer(cmd, rx_len=size)
-
+        if len(data) > self.maximum_transfer_size:
+            raise lib.stlinkex.StlinkException('set_mem32: Size for writing is %d but maximum can be %d' % (len(data), self.maximum_transfer_size))
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_WRITEMEM_32BIT, addr, len(data))
+        self._connector.xfer(cmd, data=data, wait=wait)
+
+    @lib.stlinkstats.operation
+    def get_mem8(self, addr, size, buf=None):
+        if size > self.maximum_transfer_size8:
+            raise lib.stlinkex.StlinkException('get_mem8: Size for reading is %d but maximum can be %d' % (size, self.maximum_transfer_size8))
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_READMEM_8BIT, addr, size)
+        return self._connector.xfer(cmd, rx_len=size, rx_buf=buf)
+
+    @lib.stlinkstats.operation
     def set_mem8(self, addr, data):
-        datablock = data
-        while(datablock):
-            block = datablock[:64]
-            datablock = datablock[64:]
-            cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_WRITEMEM_8BIT]
-            cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-            cmd.extend(list(len(block).to_bytes(4, byteorder='little')))
+        data = memoryview(data)
+        block_size = self.maximum_transfer_size8
+        for offset in range(0, len(data), block_size):
+            block = data[offset:offset + block_size]
+            cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_WRITEMEM_8BIT, addr + offset, len(block))
             self._connector.xfer(cmd, block)
-            addr = addr + 64
 
-    def get_mem16(self, addr, size):
+    @lib.stlinkstats.operation
+    def get_mem16(self, addr, size, buf=None):
+        if not self.has_mem16:
+            raise lib.stlinkex.StlinkException('get_mem16: 16 bit memory access is not supported by ST-Link/%s, please upgrade firmware' % self._ver_str)
         if addr % 2:
             raise lib.stlinkex.StlinkException('get_mem16: Address must be in multiples of 2')
-        if len(data) % 2:
+        if size % 2:
             raise lib.stlinkex.StlinkException('get_mem16: Size must be in multiples of 2')
-        if len(data) > Stlink.STLINK_MAXIMUM_TRANSFER_SIZE:
-            raise lib.stlinkex.StlinkException('get_mem16: Size for writing is %d but maximum can be %d' % (len(data), Stlink.STLINK_MAXIMUM_TRANSFER_SIZE))
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READMEM_16BIT]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(size.to_bytes(4, byteorder='little')))
-        return self._connector.xfer(cmd, rx_len=size)
+        if size > self.maximum_transfer_size:
+            raise lib.stlinkex.StlinkException('get_mem16: Size for reading is %d but maximum can be %d' % (size, self.maximum_transfer_size))
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_READMEM_16BIT, addr, size)
+        return self._connector.xfer(cmd, rx_len=size, rx_buf=buf)
 
+    @lib.stlinkstats.operation
     def set_mem16(self, addr, data):
+        if not self.has_mem16:
+            raise lib.stlinkex.StlinkException('set_mem16: 16 bit memory access is not supported by ST-Link/%s, please upgrade firmware' % self._ver_str)
         if addr % 2:
             raise lib.stlinkex.StlinkException('set_mem16: Address must be in multiples of 2')
         if len(data) % 2:
             raise lib.stlinkex.StlinkException('set_mem16: Size must be in multiples of 2')
-        if len(data) > Stlink.STLINK_MAXIMUM_TRANSFER_SIZE:
-            raise lib.stlinkex.StlinkException('set_mem16: Size for writing is %d but maximum can be %d' % (len(data), Stlink.STLINK_MAXIMUM_TRANSFER_SIZE))
-        cmd = [Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEMEM_16BIT]
-        cmd.extend(list(addr.to_bytes(4, byteorder='little')))
-        cmd.extend(list(len(data).to_bytes(4, byteorder='little')))
+        if len(data) > self.maximum_transfer_size:
+            raise lib.stlinkex.StlinkException('set_mem16: Size for writing is %d but maximum can be %d' % (len(data), self.maximum_transfer_size))
+        cmd = Stlink.CMD_SUB_ADDR_VALUE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_WRITEMEM_16BIT, addr, len(data))
         self._connector.xfer(cmd, data=data)
+
     def set_nrst(self, action):
-        self._connector.xfer([Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_DRIVE_NRST, action], rx_len=2)
+        self._connector.xfer(Stlink.CMD_SUB_BYTE.pack(Stlink.STLINK_DEBUG_COMMAND, Stlink.STLINK_DEBUG_APIV2_DRIVE_NRST, action), rx_len=2)
+
+
+# Queue of debug register accesses
+#
+# accesses are sent to ST-Link at flush() without waiting for each response,
+# reads or writes to consecutive ascending addresses are merged into one
+# READMEM_32BIT or WRITEMEM_32BIT transfer, flush() returns values of all
+# queued reads in order in which they was queued
+class StlinkTransaction():
+    def __init__(self, stlink):
+        self._stlink = stlink
+        self._ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._ops:
+            self.flush()
+
+    def set_debugreg32(self, addr, data):
+        if addr % 4:
+            raise lib.stlinkex.StlinkException('set_debugreg32: Address must be in multiples of 4')
+        self._ops.append((addr, data))
+
+    def get_debugreg32(self, addr):
+        if addr % 4:
+            raise lib.stlinkex.StlinkException('get_debugreg32: Address must be in multiples of 4')
+        self._ops.append((addr, None))
+
+    def _groups(self):
+        # same address is never merged, so repeated writes (unlock keys)
+        # and read after write are always separate accesses
+        max_size = self._stlink.maximum_transfer_size
+        group = []
+        for addr, data in self._ops:
+            if group and (data is None) == (group[-1][1] is None) and addr == group[-1][0] + 4 and len(group) * 4 < max_size:
+                group.append((addr, data))
+                continue
+            if group:
+                yield group
+            group = [(addr, data)]
+        if group:
+            yield group
+
+    def flush(self):
+        rx = bytearray(8 * len(self._ops))
+        view = memoryview(rx)
+        offset = 0
+        reads = []
+        for group in self._groups():
+            addr = group[0][0]
+            if group[0][1] is not None:
+                if len(group) == 1:
+                    self._stlink.set_debugreg32(addr, group[0][1], wait=False)
+                else:
+                    data = struct.pack('<%dI' % len(group), *[data for addr, data in group])
+                    self._stlink.set_mem32(addr, data, wait=False)
+            elif len(group) == 1:
+                self._stlink.get_debugreg32(addr, buf=view[offset:offset + 8], wait=False)
+                reads.append(offset + 4)
+                offset += 8
+            else:
+                size = 4 * len(group)
+                self._stlink.get_mem32(addr, size, buf=view[offset:offset + size], wait=False)
+                reads += range(offset, offset + size, 4)
+                offset += size
+        self._ops = []
+        self._stlink.sync()
+        return [Stlink.U32.unpack_from(rx, i)[0] for i in reads]
@@ -1,9 +1,21 @@
+import binascii
+import time
+import lib.memimage
 import lib.stm32devices
+import lib.stm32geometry
+import lib.stm32loader
+import lib.stm32plan
+import lib.stm32poll
+import lib.stm32timing
 import lib.stlinkex
+import lib.stlinkstats
 
 
 class Stm32():
     REGISTERS = ['R0', 'R1', 'R2', 'R3', 'R4', 'R5', 'R6', 'R7', 'R8', 'R9', 'R10', 'R11', 'R12', 'SP', 'LR', 'PC', 'PSR', 'MSP', 'PSP']
+    SP_REGISTERS = [REGISTERS.index('SP'), REGISTERS.index('MSP'), REGISTERS.index('PSP')]
+    # FPU registers with their DCRSR REGSEL index
+    FPU_REGISTERS = [('S%d' % i, 0x40 + i) for i in range(32)] + [('FPSCR', 0x21)]
 
     SRAM_START = 0x20000000
     FLASH_START = 0x08000000
@@ -20,164 +32,263 @@ class Stm32():
     DHCSR_DEBUGEN_BIT       = 0x00000001
     DHCSR_HALT_BIT          = 0x00000002
     DHCSR_STEP_BIT          = 0x00000004
+    DHCSR_MASKINTS_BIT      = 0x00000008
     DHCSR_STATUS_ENABLE_BIT = DHCSR_DEBUGEN_BIT << 16
     DHCSR_STATUS_HALT_BIT   = DHCSR_HALT_BIT    << 16
+    DHCSR_STATUS_LOCKUP_BIT = 0x00080000
     DHCSR_DEBUGDIS = DHCSR_KEY
     DHCSR_DEBUGEN = DHCSR_KEY | DHCSR_DEBUGEN_BIT
     DHCSR_HALT = DHCSR_KEY | DHCSR_DEBUGEN_BIT | DHCSR_HALT_BIT
     DHCSR_STEP = DHCSR_KEY | DHCSR_DEBUGEN_BIT | DHCSR_STEP_BIT
+    DHCSR_MASKINTS = DHCSR_KEY | DHCSR_DEBUGEN_BIT | DHCSR_MASKINTS_BIT
     DHCSR_HALTED = DHCSR_HALT_BIT | DHCSR_DEBUGEN_BIT |\
                    DHCSR_STATUS_HALT_BIT | DHCSR_STATUS_ENABLE_BIT
 
     DEMCR_RUN_AFTER_RESET = 0x00000000
     DEMCR_HALT_AFTER_RESET = 0x00000001
 
-    def __init__(self, stlink, dbg):
+    # smaller data are verified by reading, CRC routine must be loaded first
+    VERIFY_CRC_MIN_SIZE = 4 * 1024
+    # size of verified regions if sectors are not known
+    VERIFY_BLOCK_SIZE = 16 * 1024
+    # memory transfer is repeated on lower SWD frequency at most this times
+    RW_RETRIES = 4
+    # FLASH size in KB if it was not detected, biggest of all STM32
+    DEFAULT_FLASH_SIZE = 2048
+    # smallest programmed unit and value of erased FLASH, delta programming
+    # writes unit without erase only if FLASH allows it
+    FLASH_UNIT = 4
+    FLASH_ERASED = 0xff
+
+    # Media and FP Feature Register 0, is zero when there is no FPU
+    MVFR0_REG = 0xe000ef40
+
+    def __init__(self, stlink, dbg, sram_size=None, flash_size=None):
         self._stlink = stlink
         self._dbg = dbg
+        # SRAM and FLASH size in KB, None if it is not known
+        self._sram_size = sram_size
+        self._flash_size = flash_size
+        # FlashGeometry by erase sizes, built only once
+        self._flash_geometries = {}
+        self._has_fpu = None
+        # core registers by index, valid only while core is halted
+        self._reg_cache = {}
+        # opened FlashSession or None
+        self._flash_session = None
+        # durations of FLASH operations are learned for whole connection
+        self._busy_poller = lib.stm32poll.BusyPoller()
+
+    def has_fpu(self):
+        if self._has_fpu is None:
+            self._has_fpu = self._stlink.get_debugreg32(Stm32.MVFR0_REG) != 0
+        return self._has_fpu
+
+    def _reg_index(self, reg):
+        reg = reg.upper()
+        if reg in Stm32.REGISTERS:
+            return Stm32.REGISTERS.index(reg)
+        for name, index in Stm32.FPU_REGISTERS:
+            if name == reg and self.has_fpu():
+                return index
+        return None
 
     def is_reg(self, reg):
-        return reg.upper() in Stm32.REGISTERS
+        return self._reg_index(reg) is not None
+
+    def invalidate_reg_cache(self):
+        self._reg_cache = {}
+
+    def _get_regs_cached(self, indexes, read_all=False):
+        missing = [index for index in indexes if index not in self._reg_cache]
+        if missing:
+            values = self._stlink.read_all_regs() if read_all else None
+            if values is None:
+                values = self._stlink.get_regs(missing)
+            else:
+                missing = range(len(values))
+            self._reg_cache.update(zip(missing, values))
+        return [self._reg_cache[index] for index in indexes]
 
     def get_reg_all(self):
-        # TODO use instead STLINK_DEBUG_APIV2_READALLREGS
-        return [(reg, self.get_reg(reg)) for reg in Stm32.REGISTERS]
+        regs = list(zip(Stm32.REGISTERS, self._get_regs_cached(range(len(Stm32.REGISTERS)), read_all=True)))
+        if self.has_fpu():
+            names, indexes = zip(*Stm32.FPU_REGISTERS)
+            regs += zip(names, self._get_regs_cached(indexes))
+        return regs
 
     def get_reg(self, reg):
-        self._dbg.debug('Stm32.get_reg(%s)' % reg)
-        reg = reg.upper()
-        if reg in Stm32.REGISTERS:
-            index = Stm32.REGISTERS.index(reg)
-            return self._stlink.get_reg(index)
-        raise lib.stlinkex.StlinkException('Wrong register name')
+        self._dbg.debug('Stm32.get_reg(%s)', reg)
+        index = self._reg_index(reg)
+        if index is None:
+            raise lib.stlinkex.StlinkException('Wrong register name')
+        value = self._reg_cache.get(index)
+        if value is None:
+            value = self._stlink.get_reg(index)
+            self._reg_cache[index] = value
+        return value
 
     def set_reg(self, reg, value):
-        self._dbg.debug('Stm32.set_reg(%s, 0x%08x)' % (reg, value))
-        reg = reg.upper()
-        if reg in Stm32.REGISTERS:
-            index = Stm32.REGISTERS.index(reg)
-            return self._stlink.set_reg(index, value)
-        raise lib.stlinkex.StlinkException('Wrong register name')
+        self._dbg.debug('Stm32.set_reg(%s, 0x%08x)', reg, value)
+        index = self._reg_index(reg)
+        if index is None:
+            raise lib.stlinkex.StlinkException('Wrong register name')
+        self._stlink.set_reg(index, value)
+        if index in Stm32.SP_REGISTERS:
+            # SP is the same register as MSP or PSP
+            for sp_index in Stm32.SP_REGISTERS:
+                self._reg_cache.pop(sp_index, None)
+        else:
+            self._reg_cache[index] = value
+
+    def _rw_retry(self, transfer):
+        # transfer() returns False if some block failed and SWD frequency was
+        # lowered, then whole transfer is repeated
+        for retry in range(Stm32.RW_RETRIES):
+            if transfer():
+                return
+        raise lib.stlinkex.StlinkException('Memory transfer failed %d times' % Stm32.RW_RETRIES)
 
+    @lib.stlinkstats.operation
     def get_mem(self, addr, size):
-        self._dbg.debug('Stm32.get_mem(0x%08x, %d)' % (addr, size))
+        self._dbg.debug('Stm32.get_mem(0x%08x, %d)', addr, size)
+        data = bytearray(size)
         if size == 0:
-            return []
+            return data
+        self._rw_retry(lambda: self._get_mem(addr, memoryview(data)))
+        return data
+
+    def _get_mem(self, addr, view):
+        # 32 bit transfers are queued, so USB latency overlaps with next requests
+        size = len(view)
         if size >= 16384:
             self._dbg.bargraph_start('Reading memory', value_max=size)
-        data = []
+        statuses = []
+        read_size = 0
         if addr % 4:
             read_size = min(4 - (addr % 4), size)
-            data = self._stlink.get_mem8(addr, read_size)
+            self._stlink.get_mem8(addr, read_size, view[:read_size])
+            self._stlink.queue_rw_status(statuses)
+        offset = read_size
+        policy = self._stlink.transfer_policy
         while True:
-            self._dbg.bargraph_update(value=len(data))
-            # WORKAROUND for OS/X 10.11+
-            # ... read from ST-Link more than 64 bytes, must be performed even times
-            read_size = min((size - len(data) & 0xfffffff8), self._stlink.STLINK_MAXIMUM_TRANSFER_SIZE * 2)
-            if read_size == 0:
+            self._dbg.bargraph_update(value=offset)
+            read_sizes = policy.split(size - offset, self._stlink.maximum_transfer_size)
+            if not read_sizes:
                 break
-            if read_size > 64:
-                read_size //= 2
-                data.extend(self._stlink.get_mem32(addr + len(data), read_size))
-                data.extend(self._stlink.get_mem32(addr + len(data), read_size))
-            else:
-                data.extend(self._stlink.get_mem32(addr + len(data), read_size))
-        if len(data) < size:
-            read_size = size - len(data)
-            data.extend(self._stlink.get_mem8(addr + len(data), read_size))
+            for read_size in read_sizes:
+                self._stlink.get_mem32(addr + offset, read_size, view[offset:offset + read_size], wait=False)
+                self._stlink.queue_rw_status(statuses)
+                offset += read_size
+        if offset < size:
+            self._stlink.get_mem8(addr + offset, size - offset, view[offset:])
+            self._stlink.queue_rw_status(statuses)
+        self._stlink.sync()
         self._dbg.bargraph_done()
-        return data
+        return self._stlink.check_rw_status(statuses)
 
+    @lib.stlinkstats.operation
     def set_mem(self, addr, data):
-        self._dbg.debug('Stm32.set_mem(0x%08x, [data:%dBytes])' % (addr, len(data)))
+        self._dbg.debug('Stm32.set_mem(0x%08x, [data:%dBytes])', addr, len(data))
         if len(data) == 0:
             return
-        if len(data) >= 16384:
-            self._dbg.bargraph_start('Writing memory', value_max=len(data))
+        self._rw_retry(lambda: self._set_mem(addr, memoryview(data)))
+
+    def _set_mem(self, addr, view):
+        if len(view) >= 16384:
+            self._dbg.bargraph_start('Writing memory', value_max=len(view))
+        statuses = []
         written_size = 0
         if addr % 4:
-            write_size = min(4 - (addr % 4), len(data))
-            self._stlink.set_mem8(addr, data[:write_size])
+            write_size = min(4 - (addr % 4), len(view))
+            self._stlink.set_mem8(addr, view[:write_size])
+            self._stlink.queue_rw_status(statuses)
             written_size = write_size
+        policy = self._stlink.transfer_policy
         while True:
             self._dbg.bargraph_update(value=written_size)
-            # WORKAROUND for OS/X 10.11+
-            # ... write to ST-Link more than 64 bytes, must be performed even times
-            write_size = min((len(data) - written_size) & 0xfffffff8, self._stlink.STLINK_MAXIMUM_TRANSFER_SIZE * 2)
-            if write_size == 0:
+            write_sizes = policy.split(len(view) - written_size, self._stlink.maximum_transfer_size)
+            if not write_sizes:
                 break
-            if write_size > 64:
-                write_size //= 2
-                self._stlink.set_mem32(addr + written_size, data[written_size:written_size + write_size])
-                written_size += write_size
-                self._stlink.set_mem32(addr + written_size, data[written_size:written_size + write_size])
+            for write_size in write_sizes:
+                self._stlink.set_mem32(addr + written_size, view[written_size:written_size + write_size], wait=False)
+                self._stlink.queue_rw_status(statuses)
                 written_size += write_size
-            else:
-                self._stlink.set_mem32(addr + written_size, data[written_size:written_size + write_size])
-                written_size += write_size
-        if written_size < len(data):
-            self._stlink.set_mem8(addr + written_size, data[written_size:])
+        if written_size < len(view):
+            self._stlink.set_mem8(addr + written_size, view[written_size:])
+            self._stlink.queue_rw_status(statuses)
+        self._stlink.sync()
         self._dbg.bargraph_done()
-        return
+        return self._stlink.check_rw_status(statuses)
 
+    @lib.stlinkstats.operation
     def fill_mem(self, addr, size, pattern):
         if pattern >= 256:
             raise lib.stlinkex.StlinkException('Fill pattern can by 8 bit number')
-        self._dbg.debug('Stm32.fill_mem(0x%08x, 0x%02d)' % (addr, pattern))
+        self._dbg.debug('Stm32.fill_mem(0x%08x, 0x%02d)', addr, pattern)
         if size == 0:
             return
+        self._rw_retry(lambda: self._fill_mem(addr, size, pattern))
+
+    def _fill_mem(self, addr, size, pattern):
         if size >= 16384:
             self._dbg.bargraph_start('Writing memory', value_max=size)
+        # one block of pattern, all transfers are views into it
+        block = memoryview(bytes((pattern, )) * self._stlink.maximum_transfer_size)
+        statuses = []
         written_size = 0
         if addr % 4:
             write_size = min(4 - (addr % 4), size)
-            self._stlink.set_mem8(addr, [pattern] * write_size)
+            self._stlink.set_mem8(addr, block[:write_size])
+            self._stlink.queue_rw_status(statuses)
             written_size = write_size
+        policy = self._stlink.transfer_policy
         while True:
             self._dbg.bargraph_update(value=written_size)
-            # WORKAROUND for OS/X 10.11+
-            # ... write to ST-Link more than 64 bytes, must be performed even timesg
-            write_size = min((size - written_size) & 0xfffffff8, self._stlink.STLINK_MAXIMUM_TRANSFER_SIZE * 2)
-            if write_size == 0:
+            write_sizes = policy.split(size - written_size, self._stlink.maximum_transfer_size)
+            if not write_sizes:
                 break
-            if write_size > 64:
-                write_size //= 2
-                self._stlink.set_mem32(addr + written_size, [pattern] * write_size)
-                written_size += write_size
-                self._stlink.set_mem32(addr + written_size, [pattern] * write_size)
-                written_size += write_size
-            else:
-                self._stlink.set_mem32(addr + written_size, [pattern] * write_size)
+            for write_size in write_sizes:
+                self._stlink.set_mem32(addr + written_size, block[:write_size], wait=False)
+                self._stlink.queue_rw_status(statuses)
                 written_size += write_size
         if written_size < size:
-            self._stlink.set_mem8(addr + written_size, [pattern] * (size - written_size))
+            self._stlink.set_mem8(addr + written_size, block[:size - written_size])
+            self._stlink.queue_rw_status(statuses)
+        self._stlink.sync()
         self._dbg.bargraph_done()
-        return
+        return self._stlink.check_rw_status(statuses)
 
     def core_reset(self):
         self._dbg.debug('Stm32.core_reset()')
+        self.invalidate_reg_cache()
         self._stlink.set_debugreg32(Stm32.DEMCR_REG, Stm32.DEMCR_RUN_AFTER_RESET)
         self._stlink.set_debugreg32(Stm32.AIRCR_REG, Stm32.AIRCR_SYSRESETREQ)
         self._stlink.get_debugreg32(Stm32.AIRCR_REG)
 
+    @lib.stlinkstats.operation
     def core_reset_halt(self):
         self._dbg.debug('Stm32.core_reset_halt()')
+        self.invalidate_reg_cache()
         self._stlink.set_debugreg32(Stm32.DEMCR_REG, Stm32.DEMCR_HALT_AFTER_RESET)
         self._stlink.set_debugreg32(Stm32.AIRCR_REG, Stm32.AIRCR_SYSRESETREQ)
         self.core_halt()
         self._stlink.get_debugreg32(Stm32.AIRCR_REG)
-        self._dbg.debug('Stm32.core_reset_halt(): DHCSR %08x' %
-                        self._stlink.get_debugreg32(Stm32.DHCSR_REG))
+        if self._dbg.debug_enabled:
+            self._dbg.debug('Stm32.core_reset_halt(): DHCSR %08x', self._stlink.get_debugreg32(Stm32.DHCSR_REG))
 
+    @lib.stlinkstats.operation
     def core_hard_reset_halt(self):
         self._dbg.debug('Stm32.core_hard_reset_halt()')
+        self.invalidate_reg_cache()
         self._stlink.set_nrst(0)
         self._stlink.set_debugreg32(Stm32.DEMCR_REG, Stm32.DEMCR_HALT_AFTER_RESET)
         self._stlink.set_nrst(1)
         self.core_halt()
-        self._dbg.debug('Stm32.core_reset_halt(): DHCSR %08x' %
-                        self._stlink.get_debugreg32(Stm32.DHCSR_REG))
+        if self._dbg.debug_enabled:
+            self._dbg.debug('Stm32.core_reset_halt(): DHCSR %08x', self._stlink.get_debugreg32(Stm32.DHCSR_REG))
 
+    @lib.stlinkstats.operation
     def core_halt(self):
         self._dbg.debug('Stm32.core_halt()')
         verbose = self._dbg._verbose
@@ -185,24 +296,42 @@ class Stm32():
              self._dbg.set_verbose(2)
         i = 0
         while((self._stlink.get_debugreg32(Stm32.DHCSR_REG) & Stm32.DHCSR_HALTED) != Stm32.DHCSR_HALTED) :
+            # core was running, so cached registers are not valid
+            self.invalidate_reg_cache()
             while True:
                 self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_HALT)
                 i += 1
                 if i & 0xff == 0:
                     break
         self._dbg.set_verbose(verbose)
-        self._dbg.debug("Halted after %d transactions" % i)
+        self._dbg.debug("Halted after %d transactions", i)
 
     def core_step(self):
         self._dbg.debug('Stm32.core_step()')
+        self.invalidate_reg_cache()
         self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_STEP)
 
     def core_run(self):
         self._dbg.debug('Stm32.core_run()')
+        self.invalidate_reg_cache()
         self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_DEBUGEN)
 
+    def core_run_masked(self):
+        # run with PendSV, SysTick and external interrupts masked, mask can be
+        # changed only on halted core, it is removed by core_halt_unmasked
+        self._dbg.debug('Stm32.core_run_masked()')
+        self.invalidate_reg_cache()
+        self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_MASKINTS | Stm32.DHCSR_HALT_BIT)
+        self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_MASKINTS)
+
+    def core_halt_unmasked(self):
+        self._dbg.debug('Stm32.core_halt_unmasked()')
+        self.invalidate_reg_cache()
+        self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_HALT)
+
     def core_nodebug(self):
         self._dbg.debug('Stm32.core_nodebug()')
+        self.invalidate_reg_cache()
         self._stlink.set_debugreg32(Stm32.DHCSR_REG, Stm32.DHCSR_DEBUGDIS)
 
     def flash_erase_all(self, flash_size):
@@ -210,32 +339,247 @@ class Stm32():
         raise lib.stlinkex.StlinkException('Erasing FLASH is not implemented for this MCU')
 
     def flash_write(self, addr, data, erase=False, verify=False, erase_sizes=None):
-        self._dbg.debug('Stm32.flash_write(%s, [data:%dBytes], erase=%s, verify=%s, erase_sizes=%s)' % (('0x%08x' % addr) if addr is not None else 'None', len(data), erase, verify, erase_sizes))
+        self._dbg.debug('Stm32.flash_write(%s, [data:%dBytes], erase=%s, verify=%s, erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase, verify, erase_sizes)
         raise lib.stlinkex.StlinkException('Programing FLASH is not implemented for this MCU')
 
-    def flash_verify(self, addr, data):
-        self._dbg.debug('Stm32.flash_verify(%s, [data:%dBytes])' % (('0x%08x' % addr) if addr is not None else 'None', len(data)))
-        length = len(data)
+    def flash_geometry(self, erase_sizes=None):
+        # erase_sizes are from device list, driver can replace them by real
+        # sizes, without them FLASH is split to blocks for verify
+        key = tuple(erase_sizes) if erase_sizes else None
+        geometry = self._flash_geometries.get(key)
+        if geometry is None:
+            flash_size = (self._flash_size or Stm32.DEFAULT_FLASH_SIZE) * 1024
+            sizes = self._flash_erase_sizes(erase_sizes) if erase_sizes else (Stm32.VERIFY_BLOCK_SIZE, )
+            geometry = lib.stm32geometry.FlashGeometry(self.FLASH_START, flash_size, sizes, bank_size=self._flash_bank_size(flash_size))
+            self._flash_geometries[key] = geometry
+            if erase_sizes:
+                # plan passes real sizes back to flash_write
+                self._flash_geometries.setdefault(geometry.erase_sizes, geometry)
+        return geometry
+
+    def _flash_erase_sizes(self, erase_sizes):
+        # sizes of erased sectors, driver can use other than from device list
+        return erase_sizes
+
+    def _flash_bank_size(self, flash_size):
+        # size of FLASH bank in Bytes or None if FLASH has only one bank
+        return None
+
+    def _verify_mem(self, addr, data):
+        mem = self.get_mem(addr, len(data))
+        if mem != data:
+            offset = next(i for i, (a, b) in enumerate(zip(mem, data)) if a != b)
+            raise lib.stlinkex.StlinkException('Verify error at address: 0x%08x' % (addr + offset))
+
+    def _flash_crc32(self, regions):
+        # CRC of regions computed on target, SRAM and core registers used by
+        # routine are restored, so verify does not change state of target
+        routine = lib.stm32loader.Crc32Routine(self, self._stlink, self._dbg, sram_size=self._sram_size, regions=len(regions))
+        try:
+            return routine.crc32(regions)
+        finally:
+            routine.restore()
+
+    @lib.stlinkstats.operation
+    def flash_verify(self, addr, data, erase_sizes=None):
+        # CRC of each sector is computed on target and only mismatching
+        # sector is read back to find address of error
+        self._dbg.debug('Stm32.flash_verify(%s, [data:%dBytes], erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase_sizes)
+        if addr is None:
+            addr = self.FLASH_START
+        view = memoryview(data)
+        if len(data) < Stm32.VERIFY_CRC_MIN_SIZE:
+            self._verify_mem(addr, view)
+            return
         self._dbg.bargraph_start('Verify FLASH ', value_min=addr, value_max=addr + len(data))
-        if (addr & 1):
-            uneven = addr & 3
-            block = data[:uneven]
-            data = data[uneven:]
-            if block != self._stlink.get_mem8(addr, uneven):
-                raise lib.stlinkex.StlinkException('Verify error at non-aligned block address: 0x%08x' % addr)
-            addr += uneven
-        while(data):
-            block = data[:1024]
-            data = data[1024:]
-            if block != self._stlink.get_mem32(addr, len(block)):
-                raise lib.stlinkex.StlinkException('Verify error at block address: 0x%08x' % addr)
-            addr += len(block)
-            self._dbg.bargraph_update(value=addr)
-        if (len(data) & 1):
-            remainder = len(data) & 3
-            block = data[:remainder]
-            block = block[remainder:]
-            if block != self._stlink.get_mem8(addr, remainder):
-                raise lib.stlinkex.StlinkException('Verify error at block address at non-aligned length: 0x%08x' % addr)
-            addr += remainder
+        regions = self.flash_geometry(erase_sizes).regions(addr, len(data))
+        for (region_addr, size), crc in zip(regions, self._flash_crc32(regions)):
+            offset = region_addr - addr
+            if binascii.crc32(view[offset:offset + size]) != crc:
+                self._verify_mem(region_addr, view[offset:offset + size])
+            self._dbg.bargraph_update(value=region_addr + size)
         self._dbg.bargraph_done()
+
+    def _flash_programmable(self, old, new):
+        # unit can be programmed without erase only if it is erased
+        return old.count(self.FLASH_ERASED) == len(old)
+
+    def _flash_delta_runs(self, sector_addr, addr, data):
+        # list of (address, data) to program without erase or None if sector
+        # must be erased, data lies in sector but can be shorter
+        unit = self.FLASH_UNIT
+        start = addr - (addr - sector_addr) % unit
+        end = addr + len(data) + (sector_addr - addr - len(data)) % unit
+        old = self.get_mem(start, end - start)
+        new = bytearray(old)
+        new[addr - start:addr - start + len(data)] = data
+        runs = []
+        run_start = None
+        erased = bytes((self.FLASH_ERASED, )) * unit
+        for offset in range(0, len(new) + unit, unit):
+            old_unit = old[offset:offset + unit]
+            new_unit = new[offset:offset + unit]
+            if old_unit != new_unit and not self._flash_programmable(old_unit, new_unit):
+                return None
+            if old_unit and (old_unit != new_unit or old_unit == erased):
+                if run_start is None:
+                    run_start = offset
+                continue
+            # unchanged programmed unit is not written again
+            if run_start is not None and old[run_start:offset] != new[run_start:offset]:
+                runs.append((start + run_start, new[run_start:offset]))
+            run_start = None
+        return runs
+
+    @lib.stlinkstats.operation
+    def flash_delta(self, addr, data, erase_sizes=None):
+        # program only sectors with different CRC, sector is erased only if
+        # some unit can not be programmed without erase
+        self._dbg.debug('Stm32.flash_delta(%s, [data:%dBytes], erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase_sizes)
+        if addr is None:
+            addr = self.FLASH_START
+        view = memoryview(data)
+        geometry = self.flash_geometry(erase_sizes)
+        sectors = geometry.sectors(addr, len(data))
+        regions = geometry.regions(addr, len(data))
+        changed = []
+        for sector, (region_addr, size), crc in zip(sectors, regions, self._flash_crc32(regions)):
+            if binascii.crc32(view[region_addr - addr:region_addr - addr + size]) != crc:
+                changed.append((sector, region_addr, view[region_addr - addr:region_addr - addr + size]))
+        erase = []
+        runs = []
+        for (sector_addr, sector_size), region_addr, region in changed:
+            sector_runs = self._flash_delta_runs(sector_addr, region_addr, region)
+            if sector_runs is None:
+                # content of sector out of data is preserved
+                sector = self.get_mem(sector_addr, sector_size)
+                sector[region_addr - sector_addr:region_addr - sector_addr + len(region)] = region
+                erase.append((sector_addr, sector))
+            elif runs and sector_runs and runs[-1][0] + len(runs[-1][1]) == sector_runs[0][0]:
+                # runs continuing to next sector are programmed at once
+                runs[-1][1].extend(sector_runs[0][1])
+                runs.extend(sector_runs[1:])
+            else:
+                runs.extend(sector_runs)
+        self._dbg.info('FLASH delta: %d of %d sectors changed, %d erased' % (len(changed), len(sectors), len(erase)))
+        for sector_addr, sector in erase:
+            self.flash_write(sector_addr, sector, erase=True, erase_sizes=erase_sizes)
+        for run_addr, run in runs:
+            self.flash_write(run_addr, run)
+
+    def flash_busy_wait(self, wait_time, timeout, key=None):
+        # wait for FLASH operation with expected duration wait_time
+        return self._busy_poller.wait(wait_time, timeout, key=key)
+
+    def flash_session(self):
+        return FlashSession(self)
+
+    def flash_plan(self, segments, erase=False, erase_sizes=None):
+        # segments are lib.memimage.MemoryImage or list of (address, data)
+        if not isinstance(segments, lib.memimage.MemoryImage):
+            segments = lib.memimage.MemoryImage((self.FLASH_START if addr is None else addr, data) for addr, data in segments)
+        geometry = self.flash_geometry(erase_sizes) if erase and erase_sizes else None
+        plan = lib.stm32plan.FlashPlan(segments, geometry, erased=self.FLASH_ERASED, erase=erase, unit=self.FLASH_UNIT)
+        if plan.erases_all():
+            # mass erase does not destroy anything what is not erased anyway
+            timing = self.flash_timing()
+            if timing.mass_erase_time() < timing.sectors_erase_time(plan.erase, plan.geometry):
+                plan.set_mass_erase()
+        return plan
+
+    def flash_timing(self):
+        return self._flash_timing()
+
+    def _flash_timing(self):
+        # lib.stm32timing.FlashTiming with times of driver
+        raise lib.stlinkex.StlinkException('Programing FLASH is not implemented for this MCU')
+
+    def flash_estimate(self, plan):
+        return self.flash_timing().estimate(plan)
+
+    def load_flash_timings(self, filename, device):
+        self._busy_poller.load(filename, device)
+
+    def save_flash_timings(self, filename, device):
+        self._busy_poller.save(filename, device)
+
+    @lib.stlinkstats.operation
+    def flash_execute(self, plan):
+        # every chunk covers whole sectors, so flash_write erases each sector
+        # only once, chunks are programmed in order of addresses
+        self._dbg.debug('Stm32.flash_execute([erase:%d sectors], [mass_erase:%s], [program:%d chunks, %dBytes])', len(plan.erase), plan.mass_erase, len(plan.program), plan.size)
+        timing = self.flash_timing()
+        if plan.mass_erase:
+            self.flash_erase_all(plan.geometry.size // 1024 if plan.geometry else self._flash_size)
+        for addr, data in plan.program:
+            # time of writing is learned without time of erasing and only for
+            # transferred Bytes, blank runs are skipped
+            start_time = time.time()
+            erase_time = self._busy_poller.spent('erase')
+            self.flash_write(addr, data, erase=bool(plan.erase), erase_sizes=plan.erase_sizes)
+            erase_time = self._busy_poller.spent('erase') - erase_time
+            size = lib.stm32plan.transfer_size(data, plan.unit, erased=plan.erased)
+            timing.learn_write(size, time.time() - start_time - erase_time)
+
+    def _flash_open(self, key, factory):
+        # FLASH object (unlocked by constructor) is reused in session
+        if self._flash_session is None:
+            return factory()
+        return self._flash_session.flash(key, factory)
+
+    def _flash_close(self, flash):
+        # FLASH opened in session is locked when session is closed
+        if self._flash_session is None:
+            self._flash_lock(flash)
+
+    def _flash_lock(self, flash):
+        flash.lock()
+
+
+# FLASH session
+#
+# FLASH is unlocked once by first write and stays unlocked for all following
+# writes and verifies, it is locked and core is reset when session is closed
+class FlashSession():
+    def __init__(self, driver):
+        if driver._flash_session is not None:
+            raise lib.stlinkex.StlinkException('FLASH session is already opened')
+        self._driver = driver
+        self._flashes = {}
+        driver._flash_session = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flash(self, key, factory):
+        flash = self._flashes.get(key)
+        if flash is None:
+            flash = factory()
+            self._flashes[key] = flash
+        return flash
+
+    def write(self, addr, data, erase=False, erase_sizes=None):
+        self._driver.flash_write(addr, data, erase=erase, erase_sizes=erase_sizes)
+
+    def program(self, segments, erase=False, erase_sizes=None):
+        # all segments are planned together
+        plan = self._driver.flash_plan(segments, erase=erase, erase_sizes=erase_sizes)
+        self._driver.flash_execute(plan)
+        return plan
+
+    def delta(self, addr, data, erase_sizes=None):
+        self._driver.flash_delta(addr, data, erase_sizes=erase_sizes)
+
+    def verify(self, addr, data, erase_sizes=None):
+        self._driver.flash_verify(addr, data, erase_sizes=erase_sizes)
+
+    def close(self):
+        self._driver._flash_session = None
+        # locking FLASH also resets core
+        for flash in self._flashes.values():
+            self._driver._flash_lock(flash)
+        self._flashes = {}
+
@@ -1,6 +1,9 @@
 import time
 import lib.stm32
 import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32loader
+import lib.stm32timing
 
 
 class Flash():
@@ -25,137 +28,188 @@ class Flash():
     FLASH_SR_WRPRTERR_BIT = 0x00000010
     FLASH_SR_EOP_BIT = 0x00000020
 
+    # FLASH loader, R0: FLASH_SR, R1, R2: buffers with descriptors
+    # (destination, count of half-words) and data, see lib.stm32loader
+    LOADER = [
+        0x0017,  #       movs r7, r2
+        0x684b,  # wait: ldr  r3, [r1, #4]
+        0x2b00,  #       cmp  r3, #0
+        0xd0fc,  #       beq  wait
+        0x1c5c,  #       adds r4, r3, #1
+        0xd013,  #       beq  exit
+        0x680a,  #       ldr  r2, [r1]
+        0x000c,  #       movs r4, r1
+        0x3408,  #       adds r4, #8
+        0x8825,  # loop: ldrh r5, [r4]
+        0x8015,  #       strh r5, [r2]
+        0x6805,  # busy: ldr  r5, [r0]
+        0x086e,  #       lsrs r6, r5, #1
+        0xd2fc,  #       bcs  busy
+        0x2614,  #       movs r6, #0x14 (PGERR | WRPRTERR)
+        0x4235,  #       tst  r5, r6
+        0xd108,  #       bne  exit
+        0x3402,  #       adds r4, #2
+        0x3202,  #       adds r2, #2
+        0x3b01,  #       subs r3, #1
+        0xd1f3,  #       bne  loop
+        0x604b,  #       str  r3, [r1, #4]
+        0x000c,  #       movs r4, r1
+        0x0039,  #       movs r1, r7
+        0x0027,  #       movs r7, r4
+        0xe7e6,  #       b    wait
+        0xbe00,  # exit: bkpt #0
+    ]
+    LOADER_UNIT = 2
+    LOADER_UNIT_TIME = 0.00007
+    MASS_ERASE_TIME = 2
+    PAGE_ERASE_TIME = 0.2
+
     def __init__(self, driver, stlink, dbg, bank=0):
         self._driver = driver
         self._stlink = stlink
         self._dbg = dbg
         self._stlink.read_target_voltage()
+        # registers of bank are set to instance, so both banks can be opened
         reg_bank = Flash.FLASH_REG_BASE + Flash.FLASH_REG_BASE_STEP * bank
-        Flash.FLASH_KEYR_REG = reg_bank + Flash.FLASH_KEYR_INDEX
-        Flash.FLASH_SR_REG = reg_bank + Flash.FLASH_SR_INDEX
-        Flash.FLASH_CR_REG = reg_bank + Flash.FLASH_CR_INDEX
-        Flash.FLASH_AR_REG = reg_bank + Flash.FLASH_AR_INDEX
+        self.FLASH_KEYR_REG = reg_bank + Flash.FLASH_KEYR_INDEX
+        self.FLASH_SR_REG = reg_bank + Flash.FLASH_SR_INDEX
+        self.FLASH_CR_REG = reg_bank + Flash.FLASH_CR_INDEX
+        self.FLASH_AR_REG = reg_bank + Flash.FLASH_AR_INDEX
         if self._stlink.target_voltage < 2.0:
             raise lib.stlinkex.StlinkException('Supply voltage is %.2fV, but minimum for FLASH program or erase is 2.0V' % self._stlink.target_voltage)
         self.unlock()
 
-    def clear_sr(self):
-        # clear errors
-        sr = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
-        self._stlink.set_debugreg32(Flash.FLASH_SR_REG, sr)
-
+    @lib.stlinkstats.operation
     def unlock(self):
         self._driver.core_reset_halt()
-        self.clear_sr()
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(self.FLASH_SR_REG)
+        tr.get_debugreg32(self.FLASH_CR_REG)
+        sr, cr = tr.flush()
+        # clear errors
+        tr.set_debugreg32(self.FLASH_SR_REG, sr)
         # programing locked
-        if self._stlink.get_debugreg32(Flash.FLASH_CR_REG) & Flash.FLASH_CR_LOCK_BIT:
+        if cr & Flash.FLASH_CR_LOCK_BIT:
             # unlock keys
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0x45670123)
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0xcdef89ab)
+            tr.set_debugreg32(self.FLASH_KEYR_REG, 0x45670123)
+            tr.set_debugreg32(self.FLASH_KEYR_REG, 0xcdef89ab)
+        tr.get_debugreg32(self.FLASH_CR_REG)
+        cr, = tr.flush()
         # programing locked
-        if self._stlink.get_debugreg32(Flash.FLASH_CR_REG) & Flash.FLASH_CR_LOCK_BIT:
+        if cr & Flash.FLASH_CR_LOCK_BIT:
             raise lib.stlinkex.StlinkException('Error unlocking FLASH')
 
+    @lib.stlinkstats.operation
     def lock(self):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
+        self._stlink.set_debugreg32(self.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
         self._driver.core_reset_halt()
 
+    @lib.stlinkstats.operation
     def erase_all(self):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT | Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(2, 'Erasing FLASH')
-
-    def erase_page(self, page_addr):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PER_BIT)
-        self._stlink.set_debugreg32(Flash.FLASH_AR_REG, page_addr)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PER_BIT | Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(0.2)
-
-    def erase_pages(self, flash_start, erase_sizes, addr, size):
-        page_addr = flash_start
-        self._dbg.bargraph_start('Erasing FLASH', value_min=addr, value_max=addr + size)
-        while True:
-            for page_size in erase_sizes:
-                if addr < page_addr + page_size:
-                    self._dbg.bargraph_update(value=page_addr)
-                    self.erase_page(page_addr)
-                page_addr += page_size
-                if addr + size < page_addr:
-                    self._dbg.bargraph_done()
-                    return
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(self.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT)
+            tr.set_debugreg32(self.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT | Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(Flash.MASS_ERASE_TIME, 'Erasing FLASH', key=lib.stm32timing.FlashTiming.MASS_ERASE_KEY)
+
+    @lib.stlinkstats.operation
+    def erase_page(self, page_addr, page_size):
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(self.FLASH_CR_REG, Flash.FLASH_CR_PER_BIT)
+            tr.set_debugreg32(self.FLASH_AR_REG, page_addr)
+            tr.set_debugreg32(self.FLASH_CR_REG, Flash.FLASH_CR_PER_BIT | Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(Flash.PAGE_ERASE_TIME, key=lib.stm32timing.FlashTiming.erase_key(page_size))
+
+    @lib.stlinkstats.operation
+    def erase_pages(self, geometry, addr, size):
+        pages = geometry.sectors(addr, size)
+        self._dbg.bargraph_start('Erasing FLASH', value_min=0, value_max=len(pages))
+        for index, (page_addr, page_size) in enumerate(pages):
+            self._dbg.bargraph_update(value=index)
+            self.erase_page(page_addr, page_size)
+        self._dbg.bargraph_done()
 
-    def wait_busy(self, wait_time, bargraph_msg=None):
-        end_time = time.time()
-        if bargraph_msg:
-            self._dbg.bargraph_start(bargraph_msg, value_min=time.time(), value_max=end_time + wait_time)
+    @lib.stlinkstats.operation
+    def wait_busy(self, wait_time, bargraph_msg=None, key=None):
         # all times are from data sheet, will be more safe to wait 2 time longer
-        end_time += wait_time * 2
-        while time.time() < end_time:
+        wait = self._driver.flash_busy_wait(wait_time, wait_time * 2, key=key)
+        if bargraph_msg:
+            self._dbg.bargraph_start(bargraph_msg, value_min=wait.start_time, value_max=wait.start_time + wait.expected)
+        while True:
             if bargraph_msg:
                 self._dbg.bargraph_update(value=time.time())
-            status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
+            status = self._stlink.get_debugreg32(self.FLASH_SR_REG)
             if not status & Flash.FLASH_SR_BUSY_BIT:
+                wait.done()
                 self.end_of_operation(status)
                 if bargraph_msg:
                     self._dbg.bargraph_done()
                 return
-            time.sleep(wait_time / 20)
-        raise lib.stlinkex.StlinkException('Operation timeout')
+            if wait.timeout():
+                raise lib.stlinkex.StlinkException('Operation timeout')
+            wait.sleep()
 
+    @lib.stlinkstats.operation
     def wait_for_breakpoint(self, wait_time):
         end_time = time.time() + wait_time
-        while time.time() < end_time and not self._stlink.get_debugreg32(lib.stm32.Stm32.DHCSR_REG) & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+        while not self._stlink.get_debugreg32(lib.stm32.Stm32.DHCSR_REG) & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+            if time.time() > end_time:
+                raise lib.stlinkex.StlinkException('FLASH loader timeout')
             time.sleep(wait_time / 20)
-        self.end_of_operation(self._stlink.get_debugreg32(Flash.FLASH_SR_REG))
+        self.end_of_operation(self._stlink.get_debugreg32(self.FLASH_SR_REG))
 
     def end_of_operation(self, status):
         if status != Flash.FLASH_SR_EOP_BIT:
             raise lib.stlinkex.StlinkException('Error writing FLASH with status (FLASH_SR) %08x' % status)
-        self._stlink.set_debugreg32(Flash.FLASH_SR_REG, status)
+        self._stlink.set_debugreg32(self.FLASH_SR_REG, status)
 
 
 # support all STM32F MCUs with page access to FLASH
 # (STM32F0xx, STM32F1xx and also STM32F3xx)
 class Stm32FP(lib.stm32.Stm32):
+    FLASH_UNIT = 2
+
+    def _flash_programmable(self, old, new):
+        # zero can be programmed also over not erased half-word
+        return super()._flash_programmable(old, new) or not any(new)
+
+    def _flash_timing(self):
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, Flash.PAGE_ERASE_TIME, Flash.MASS_ERASE_TIME,
+            Flash.LOADER_UNIT_TIME / Flash.LOADER_UNIT)
+
     def _flash_erase_all(self, bank=0):
-        flash = Flash(self, self._stlink, self._dbg, bank=bank)
+        flash = self._flash_open(bank, lambda: Flash(self, self._stlink, self._dbg, bank=bank))
         flash.erase_all()
-        flash.lock()
+        self._flash_close(flash)
 
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         self._dbg.debug('Stm32FP.flash_erase_all()')
         self._flash_erase_all()
 
-    def _flash_write(self, addr, data, erase=False, erase_sizes=None, bank=0):
-        # align data
-        if len(data) % 2:
-            data.extend([0xff] * (2 - len(data) % 2))
-        flash = Flash(self, self._stlink, self._dbg, bank=bank)
+    def _flash_write(self, addr, data, erase=False, geometry=None, bank=0):
+        flash = self._flash_open(bank, lambda: Flash(self, self._stlink, self._dbg, bank=bank))
         if erase:
-            if erase_sizes:
-                flash.erase_pages(self.FLASH_START, erase_sizes, addr, len(data))
+            if geometry:
+                flash.erase_pages(geometry, addr, len(data))
             else:
                 flash.erase_all()
         self._dbg.bargraph_start('Writing FLASH', value_min=addr, value_max=addr + len(data))
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PG_BIT)
-        while(data):
-            self._dbg.bargraph_update(value=addr)
-            block = data[:self._stlink.STLINK_MAXIMUM_TRANSFER_SIZE]
-            data = data[self._stlink.STLINK_MAXIMUM_TRANSFER_SIZE:]
-            if min(block) != 0xff:
-                self._stlink.set_mem16(addr, block)
-            addr += len(block)
-        flash.wait_busy(0.001)
-        flash.lock()
+        self._stlink.set_debugreg32(flash.FLASH_CR_REG, Flash.FLASH_CR_PG_BIT)
+        loader = lib.stm32loader.FlashLoader(self, self._stlink, self._dbg, flash, sram_size=self._sram_size)
+        loader.write(flash.FLASH_SR_REG, addr, data)
+        self._flash_close(flash)
         self._dbg.bargraph_done()
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
-        self._dbg.debug('Stm32FP.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)' % (('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes))
+        self._dbg.debug('Stm32FP.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes)
         if addr is None:
             addr = self.FLASH_START
         elif addr % 2:
             raise lib.stlinkex.StlinkException('Start address is not aligned to half-word')
-        self._flash_write(addr, data, erase=erase, erase_sizes=erase_sizes)
+        geometry = self.flash_geometry(erase_sizes) if erase_sizes else None
+        self._flash_write(addr, data, erase=erase, geometry=geometry)
 
 
 # support STM32F MCUs with page access to FLASH and two banks
@@ -163,25 +217,34 @@ class Stm32FP(lib.stm32.Stm32):
 class Stm32FPXL(Stm32FP):
     BANK_SIZE = 512 * 1024
 
+    def _flash_timing(self):
+        # both banks are erased one after other
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, Flash.PAGE_ERASE_TIME, Flash.MASS_ERASE_TIME,
+            Flash.LOADER_UNIT_TIME / Flash.LOADER_UNIT, mass_erases=2)
+
+    def _flash_bank_size(self, flash_size):
+        return Stm32FPXL.BANK_SIZE
+
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         self._dbg.debug('Stm32F1.flash_erase_all()')
         self._flash_erase_all(bank=0)
         self._flash_erase_all(bank=1)
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
-        self._dbg.debug('Stm32F1.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)' % (('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes))
+        self._dbg.debug('Stm32F1.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes)
         if addr is None:
             addr = self.FLASH_START
         elif addr % 2:
             raise lib.stlinkex.StlinkException('Start address is not aligned to half-word')
-        if (addr - self.FLASH_START) + len(data) <= Stm32FPXL.BANK_SIZE:
-            self._flash_write(addr, data, erase=erase, erase_sizes=erase_sizes, bank=0)
-        elif (addr - self.FLASH_START) > Stm32FPXL.BANK_SIZE:
-            self._flash_write(addr, data, erase=erase, erase_sizes=erase_sizes, bank=1)
-        else:
-            addr_bank1 = addr
-            addr_bank2 = self.FLASH_START + Stm32FPXL.BANK_SIZE
-            data_bank1 = data[:(Stm32FPXL.BANK_SIZE - (addr - self.FLASH_START))]
-            data_bank2 = data[(Stm32FPXL.BANK_SIZE - (addr - self.FLASH_START)):]
-            self._flash_write(addr_bank1, data_bank1, erase=erase, erase_sizes=erase_sizes, bank=0)
-            self._flash_write(addr_bank2, data_bank2, erase=erase, erase_sizes=erase_sizes, bank=1)
+        geometry = self.flash_geometry(erase_sizes)
+        # data are split to banks
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            bank = geometry.bank(addr + offset)
+            size = geometry.bank_end(bank) - addr - offset
+            self._flash_write(addr + offset, view[offset:offset + size], erase=erase, geometry=geometry if erase_sizes else None, bank=bank)
+            offset += size
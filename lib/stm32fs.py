@@ -1,6 +1,10 @@
 import time
 import lib.stm32
 import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32loader
+import lib.stm32plan
+import lib.stm32timing
 
 
 class Flash():
@@ -31,6 +35,40 @@ class Flash():
     FLASH_SR_ERROR_MASK	= FLASH_SR_WRPERR   | FLASH_SR_PGAERR  |\
 			   FLASH_SR_PGPERR |FLASH_SR_ERSERR
 
+    # FLASH loader, R0: FLASH_SR, R1, R2: buffers with descriptors
+    # (destination, count of words) and data, see lib.stm32loader
+    LOADER = [
+        0x0017,  #       movs r7, r2
+        0x684b,  # wait: ldr  r3, [r1, #4]
+        0x2b00,  #       cmp  r3, #0
+        0xd0fc,  #       beq  wait
+        0x1c5c,  #       adds r4, r3, #1
+        0xd013,  #       beq  exit
+        0x680a,  #       ldr  r2, [r1]
+        0x000c,  #       movs r4, r1
+        0x3408,  #       adds r4, #8
+        0x6825,  # loop: ldr  r5, [r4]
+        0x6015,  #       str  r5, [r2]
+        0x6805,  # busy: ldr  r5, [r0]
+        0x0c6e,  #       lsrs r6, r5, #17
+        0xd2fc,  #       bcs  busy
+        0x26f2,  #       movs r6, #0xf2 (PGSERR | PGPERR | PGAERR | WRPERR | OPERR)
+        0x4235,  #       tst  r5, r6
+        0xd108,  #       bne  exit
+        0x3404,  #       adds r4, #4
+        0x3204,  #       adds r2, #4
+        0x3b01,  #       subs r3, #1
+        0xd1f3,  #       bne  loop
+        0x604b,  #       str  r3, [r1, #4]
+        0x000c,  #       movs r4, r1
+        0x0039,  #       movs r1, r7
+        0x0027,  #       movs r7, r4
+        0xe7e6,  #       b    wait
+        0xbe00,  # exit: bkpt #0
+    ]
+    LOADER_UNIT = 4
+    LOADER_UNIT_TIME = 0.0001
+
     VOLTAGE_DEPENDEND_PARAMS = [
         {
             'min_voltage': 2.7,
@@ -57,86 +95,95 @@ class Flash():
         self._driver = driver
         self._stlink = stlink
         self._dbg = dbg
-        self._params = self.get_voltage_dependend_params()
+        self._params = Flash.get_voltage_dependend_params(stlink)
         self.unlock()
 
-    def get_voltage_dependend_params(self):
-        self._stlink.read_target_voltage()
+    @staticmethod
+    def get_voltage_dependend_params(stlink):
+        stlink.read_target_voltage()
         for params in Flash.VOLTAGE_DEPENDEND_PARAMS:
-            if self._stlink.target_voltage > params['min_voltage']:
+            if stlink.target_voltage > params['min_voltage']:
                 return params
-        raise lib.stlinkex.StlinkException('Supply voltage is %.2fV, but minimum for FLASH program or erase is 1.8V' % self._stlink.target_voltage)
-
-    def clear_sr(self):
-        # clear errors
-        sr = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
-        self._stlink.set_debugreg32(Flash.FLASH_SR_REG, sr)
+        raise lib.stlinkex.StlinkException('Supply voltage is %.2fV, but minimum for FLASH program or erase is 1.8V' % stlink.target_voltage)
 
+    @lib.stlinkstats.operation
     def unlock(self):
         self._driver.core_reset_halt()
-        self.clear_sr()
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(Flash.FLASH_SR_REG)
         # do dummy read of FLASH_CR_REG
-        self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
-        self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        sr, _, _, cr = tr.flush()
+        # clear errors
+        tr.set_debugreg32(Flash.FLASH_SR_REG, sr)
         # programing locked
-        if self._stlink.get_debugreg32(Flash.FLASH_CR_REG) & Flash.FLASH_CR_LOCK_BIT:
+        if cr & Flash.FLASH_CR_LOCK_BIT:
             # unlock keys
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0x45670123)
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0xcdef89ab)
-            # check if programing was unlocked
-        if self._stlink.get_debugreg32(Flash.FLASH_CR_REG) & Flash.FLASH_CR_LOCK_BIT:
+            tr.set_debugreg32(Flash.FLASH_KEYR_REG, 0x45670123)
+            tr.set_debugreg32(Flash.FLASH_KEYR_REG, 0xcdef89ab)
+        # check if programing was unlocked
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        cr, = tr.flush()
+        if cr & Flash.FLASH_CR_LOCK_BIT:
             raise lib.stlinkex.StlinkException('Error unlocking FLASH')
 
+    @lib.stlinkstats.operation
     def lock(self):
         self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
         self._driver.core_reset_halt()
 
+    @lib.stlinkstats.operation
     def erase_all(self):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT | Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(self._params['max_mass_erase_time'], 'Erasing FLASH')
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT)
+            tr.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_MER_BIT | Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(self._params['max_mass_erase_time'], 'Erasing FLASH', key=lib.stm32timing.FlashTiming.MASS_ERASE_KEY)
 
+    @lib.stlinkstats.operation
     def erase_sector(self, sector, erase_size):
         flash_cr_value = Flash.FLASH_CR_SER_BIT
         flash_cr_value |= self._params['FLASH_CR_PSIZE'] | (sector << Flash.FLASH_CR_SNB_BITINDEX)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value | Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(self._params['max_erase_time'][erase_size / 1024])
-
-    def erase_sectors(self, flash_start, erase_sizes, addr, size):
-        erase_addr = flash_start
-        self._dbg.bargraph_start('Erasing FLASH', value_min=flash_start, value_max=flash_start + size)
-        sector = 0
-        while True:
-            for erase_size in erase_sizes:
-                if addr < erase_addr + erase_size:
-                    self._dbg.bargraph_update(value=erase_addr)
-                    self.erase_sector(sector, erase_size)
-                erase_addr += erase_size
-                if addr + size < erase_addr:
-                    self._dbg.bargraph_done()
-                    return
-                sector += 1
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value)
+            tr.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value | Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(self._params['max_erase_time'][erase_size // 1024], key=lib.stm32timing.FlashTiming.erase_key(erase_size))
 
-    def wait_busy(self, wait_time, bargraph_msg=None):
-        end_time = time.time() + wait_time * 1.5
+    @lib.stlinkstats.operation
+    def erase_sectors(self, geometry, addr, size):
+        sectors = geometry.indexes(addr, size)
+        self._dbg.bargraph_start('Erasing FLASH', value_min=sectors.start, value_max=sectors.stop)
+        for sector in sectors:
+            self._dbg.bargraph_update(value=sector)
+            self.erase_sector(sector, geometry.sector(sector)[1])
+        self._dbg.bargraph_done()
+
+    @lib.stlinkstats.operation
+    def wait_busy(self, wait_time, bargraph_msg=None, key=None):
+        wait = self._driver.flash_busy_wait(wait_time, wait_time * 1.5, key=key)
         if bargraph_msg:
-            self._dbg.bargraph_start(bargraph_msg, value_min=time.time(), value_max=time.time() + wait_time)
-        while time.time() < end_time:
+            self._dbg.bargraph_start(bargraph_msg, value_min=wait.start_time, value_max=wait.start_time + wait.expected)
+        while True:
             if bargraph_msg:
                 self._dbg.bargraph_update(value=time.time())
             status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
             if not status & Flash.FLASH_SR_BSY:
+                wait.done()
                 self.end_of_operation(status)
                 if bargraph_msg:
                     self._dbg.bargraph_done()
                 return
-            time.sleep(wait_time / 20)
-        raise lib.stlinkex.StlinkException('Operation timeout')
+            if wait.timeout():
+                raise lib.stlinkex.StlinkException('Operation timeout')
+            wait.sleep()
 
+    @lib.stlinkstats.operation
     def wait_for_breakpoint(self, wait_time):
         end_time = time.time() + wait_time
-        while time.time() < end_time and not self._stlink.get_debugreg32(lib.stm32.Stm32.DHCSR_REG) & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+        while not self._stlink.get_debugreg32(lib.stm32.Stm32.DHCSR_REG) & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+            if time.time() > end_time:
+                raise lib.stlinkex.StlinkException('FLASH loader timeout')
             time.sleep(wait_time / 20)
         self.end_of_operation(self._stlink.get_debugreg32(Flash.FLASH_SR_REG))
 
@@ -148,55 +195,66 @@ class Flash():
 # support all STM32F MCUs with sector access access to FLASH
 # (STM32F2xx, STM32F4xx)
 class Stm32FS(lib.stm32.Stm32):
+    def _flash_programmable(self, old, new):
+        # programming can clear any bit
+        return all(o & n == n for o, n in zip(old, new))
+
+    def _flash_timing(self):
+        params = Flash.get_voltage_dependend_params(self._stlink)
+        erase_times = {size * 1024: erase_time for size, erase_time in params['max_erase_time'].items()}
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, max(erase_times.values()), params['max_mass_erase_time'],
+            Flash.LOADER_UNIT_TIME / Flash.LOADER_UNIT, erase_times=erase_times)
+
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         self._dbg.debug('Stm32FS.flash_erase_all()')
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         flash.erase_all()
-        flash.lock()
+        self._flash_close(flash)
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
-        self._dbg.debug('Stm32FS.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)' % (('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes))
+        self._dbg.debug('Stm32FS.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)', ('0x%08x' % addr) if addr is not None else 'None', len(data), erase, erase_sizes)
         if addr is None:
             addr = self.FLASH_START
         if addr < self.FLASH_START and addr >= Flash.AXIM_BASE:
             addr = Flash.AXIM_BASE + addr - self.FLASH_START
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         if erase:
             if erase_sizes:
-                flash.erase_sectors(self.FLASH_START, erase_sizes, addr, len(data))
+                flash.erase_sectors(self.flash_geometry(erase_sizes), addr, len(data))
             else:
                 flash.erase_all()
         status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
         if status & Flash.FLASH_SR_ERROR_MASK:
             # Try to clear errors
-            self._stlink.set_debugreg32(Flash.FLASH_SR_REG, Flash.FLASH_SR_ERROR_MASK)
-            status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
+            tr = self._stlink.transaction()
+            tr.set_debugreg32(Flash.FLASH_SR_REG, Flash.FLASH_SR_ERROR_MASK)
+            tr.get_debugreg32(Flash.FLASH_SR_REG)
+            status, = tr.flush()
             if status & Flash.FLASH_SR_ERROR_MASK:
                 raise lib.stlinkex.StlinkException(
                     'FLASH state error : %08x\n' % status)
-        params =   Flash.get_voltage_dependend_params(self)
-        print('Align %d' % params['align'])
+        params = flash._params
+        self._dbg.debug('Align %d', params['align'])
         self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PG_BIT | params['FLASH_CR_PSIZE'])
         self._dbg.bargraph_start('Writing FLASH', value_min=addr, value_max=addr + len(data))
-        # align data
-        if len(data) % params['align']:
-            data.extend([0xff] * (params['align'] - len(data) % params['align']))
-        datablock = data
-        data_addr = addr
-        while datablock:
-            block = datablock[:1024]
-            datablock = datablock[1024:]
-            if min(block) != 0xff:
+        if params['align'] == Flash.LOADER_UNIT and addr % Flash.LOADER_UNIT == 0:
+            # program FLASH by loader running from SRAM
+            loader = lib.stm32loader.FlashLoader(self, self._stlink, self._dbg, flash, sram_size=self._sram_size)
+            loader.write(Flash.FLASH_SR_REG, addr, data)
+        else:
+            for offset, block in lib.stm32plan.program_chunks(data, self._stlink.maximum_transfer_size, params['align']):
                 if params['align'] == 4:
-                    self._stlink.set_mem32(data_addr, block)
+                    self._stlink.set_mem32(addr + offset, block)
                 elif params['align'] == 2:
-                    self._stlink.set_mem16(data_addr, block)
+                    self._stlink.set_mem16(addr + offset, block)
                 else :
-                    self._stlink.set_mem8(data_addr, block)
-            data_addr += len(block)
-            self._dbg.bargraph_update(value=data_addr)
-        flash.wait_busy(0.001)
-        flash.lock()
+                    self._stlink.set_mem8(addr + offset, block)
+                self._dbg.bargraph_update(value=addr + offset + len(block))
+            flash.wait_busy(0.001)
+        self._flash_close(flash)
         self._dbg.bargraph_done()
         if status & Flash.FLASH_SR_ERROR_MASK:
             raise lib.stlinkex.StlinkException(
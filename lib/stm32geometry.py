@@ -0,0 +1,87 @@
+import bisect
+import lib.stlinkex
+
+
+# FLASH geometry
+#
+# start addresses and sizes of all sectors (or pages) of FLASH and start
+# addresses of banks, it is built once for detected MCU and shared by erasing,
+# verifying and planning, sectors of address or region are found by bisect.
+# Sector sizes from device list are repeated until whole FLASH is covered.
+
+
+class FlashGeometry():
+    def __init__(self, flash_start, flash_size, erase_sizes, bank_size=None):
+        # sizes are in Bytes
+        if not erase_sizes:
+            raise lib.stlinkex.StlinkException('Sector sizes are not known, FLASH can be only mass erased')
+        self.start = flash_start
+        self.size = flash_size
+        self.end = flash_start + flash_size
+        self.erase_sizes = tuple(erase_sizes)
+        self.bank_size = bank_size or flash_size
+        self.banks = list(range(flash_start, self.end, self.bank_size))
+        self.addrs = []
+        self.sizes = []
+        addr = flash_start
+        while addr < self.end:
+            for erase_size in self.erase_sizes:
+                if addr >= self.end:
+                    break
+                self.addrs.append(addr)
+                self.sizes.append(erase_size)
+                addr += erase_size
+        # index of first sector of each bank
+        self._bank_indexes = [bisect.bisect_left(self.addrs, bank_addr) for bank_addr in self.banks]
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def _check(self, addr):
+        if not self.start <= addr < self.end:
+            raise lib.stlinkex.StlinkException('Address 0x%08x is out of FLASH' % addr)
+
+    def index(self, addr):
+        # index of sector containing address
+        self._check(addr)
+        return bisect.bisect_right(self.addrs, addr) - 1
+
+    def sector(self, index):
+        return self.addrs[index], self.sizes[index]
+
+    def indexes(self, addr, size):
+        # range of indexes of sectors overlapping region
+        if size <= 0:
+            return range(0)
+        return range(self.index(addr), self.index(addr + size - 1) + 1)
+
+    def sectors(self, addr, size):
+        # list of (address, size) of sectors overlapping region
+        return [self.sector(index) for index in self.indexes(addr, size)]
+
+    def regions(self, addr, size):
+        # split region to parts lying in single sectors
+        regions = []
+        for sector_addr, sector_size in self.sectors(addr, size):
+            start = max(sector_addr, addr)
+            end = min(sector_addr + sector_size, addr + size)
+            regions.append((start, end - start))
+        return regions
+
+    def bank(self, addr):
+        # index of bank containing address
+        self._check(addr)
+        return bisect.bisect_right(self.banks, addr) - 1
+
+    def bank_sector(self, index):
+        # (bank, sector number in bank) of sector index
+        bank = bisect.bisect_right(self._bank_indexes, index) - 1
+        return bank, index - self._bank_indexes[bank]
+
+    def bank_end(self, bank):
+        return min(self.banks[bank] + self.bank_size, self.end)
+
+    def bank_sectors(self, bank):
+        # range of indexes of all sectors of bank
+        end = self._bank_indexes[bank + 1] if bank + 1 < len(self.banks) else len(self.addrs)
+        return range(self._bank_indexes[bank], end)
@@ -1,6 +1,9 @@
 import time
 import lib.stm32
 import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32plan
+import lib.stm32timing
 
 # Stm32H7 programming
 class Flash():
@@ -60,11 +63,18 @@ class Flash():
 
     FLASH_OPTCR_MER       = 1 <<  4
 
+    SECTOR_SIZE = 128 * 1024
+    MASS_ERASE_TIME = 20
+    BANK_ERASE_TIME = 12
+    SECTOR_ERASE_TIME = 4
+    # programming of 256 bit FLASH word
+    PROGRAM_TIME = 0.0001 / 32
+
     def __init__(self, driver, stlink, dbg):
         self._driver = driver
         self._stlink = stlink
         self._dbg = dbg
-        self._sector_size = 128 * 1024
+        self._sector_size = Flash.SECTOR_SIZE
         self._flash_size = self._stlink.get_debugreg32(0x1ff1e880) & 0xffff
         self._flash_size *= 1024
         self._driver.core_reset_halt()
@@ -74,22 +84,28 @@ class Flash():
         self.unlock(1)
 
     def clear_sr(self, bank):
-        # clear errors
-        sr = self._stlink.get_debugreg32(Flash.FLASH_SR_REGS[bank])
-        self._stlink.set_debugreg32(Flash.FLASH_CCR1_REGS[bank], sr)
+        # clear errors, returned transaction can be used to queue more
+        # accesses after clearing
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(Flash.FLASH_SR_REGS[bank])
+        sr, = tr.flush()
+        tr.set_debugreg32(Flash.FLASH_CCR1_REGS[bank], sr)
+        return tr
 
+    @lib.stlinkstats.operation
     def unlock(self, bank):
-        self._dbg.debug('unlock bank %d start' % bank)
-        self.clear_sr(bank)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[bank],
-                                    Flash.FLASH_CR_LOCK)
+        self._dbg.debug('unlock bank %d start', bank)
+        tr = self.clear_sr(bank)
+        tr.set_debugreg32(Flash.FLASH_CR_REGS[bank], Flash.FLASH_CR_LOCK)
         # Lock first. Unlock a previous unlocks register will fail until reset!
-        cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+        tr.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+        cr, = tr.flush()
         if cr & Flash.FLASH_CR_LOCK:
             # unlock keys
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REGS[bank],0x45670123)
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REGS[bank], 0xcdef89ab)
-            cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+            tr.set_debugreg32(Flash.FLASH_KEYR_REGS[bank], 0x45670123)
+            tr.set_debugreg32(Flash.FLASH_KEYR_REGS[bank], 0xcdef89ab)
+            tr.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+            cr, = tr.flush()
         else :
             raise lib.stlinkex.StlinkException(
                 'Unexpected unlock behaviour bank %d! FLASH_CR 0x%08x'
@@ -100,168 +116,184 @@ class Flash():
                 'Error unlocking bank %d, FLASH_CR: 0x%08x. Reset!'
                                                % (bank, cr))
 
+    @lib.stlinkstats.operation
     def lock(self, bank):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[bank],
-                                    Flash.FLASH_CR_LOCK)
-        cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+        tr = self._stlink.transaction()
+        tr.set_debugreg32(Flash.FLASH_CR_REGS[bank], Flash.FLASH_CR_LOCK)
+        tr.get_debugreg32(Flash.FLASH_CR_REGS[bank])
+        cr, = tr.flush()
         if not cr &Flash.FLASH_CR_LOCK:
             self._dbg.info('Bank %d lock faildL cr %08x' % (bank, cr))
         self._driver.core_reset_halt()
 
+    @lib.stlinkstats.operation
     def erase_all(self):
         self._dbg.debug('erase_all')
-        self.clear_sr(0)
-        self.clear_sr(1)
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(Flash.FLASH_SR_REGS[0])
+        tr.get_debugreg32(Flash.FLASH_SR_REGS[1])
+        sr0, sr1 = tr.flush()
+        # clear errors of both banks
+        tr.set_debugreg32(Flash.FLASH_CCR1_REGS[0], sr0)
+        tr.set_debugreg32(Flash.FLASH_CCR1_REGS[1], sr1)
         cr = Flash.FLASH_CR_PSIZE32
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[0], cr)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[1], cr)
-        self._stlink.set_debugreg32(Flash.FLASH_OPTCR, Flash.FLASH_OPTCR_MER )
-        self.wait_busy(20, bargraph_msg='Erasing FLASH', bank=2, check_qw=True)
+        tr.set_debugreg32(Flash.FLASH_CR_REGS[0], cr)
+        tr.set_debugreg32(Flash.FLASH_CR_REGS[1], cr)
+        tr.set_debugreg32(Flash.FLASH_OPTCR, Flash.FLASH_OPTCR_MER )
+        tr.flush()
+        self.wait_busy(Flash.MASS_ERASE_TIME, bargraph_msg='Erasing FLASH', bank=2, check_qw=True, key=lib.stm32timing.FlashTiming.MASS_ERASE_KEY)
 
+    @lib.stlinkstats.operation
     def erase_bank(self, bank):
-        self._dbg.debug('erase_bank %d' % bank)
-        self.clear_sr(bank)
+        self._dbg.debug('erase_bank %d', bank)
         cr = Flash.FLASH_CR_PSIZE32 | Flash.FLASH_CR_BER
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[bank], cr)
-        cr |= Flash.FLASH_CR_START
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[bank], cr)
-        self.wait_busy(12, bank=bank, check_qw=True)
+        with self.clear_sr(bank) as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[bank], cr)
+            cr |= Flash.FLASH_CR_START
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[bank], cr)
+        self.wait_busy(Flash.BANK_ERASE_TIME, bank=bank, check_qw=True, key=lib.stm32timing.FlashTiming.BANK_ERASE_KEY)
 
-    def erase_sector(self, sector):
+    @lib.stlinkstats.operation
+    def erase_sector(self, bank, sector):
+        # sector is numbered in bank
         cr = Flash.FLASH_CR_SER | Flash.FLASH_CR_PSIZE32
-        if (sector < 8) :
-            self.clear_sr(0)
-            cr |= (sector << Flash.FLASH_CR_SNB_BITINDEX)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[0], cr)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[0],
-                                        cr | Flash.FLASH_CR_START)
-            self.wait_busy(4, bank=0, check_qw=True)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[0], 0)
-        else:
-            self.clear_sr(1)
-            cr |= ((sector - 8) * Flash.FLASH_CR_SNB_BITINDEX)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[1], cr)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[1],
-                                        cr | Flash.FLASH_CR_START)
-            self.wait_busy(4, bank=1, check_qw=True)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[1], 0)
+        cr |= (sector << Flash.FLASH_CR_SNB_BITINDEX)
+        with self.clear_sr(bank) as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[bank], cr)
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[bank],
+                              cr | Flash.FLASH_CR_START)
+        self.wait_busy(Flash.SECTOR_ERASE_TIME, bank=bank, check_qw=True, key=lib.stm32timing.FlashTiming.erase_key(Flash.SECTOR_SIZE))
+        self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[bank], 0)
 
-    def erase_sectors(self, addr, size):
+    @lib.stlinkstats.operation
+    def erase_sectors(self, geometry, addr, size):
         if size == 0:
             return
         self._dbg.debug(
-            'erase_sectors page size %d from addr %08x for %d byte' %
-            (self._sector_size, addr, size))
+            'erase_sectors page size %d from addr %08x for %d byte',
+            self._sector_size, addr, size)
         self._dbg.bargraph_start('Erasing FLASH', value_min=addr,
                                  value_max=addr + size)
-        sector     = addr        - lib.stm32.Stm32.FLASH_START
-        end_sector = addr + size - lib.stm32.Stm32.FLASH_START
-        sector     //= self._sector_size
-        end_sector //= self._sector_size
-        if sector == 0 and end_sector >= 8:
-            self.erase_bank(0)
-            addr += 8* self._sector_size
-            self._dbg.bargraph_update(value=addr)
-            sector = 8
-        while sector <= end_sector:
-            if sector == 8 and end_sector >= 16:
-                self.erase_bank(1)
-                addr += 8* self._sector_size
-                self._dbg.bargraph_update(value=addr)
-                break
-            self.erase_sector(sector)
-            sector += 1
-            addr += self._sector_size
-            self._dbg.bargraph_update(value=addr)
+        indexes = geometry.indexes(addr, size)
+        index = indexes.start
+        while index < indexes.stop:
+            bank, sector = geometry.bank_sector(index)
+            bank_sectors = geometry.bank_sectors(bank)
+            # whole bank is erased at once
+            if sector == 0 and indexes.stop >= bank_sectors.stop:
+                self.erase_bank(bank)
+                index = bank_sectors.stop
+            else:
+                self.erase_sector(bank, sector)
+                index += 1
+            self._dbg.bargraph_update(value=sum(geometry.sector(index - 1)))
         self._dbg.bargraph_done()
 
-    def wait_busy(self, wait_time, bargraph_msg=None, bank=0, check_qw=False):
-        end_time = time.time() + wait_time * 1.5
+    @lib.stlinkstats.operation
+    def wait_busy(self, wait_time, bargraph_msg=None, bank=0, check_qw=False, key=None):
+        wait = self._driver.flash_busy_wait(wait_time, wait_time * 1.5, key=key)
         if bargraph_msg:
-            self._dbg.bargraph_start(bargraph_msg, value_min=time.time(), value_max=time.time() + wait_time)
-        while time.time() < end_time:
+            self._dbg.bargraph_start(bargraph_msg, value_min=wait.start_time, value_max=wait.start_time + wait.expected)
+        while True:
             if bargraph_msg:
                 self._dbg.bargraph_update(value=time.time())
-            status = 0
+            tr = self._stlink.transaction()
             if bank == 0 or bank == 2:
-                status |= self._stlink.get_debugreg32(Flash.FLASH_SR_REGS[0])
+                tr.get_debugreg32(Flash.FLASH_SR_REGS[0])
             if bank & 1:
-                status |= self._stlink.get_debugreg32(Flash.FLASH_SR_REGS[1])
+                tr.get_debugreg32(Flash.FLASH_SR_REGS[1])
+            status = 0
+            for sr in tr.flush():
+                status |= sr
             if not status & (Flash.FLASH_SR_BUSY | (check_qw & Flash.FLASH_SR_QW)) :
+                wait.done()
                 self.end_of_operation(status)
                 if bargraph_msg:
                     self._dbg.bargraph_done()
                 return
-            time.sleep(wait_time / 20)
-        raise lib.stlinkex.StlinkException('Operation timeout')
+            if wait.timeout():
+                raise lib.stlinkex.StlinkException('Operation timeout')
+            wait.sleep()
 
     def end_of_operation(self, status):
         if status & Flash.FLASH_SR_ERROR_MASK:
             raise lib.stlinkex.StlinkException('Error writing FLASH with status (FLASH_SR) %08x' % status)
 
 class Stm32H7(lib.stm32.Stm32):
+    FLASH_UNIT = 32
+    BANK_SIZE = 1024 * 1024
+
+    def _flash_lock(self, flash):
+        flash.lock(0)
+        flash.lock(1)
+
+    def _flash_erase_sizes(self, erase_sizes):
+        return (Flash.SECTOR_SIZE, )
+
+    def _flash_timing(self):
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, Flash.SECTOR_ERASE_TIME, Flash.MASS_ERASE_TIME,
+            Flash.PROGRAM_TIME, bank_erase_time=Flash.BANK_ERASE_TIME)
+
+    def _flash_bank_size(self, flash_size):
+        return Stm32H7.BANK_SIZE
+
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         self._dbg.debug('Stm32H7.flash_erase_all()')
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         flash.erase_all()
-        flash.lock(0)
-        flash.lock(1)
+        self._flash_close(flash)
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
         if addr is None:
             addr = self.FLASH_START
         self._dbg.debug(
-            'Stm32h7.flash_write(%s, [data:%dBytes], erase=%s)' %
-            (addr, len(data), erase))
+            'Stm32h7.flash_write(%s, [data:%dBytes], erase=%s)',
+            addr, len(data), erase)
         if addr % 8:
             raise lib.stlinkex.StlinkException(
                 'Start address is not aligned to word')
-        # pad data
-        if len(data) % 32:
-            data.extend([0xff] * (32 - len(data) % 32))
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         if erase:
             full_chip = (addr == self.FLASH_START) and \
                         (len(data) == flash._flash_size)
             if not erase_sizes or full_chip:
                 flash.erase_all()
             else:
-                flash.erase_sectors(addr, len(data))
+                flash.erase_sectors(self.flash_geometry(erase_sizes), addr, len(data))
         self._dbg.bargraph_start('Writing FLASH', value_min=addr,
                                  value_max=addr + len(data))
+        # banks were unlocked when FLASH session was opened
         cr = Flash.FLASH_CR_PG | Flash.FLASH_CR_PSIZE32
         if addr < 0x08100000:
-            flash.unlock(0)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[0], cr)
-            cr =  self._stlink.get_debugreg32(Flash.FLASH_CR_REGS[0])
+            tr = flash.clear_sr(0)
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[0], cr)
+            tr.get_debugreg32(Flash.FLASH_CR_REGS[0])
+            cr, = tr.flush()
             if not cr & Flash.FLASH_CR_PG:
                 raise lib.stlinkex.StlinkException(
                     'Bank 0 FLASH_CR not ready for programming: %08x\n' % cr)
         if addr + len(data) >= 0x08100000:
-            flash.unlock(1)
-            self._stlink.set_debugreg32(Flash.FLASH_CR_REGS[1], cr)
-            cr =  self._stlink.get_debugreg32(Flash.FLASH_CR_REGS[1])
+            tr = flash.clear_sr(1)
+            tr.set_debugreg32(Flash.FLASH_CR_REGS[1], cr)
+            tr.get_debugreg32(Flash.FLASH_CR_REGS[1])
+            cr, = tr.flush()
             if not cr & Flash.FLASH_CR_PG:
                 raise lib.stlinkex.StlinkException(
                     'Bank 1 FLASH_CR not ready for programming: %08x\n' % cr)
-        datablock = data
-        data_addr = addr
-        while datablock:
-            block = datablock[:1024]
-            datablock = datablock[1024:]
-            if min(block) != 0xff:
-                self._stlink.set_mem32(data_addr, block)
-            data_addr += len(block)
-            self._dbg.bargraph_update(value=data_addr)
+        for offset, block in lib.stm32plan.program_chunks(data, self._stlink.maximum_transfer_size, Stm32H7.FLASH_UNIT):
+            self._stlink.set_mem32(addr + offset, block)
+            self._dbg.bargraph_update(value=addr + offset + len(block))
         flash.wait_busy(0.001)
-        flash.lock(0)
-        flash.lock(1)
+        self._flash_close(flash)
         self._dbg.bargraph_done()
-        status = self._stlink.get_debugreg32(Flash.FLASH_SR_REGS[0])
-        if status & Flash.FLASH_SR_ERROR_MASK:
-            raise lib.stlinkex.StlinkException(
-                'Bank 0, Error writing FLASH with status: %08x\n' % status)
-        status = self._stlink.get_debugreg32(Flash.FLASH_SR_REGS[1])
-        if status & Flash.FLASH_SR_ERROR_MASK:
-            raise lib.stlinkex.StlinkException(
-                'Bank 1, Error writing FLASH with status: %08x\n' % status)
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(Flash.FLASH_SR_REGS[0])
+        tr.get_debugreg32(Flash.FLASH_SR_REGS[1])
+        statuses = tr.flush()
+        for bank, status in enumerate(statuses):
+            if status & Flash.FLASH_SR_ERROR_MASK:
+                raise lib.stlinkex.StlinkException(
+                    'Bank %d, Error writing FLASH with status: %08x\n' % (bank, status))
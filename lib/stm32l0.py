@@ -1,6 +1,10 @@
 import time
 import lib.stm32
 import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32geometry
+import lib.stm32plan
+import lib.stm32timing
 
 # Stm32 L0 and L1 programming
 class Flash():
@@ -30,54 +34,62 @@ class Flash():
 
     SR_ERROR_MASK = SR_WRPERR | SR_PGAERR | SR_SIZERR
 
+    PAGE_ERASE_TIME = 0.01
+    HALF_PAGE_PROGRAM_TIME = 0.005
+
     def __init__(self, driver, stlink, dbg):
         self._driver = driver
         self._stlink = stlink
         self._dbg = dbg
-        self._page_size = 2048
+        self._page_size = Flash.page_size(stlink)
         #use core id to find out if L0 or L1
         if  stlink._coreid == 0xbc11477:
             self._nvm = Flash.STM32L0_NVM_PHY
-            self._page_size = 128
         else:
             self._nvm = Flash.STM32L1_NVM_PHY
-            self._page_size = 256
         self.unlock()
 
-    def clear_sr(self):
-        # clear errors
-        sr = self._stlink.get_debugreg32(self._nvm + Flash.SR_OFFSET)
-        self._stlink.set_debugreg32(self._nvm + Flash.SR_OFFSET, sr)
+    @staticmethod
+    def page_size(stlink):
+        return 128 if stlink._coreid == 0xbc11477 else 256
 
+    @lib.stlinkstats.operation
     def unlock(self):
         self._dbg.debug('unlock')
         self._driver.core_reset_halt()
         self.wait_busy(0.01)
-        self.clear_sr()
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(self._nvm + Flash.SR_OFFSET)
+        sr, = tr.flush()
+        # clear errors
+        tr.set_debugreg32(self._nvm + Flash.SR_OFFSET, sr)
         # Lock first. Double unlock results in error!
-        self._stlink.set_debugreg32(self._nvm + Flash.PECR_OFFSET,
-                                    Flash.PECR_PELOCK)
-        pecr = self._stlink.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+        tr.set_debugreg32(self._nvm + Flash.PECR_OFFSET, Flash.PECR_PELOCK)
+        tr.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+        pecr, = tr.flush()
         if pecr & Flash.PECR_PELOCK:
             # unlock keys
-            self._stlink.set_debugreg32(self._nvm + Flash.PEKEYR_OFFSET,
-                                        Flash.STM32_NVM_PEKEY1)
-            self._stlink.set_debugreg32(self._nvm + Flash.PEKEYR_OFFSET,
-                                        Flash.STM32_NVM_PEKEY2)
-            pecr = self._stlink.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+            tr.set_debugreg32(self._nvm + Flash.PEKEYR_OFFSET,
+                              Flash.STM32_NVM_PEKEY1)
+            tr.set_debugreg32(self._nvm + Flash.PEKEYR_OFFSET,
+                              Flash.STM32_NVM_PEKEY2)
+            tr.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+            pecr, = tr.flush()
         else :
             raise lib.stlinkex.StlinkException(
                 'Unexpected unlock behaviour! FLASH_CR 0x%08x' % pecr)
         # check if programing was unlocked
         if pecr & Flash.PECR_PELOCK:
             raise lib.stlinkex.StlinkException(
-                'Error unlocking FLASH_CR: 0x%08x. Reset!' % prcr)
+                'Error unlocking FLASH_CR: 0x%08x. Reset!' % pecr)
 
+    @lib.stlinkstats.operation
     def lock(self):
         self._stlink.set_debugreg32(self._nvm + Flash.PECR_OFFSET,
                                     Flash.PECR_PELOCK)
         self._driver.core_reset_halt()
 
+    @lib.stlinkstats.operation
     def prg_unlock(self):
         pecr = self._stlink.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
         if not pecr & Flash.PECR_PRGLOCK:
@@ -85,43 +97,45 @@ class Flash():
         if pecr & Flash.PECR_PELOCK:
             raise lib.stlinkex.StlinkException('PELOCK still set: %08x' % pecr)
         # unlock keys
-        self._stlink.set_debugreg32(self._nvm + Flash.PRGKEYR_OFFSET,
-                                    Flash.STM32_NVM_PRGKEY1)
-        self._stlink.set_debugreg32(self._nvm + Flash.PRGKEYR_OFFSET,
-                                    Flash.STM32_NVM_PRGKEY2)
-        pecr = self._stlink.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+        tr = self._stlink.transaction()
+        tr.set_debugreg32(self._nvm + Flash.PRGKEYR_OFFSET,
+                          Flash.STM32_NVM_PRGKEY1)
+        tr.set_debugreg32(self._nvm + Flash.PRGKEYR_OFFSET,
+                          Flash.STM32_NVM_PRGKEY2)
+        tr.get_debugreg32(self._nvm + Flash.PECR_OFFSET)
+        pecr, = tr.flush()
         if pecr & Flash.PECR_PRGLOCK:
             raise lib.stlinkex.StlinkException('PRGLOCK still set: %08x' % pecr)
 
-    def erase_pages(self, addr, size):
+    @lib.stlinkstats.operation
+    def erase_pages(self, geometry, addr, size):
         self._dbg.verbose('erase_pages from addr 0x%08x for %d byte' %
                           (addr, size))
-        erase_addr =   addr         & ~(self._page_size - 1)
-        last_addr  =  (addr + size + self._page_size - 1) &\
-                      ~(self._page_size - 1)
-        self._dbg.bargraph_start('Erasing FLASH', value_min=erase_addr,
-                                 value_max=last_addr)
+        pages = geometry.sectors(addr, size)
+        self._dbg.bargraph_start('Erasing FLASH', value_min=0, value_max=len(pages))
         self.prg_unlock()
         pecr = Flash.PECR_PRG | Flash.PECR_ERASE
         self._stlink.set_debugreg32(self._nvm + Flash.PECR_OFFSET, pecr)
-        while erase_addr < last_addr:
-            self._stlink.set_debugreg32(erase_addr, 0)
-            self.wait_busy(0.01)
-            erase_addr += self._page_size
-            self._dbg.bargraph_update(value=erase_addr)
+        for index, (page_addr, page_size) in enumerate(pages):
+            self._dbg.bargraph_update(value=index)
+            # page is erased by writing any word in it
+            self._stlink.set_debugreg32(page_addr, 0)
+            self.wait_busy(Flash.PAGE_ERASE_TIME, key=lib.stm32timing.FlashTiming.erase_key(page_size))
         self._dbg.bargraph_done()
         self._stlink.set_debugreg32(self._nvm + Flash.PECR_OFFSET, 0)
 
-    def wait_busy(self, wait_time, bargraph_msg=None, check_eop=False):
-        end_time = time.time() + wait_time * 1.5
+    @lib.stlinkstats.operation
+    def wait_busy(self, wait_time, bargraph_msg=None, check_eop=False, key=None):
+        wait = self._driver.flash_busy_wait(wait_time, wait_time * 1.5, key=key)
         if bargraph_msg:
-            self._dbg.bargraph_start(bargraph_msg, value_min=time.time(),
-                                     value_max=time.time() + wait_time)
-        while time.time() < end_time:
+            self._dbg.bargraph_start(bargraph_msg, value_min=wait.start_time,
+                                     value_max=wait.start_time + wait.expected)
+        while True:
             if bargraph_msg:
                 self._dbg.bargraph_update(value=time.time())
             status = self._stlink.get_debugreg32(self._nvm + Flash.SR_OFFSET)
             if not status & (Flash.SR_BSY | (check_eop & Flash.SR_EOP)) :
+                wait.done()
                 self.end_of_operation(status)
                 if bargraph_msg:
                     self._dbg.bargraph_done()
@@ -129,8 +143,9 @@ class Flash():
                     self._stlink.set_debugreg32(self._nvm + Flash.SR_OFFSET,
                                                  Flash.SR_EOP)
                 return
-            time.sleep(wait_time / 20)
-        raise lib.stlinkex.StlinkException('Operation timeout')
+            if wait.timeout():
+                raise lib.stlinkex.StlinkException('Operation timeout')
+            wait.sleep()
 
     def end_of_operation(self, status):
         if status & Flash.SR_ERROR_MASK:
@@ -139,67 +154,75 @@ class Flash():
 
 
 class Stm32L0(lib.stm32.Stm32):
+    FLASH_ERASED = 0x00
+
+    def _flash_timing(self):
+        # there is no mass erase, all pages are erased
+        page_size = Flash.page_size(self._stlink)
+        pages = (self._flash_size or Stm32L0.DEFAULT_FLASH_SIZE) * 1024 // page_size
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, Flash.PAGE_ERASE_TIME, Flash.PAGE_ERASE_TIME,
+            Flash.HALF_PAGE_PROGRAM_TIME / (page_size // 2), mass_erases=pages)
+
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         # Mass erase is only possible by setting and removing flash
         # write protection. This will also erase EEPROM!
         # Use page erase instead
 
         self._dbg.debug('Stm32L0.flash_erase_all')
-        flash = Flash(self, self._stlink, self._dbg)
-        flash.erase_pages(lib.stm32.Stm32.FLASH_START, flash_size);
-        flash.lock()
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
+        geometry = lib.stm32geometry.FlashGeometry(self.FLASH_START, flash_size * 1024, (Flash.page_size(self._stlink), ))
+        flash.erase_pages(geometry, geometry.start, geometry.size)
+        self._flash_close(flash)
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
         if addr is None:
             addr = self.FLASH_START
         self._dbg.debug(
             'Stm32l4.flash_write '
-            '(%s, [data:%dBytes], erase=%s, erase_sizes=%s)'
-            % (addr, len(data), erase, erase_sizes))
+            '(%s, [data:%dBytes], erase=%s, erase_sizes=%s)',
+            addr, len(data), erase, erase_sizes)
         if addr % 4:
             raise lib.stlinkex.StlinkException
         ('Start address is not aligned to word')
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         if erase:
             if erase_sizes:
-                flash.erase_pages(addr, len(data))
+                flash.erase_pages(self.flash_geometry(erase_sizes), addr, len(data))
             else:
                 flash.erase_all()
         self._dbg.bargraph_start('Writing FLASH', value_min=addr,
                                  value_max=addr + len(data))
-        flash.unlock()
+        # FLASH was unlocked when it was opened
         flash.prg_unlock()
-        datablock = data
-        data_addr = addr
-        block = datablock
-        while len(datablock):
+        half_page = flash._page_size >> 1
+        data = lib.stm32plan.pad(data, 4, erased=Stm32L0.FLASH_ERASED)
+        offset = 0
+        while offset < len(data):
             size = 0
-            if data_addr & ((flash._page_size >> 1) -1):
+            if (addr + offset) % half_page:
                 # not half page aligned
-                size = data_addr & ((flash._page_size >> 1) -1)
-                size = (flash._page_size >> 1) - size
-            if len(datablock) < (flash._page_size >> 1):
+                size = half_page - (addr + offset) % half_page
+            if len(data) - offset < half_page:
                 # remainder not full half page
-                size = len(datablock)
-            while size:
-                block = datablock[:4]
-                datablock = datablock[4:]
+                size = len(data) - offset
+            for word_offset, block in lib.stm32plan.chunks(data, 4, offset, offset + size):
                 if max(block) != 0:
-                    self._stlink.set_mem32(data_addr, block)
-                data_addr += 4
-                size -= 4
-                self._dbg.bargraph_update(value=data_addr)
-                flash.wait_busy(0.005, check_eop=True)
+                    self._stlink.set_mem32(addr + word_offset, block)
+                self._dbg.bargraph_update(value=addr + word_offset + 4)
+                flash.wait_busy(Flash.HALF_PAGE_PROGRAM_TIME, check_eop=True)
+            offset += size
             pecr = Flash.PECR_FPRG | Flash.PECR_PRG
             self._stlink.set_debugreg32(flash._nvm + Flash.PECR_OFFSET, pecr)
-            while len(datablock) >= (flash._page_size >> 1):
-                block = datablock[:(flash._page_size >> 1)]
-                datablock = datablock[(flash._page_size >> 1):]
+            end = offset + (len(data) - offset) // half_page * half_page
+            for offset, block in lib.stm32plan.chunks(data, half_page, offset, end):
                 if max(block) != 0:
-                    self._stlink.set_mem32(data_addr, block)
-                data_addr += len(block)
-                self._dbg.bargraph_update(value=data_addr)
-                flash.wait_busy(0.005, check_eop=True)
+                    self._stlink.set_mem32(addr + offset, block)
+                self._dbg.bargraph_update(value=addr + offset + len(block))
+                flash.wait_busy(Flash.HALF_PAGE_PROGRAM_TIME, check_eop=True)
+            offset = end
             self._stlink.set_debugreg32(flash._nvm + Flash.PECR_OFFSET, 0)
-        flash.lock()
+        self._flash_close(flash)
         self._dbg.bargraph_done()
@@ -1,6 +1,9 @@
 import time
 import lib.stm32
 import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32plan
+import lib.stm32timing
 
 # Stm32 L4 and G0 programming
 class Flash():
@@ -38,42 +41,85 @@ class Flash():
         FLASH_SR_MISSERR_BIT)
 
     FLASH_OPTR_REG          = FLASH_REG_BASE + 0x20
+    FLASH_OPTR_DUALBANK_BIT = 1 << 21
     FLASH_OPTR_DBANK_BIT    = 1 << 22
+    # STM32L47x/L48x and L49x/L4Ax have two banks, 256 KB devices only with
+    # DUALBANK option, STM32L4R/S has two banks with DBANK option
+    DUAL_BANK_DEV_IDS = (0x415, 0x461)
+    DBANK_DEV_IDS = (0x470, )
+
+    # max 22.1 sec on STM32L4R (two banks)
+    MASS_ERASE_TIME = 25
+    PAGE_ERASE_TIME = 0.05
+    BANK_ERASE_TIME = 0.05
+    # fast programming of double word
+    PROGRAM_TIME = 0.0001 / 8
 
     def __init__(self, driver, stlink, dbg):
         self._driver = driver
         self._stlink = stlink
         self._dbg = dbg
-        self._page_size = 2048
-        dev_id = self._stlink.get_debugreg32(0xE0042000) & 0xfff
+        self._page_size = Flash.read_page_size(stlink)
+        if self._page_size == 8192:
+            self._dbg.info('STM32L4[R|S] in single bank configuration')
+            self._single_bank = True
+        elif self._page_size == 4096:
+            self._dbg.info('STM32L4[R|S] in dual bank configuration')
+        self.unlock()
+
+    @staticmethod
+    def read_page_size(stlink):
+        # page size depends on bank configuration of STM32L4[R|S]
+        page_size = 2048
+        dev_id = stlink.get_debugreg32(0xE0042000) & 0xfff
         if dev_id == 0x470:
-            optr = self._stlink.get_debugreg32(Flash.FLASH_OPTR_REG)
+            optr = stlink.get_debugreg32(Flash.FLASH_OPTR_REG)
             if not optr & Flash.FLASH_OPTR_DBANK_BIT:
-                self._dbg.info('STM32L4[R|S] in single bank configuration')
-                self._page_size *= 4
-                self._single_bank = True
+                page_size *= 4
             else:
-                self._dbg.info('STM32L4[R|S] in dual bank configuration')
-                self._page_size *= 2
-        self.unlock()
+                page_size *= 2
+        return page_size
+
+    @staticmethod
+    def read_bank_size(stlink, flash_size):
+        # size of bank in Bytes or None if FLASH has only one bank
+        dev_id = stlink.get_debugreg32(0xE0042000) & 0xfff
+        if dev_id in Flash.DUAL_BANK_DEV_IDS:
+            if flash_size > 256 * 1024:
+                return flash_size // 2
+            bank_bit = Flash.FLASH_OPTR_DUALBANK_BIT
+        elif dev_id in Flash.DBANK_DEV_IDS:
+            bank_bit = Flash.FLASH_OPTR_DBANK_BIT
+        else:
+            return None
+        if stlink.get_debugreg32(Flash.FLASH_OPTR_REG) & bank_bit:
+            return flash_size // 2
+        return None
 
     def clear_sr(self):
-        # clear errors
-        sr = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
-        self._stlink.set_debugreg32(Flash.FLASH_SR_REG, sr)
+        # clear errors, returned transaction can be used to queue more
+        # accesses after clearing
+        tr = self._stlink.transaction()
+        tr.get_debugreg32(Flash.FLASH_SR_REG)
+        sr, = tr.flush()
+        tr.set_debugreg32(Flash.FLASH_SR_REG, sr)
+        return tr
 
+    @lib.stlinkstats.operation
     def unlock(self):
         self._dbg.debug('unlock start')
         self._driver.core_reset_halt()
-        self.clear_sr()
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
+        tr = self.clear_sr()
         # Lock first. Double unlock results in error!
-        cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
+        tr.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        cr, = tr.flush()
         if cr & Flash.FLASH_CR_LOCK_BIT:
             # unlock keys
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0x45670123)
-            self._stlink.set_debugreg32(Flash.FLASH_KEYR_REG, 0xcdef89ab)
-            cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
+            tr.set_debugreg32(Flash.FLASH_KEYR_REG, 0x45670123)
+            tr.set_debugreg32(Flash.FLASH_KEYR_REG, 0xcdef89ab)
+            tr.get_debugreg32(Flash.FLASH_CR_REG)
+            cr, = tr.flush()
         else :
             raise lib.stlinkex.StlinkException(
                 'Unexpected unlock behaviour! FLASH_CR 0x%08x' % cr)
@@ -85,83 +131,95 @@ class Flash():
             raise lib.stlinkex.StlinkException(
                 'Error unlocking FLASH_CR: 0x%08x. Reset!' % cr)
 
+    @lib.stlinkstats.operation
     def lock(self):
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
-        cr = self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
-        self._dbg.debug('lock cr %08x' % cr)
+        tr = self._stlink.transaction()
+        tr.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_LOCK_BIT)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        cr, = tr.flush()
+        self._dbg.debug('lock cr %08x', cr)
 
+    @lib.stlinkstats.operation
     def erase_all(self):
         self._dbg.debug('erase_all')
         cr =  Flash.FLASH_CR_MER1_BIT | Flash.FLASH_CR_MER2_BIT;
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, cr)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, cr|
-                                    Flash.FLASH_CR_STRT_BIT)
-        # max 22.1 sec on STM32L4R (two banks)
-        self.wait_busy(25, 'Erasing FLASH')
-
-    def erase_page(self, page):
-        self._dbg.debug('erase_page %d' % page)
-        self.clear_sr()
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REG, cr)
+            tr.set_debugreg32(Flash.FLASH_CR_REG, cr |
+                              Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(Flash.MASS_ERASE_TIME, 'Erasing FLASH', key=lib.stm32timing.FlashTiming.MASS_ERASE_KEY)
+
+    @lib.stlinkstats.operation
+    def erase_page(self, page, bank=0):
+        self._dbg.debug('erase_page %d in bank %d', page, bank)
         flash_cr_value = Flash.FLASH_CR_PER_BIT
         flash_cr_value |= (page << Flash.FLASH_CR_PNB_BITINDEX)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value |
-                                    Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(0.05)
+        if bank:
+            flash_cr_value |= Flash.FLASH_CR_BKER_BIT
+        with self.clear_sr() as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value)
+            tr.set_debugreg32(Flash.FLASH_CR_REG, flash_cr_value |
+                              Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(Flash.PAGE_ERASE_TIME, key=lib.stm32timing.FlashTiming.erase_key(self._page_size))
 
+    @lib.stlinkstats.operation
     def erase_bank(self, bank):
-        self._dbg.debug('erase_bank %d' % bank)
-        self.clear_sr()
+        self._dbg.debug('erase_bank %d', bank)
         cr =  Flash.FLASH_CR_MER1_BIT;
         if bank == 1:
             cr =  Flash.FLASH_CR_MER2_BIT
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, cr)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, cr|
-                                    Flash.FLASH_CR_STRT_BIT)
-        self.wait_busy(0.05)
+        with self.clear_sr() as tr:
+            tr.set_debugreg32(Flash.FLASH_CR_REG, cr)
+            tr.set_debugreg32(Flash.FLASH_CR_REG, cr |
+                              Flash.FLASH_CR_STRT_BIT)
+        self.wait_busy(Flash.BANK_ERASE_TIME, key=lib.stm32timing.FlashTiming.BANK_ERASE_KEY)
 
-    def erase_pages(self, addr, size):
+    @lib.stlinkstats.operation
+    def erase_pages(self, geometry, addr, size):
         self._dbg.verbose('erase_pages from addr %08x for %d byte' %
                           (addr, size))
-        page =      (addr - lib.stm32.Stm32.FLASH_START       ) // self._page_size
-        last_page = (addr - lib.stm32.Stm32.FLASH_START + size + self._page_size - 1) // self._page_size
-        self._dbg.verbose('erase_pages %d to %d' % (page, last_page))
-        self._dbg.bargraph_start('Erasing FLASH', value_min=page,
-                                 value_max=last_page)
-        if page == 0 and last_page >= 256:
-            self.erase_bank(0);
-            page = 256
-            self._dbg.bargraph_update(value=page)
-        while page < last_page:
-            if page == 256 and last_page >= 512:
-                self.erase_bank(1);
-                page = 512
-                self._dbg.bargraph_update(value=page)
-                break
-            self.erase_page(page)
-            page += 1
-            self._dbg.bargraph_update(value=page)
-        self._dbg.bargraph_done()
+        indexes = geometry.indexes(addr, size)
+        if len(indexes) == len(geometry):
+            # whole FLASH is erased at once, both banks if they are enabled
+            self.erase_all()
+        else:
+            self._dbg.bargraph_start('Erasing FLASH', value_min=addr, value_max=addr + size)
+            index = indexes.start
+            while index < indexes.stop:
+                bank, page = geometry.bank_sector(index)
+                bank_pages = geometry.bank_sectors(bank)
+                # whole bank is erased at once
+                if page == 0 and indexes.stop >= bank_pages.stop:
+                    self.erase_bank(bank)
+                    index = bank_pages.stop
+                else:
+                    self.erase_page(page, bank)
+                    index += 1
+                self._dbg.bargraph_update(value=sum(geometry.sector(index - 1)))
+            self._dbg.bargraph_done()
         self._stlink.set_debugreg32(Flash.FLASH_CR_REG, 0)
 
-    def wait_busy(self, wait_time, bargraph_msg=None, check_eop=False):
-        end_time = time.time() + wait_time * 1.5
+    @lib.stlinkstats.operation
+    def wait_busy(self, wait_time, bargraph_msg=None, check_eop=False, key=None):
+        wait = self._driver.flash_busy_wait(wait_time, wait_time * 1.5, key=key)
         if bargraph_msg:
-            self._dbg.bargraph_start(bargraph_msg, value_min=time.time(),
-                                     value_max=time.time() + wait_time)
-        while time.time() < end_time:
+            self._dbg.bargraph_start(bargraph_msg, value_min=wait.start_time,
+                                     value_max=wait.start_time + wait.expected)
+        while True:
             if bargraph_msg:
                 self._dbg.bargraph_update(value=time.time())
             status = self._stlink.get_debugreg32(Flash.FLASH_SR_REG)
             if not status & (Flash.FLASH_SR_BUSY_BIT |
                              Flash.FLASH_SR_CFGBSY_BIT |
                              (check_eop & Flash.FLASH_SR_EOP_BIT)) :
+                wait.done()
                 self.end_of_operation(status)
                 if bargraph_msg:
                     self._dbg.bargraph_done()
                 return
-            time.sleep(wait_time / 20)
-        raise lib.stlinkex.StlinkException('Operation timeout')
+            if wait.timeout():
+                raise lib.stlinkex.StlinkException('Operation timeout')
+            wait.sleep()
 
     def end_of_operation(self, status):
         if status & Flash.FLASH_SR_ERROR_MASK:
@@ -171,45 +229,57 @@ class Flash():
 
 # support all STM32L4 and G0 MCUs with page size access to FLASH
 class Stm32L4(lib.stm32.Stm32):
+    FLASH_UNIT = 8
+
+    def _flash_erase_sizes(self, erase_sizes):
+        # page size depends on bank configuration, FLASH is not unlocked
+        return (Flash.read_page_size(self._stlink), )
+
+    def _flash_bank_size(self, flash_size):
+        # bank configuration is read without unlocking FLASH
+        return Flash.read_bank_size(self._stlink, flash_size)
+
+    def _flash_timing(self):
+        return lib.stm32timing.FlashTiming(
+            self._busy_poller, Flash.PAGE_ERASE_TIME, Flash.MASS_ERASE_TIME,
+            Flash.PROGRAM_TIME, bank_erase_time=Flash.BANK_ERASE_TIME)
+
+    @lib.stlinkstats.operation
     def flash_erase_all(self, flash_size):
         self._dbg.debug('Stm32L4.flash_erase_all()')
-        flash = Flash(self, self._stlink, self._dbg)
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         flash.erase_all()
-        flash.lock()
+        self._flash_close(flash)
 
+    @lib.stlinkstats.operation
     def flash_write(self, addr, data, erase=False, erase_sizes=None):
         if addr is None:
             addr = self.FLASH_START
         self._dbg.debug(
-            'Stm32l4.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)'
-            % (addr, len(data), erase, erase_sizes))
+            'Stm32l4.flash_write(%s, [data:%dBytes], erase=%s, erase_sizes=%s)',
+            addr, len(data), erase, erase_sizes)
         if addr % 8:
             raise lib.stlinkex.StlinkException('Start address is not aligned to word')
         # pad data
-        if len(data) % 8:
-            data.extend([0xff] * (8 - len(data) % 8))
-        flash = Flash(self, self._stlink, self._dbg)
-        flash.unlock()
+        flash = self._flash_open(0, lambda: Flash(self, self._stlink, self._dbg))
         if erase:
             if erase_sizes:
-                flash.erase_pages(addr, len(data))
+                flash.erase_pages(self.flash_geometry(erase_sizes), addr, len(data))
             else:
                 flash.erase_all()
             flash.unlock()
         self._dbg.bargraph_start('Writing FLASH', value_min=addr, value_max=addr + len(data))
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, 0)
-        self._stlink.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PG_BIT)
-        cr =  self._stlink.get_debugreg32(Flash.FLASH_CR_REG)
+        tr = self._stlink.transaction()
+        tr.set_debugreg32(Flash.FLASH_CR_REG, 0)
+        tr.set_debugreg32(Flash.FLASH_CR_REG, Flash.FLASH_CR_PG_BIT)
+        tr.get_debugreg32(Flash.FLASH_CR_REG)
+        cr, = tr.flush()
         if not cr & Flash.FLASH_CR_PG_BIT:
             raise lib.stlinkex.StlinkException('Flash_Cr not ready for programming: %08x\n' % cr)
-        while data:
-            block = data[:256]
-            data = data[256:]
-            self._dbg.debug('Stm32l4.flash_write len %s addr %x' % (len(block), addr))
-            if min(block) != 0xff:
-                self._stlink.set_mem32(addr, block)
-            addr += len(block)
-            self._dbg.bargraph_update(value=addr)
+        for offset, block in lib.stm32plan.program_chunks(data, self._stlink.maximum_transfer_size, Stm32L4.FLASH_UNIT):
+            self._dbg.debug('Stm32l4.flash_write len %s addr %x', len(block), addr + offset)
+            self._stlink.set_mem32(addr + offset, block)
+            self._dbg.bargraph_update(value=addr + offset + len(block))
         flash.wait_busy(0.001)
         self._dbg.bargraph_done()
-        flash.lock()
+        self._flash_close(flash)
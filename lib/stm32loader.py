@@ -0,0 +1,291 @@
+import struct
+import time
+import lib.stm32
+import lib.stlinkex
+import lib.stlinkstats
+import lib.stm32plan
+
+
+# Routines running on target from SRAM
+#
+# routine is loaded to start of SRAM as list of Thumb half-words, arguments
+# are passed in registers R0, R1, ... and routine ends on BKPT, core must be
+# halted before routine is started. Routine can save SRAM it uses and core
+# registers and restore() returns them, otherwise content of start of SRAM is
+# lost. Vector table and interrupts of application stay enabled when core is
+# only halted, so routine runs with interrupts masked (DHCSR C_MASKINTS) and
+# mask is removed by stop when routine ends or fails
+
+
+class SramRoutine():
+    # start of SRAM, lib.stm32 imports this module so it is not used here
+    CODE_ADDR = 0x20000000
+    CODE_SIZE = 0x100
+    # SRAM size in KB if it was not detected, smallest of all STM32
+    DEFAULT_SRAM_SIZE = 4
+    # time for starting routine and polling
+    MIN_WAIT_TIME = 0.05
+
+    PSR_THUMB_BIT = 0x01000000
+    # registers changed by routines
+    SAVED_REGISTERS = ['R0', 'R1', 'R2', 'R3', 'R4', 'R5', 'R6', 'R7', 'PC', 'PSR']
+
+    def __init__(self, driver, stlink, dbg, code, saved_size=0):
+        # saved_size Bytes from start of SRAM and registers are saved
+        self._driver = driver
+        self._stlink = stlink
+        self._dbg = dbg
+        code = struct.pack('<%dH' % len(code), *code)
+        if len(code) > SramRoutine.CODE_SIZE:
+            raise lib.stlinkex.StlinkException('SRAM routine is too big: %d Bytes' % len(code))
+        code += bytes(-len(code) % 4)
+        self._saved = None
+        if saved_size:
+            indexes = [lib.stm32.Stm32.REGISTERS.index(reg) for reg in SramRoutine.SAVED_REGISTERS]
+            regs = list(zip(indexes, self._stlink.get_regs(indexes)))
+            self._saved = (regs, self.get_mem(SramRoutine.CODE_ADDR, saved_size))
+        self._stlink.set_mem32(SramRoutine.CODE_ADDR, code)
+
+    def set_mem(self, addr, data):
+        # queued transfers, Stm32.set_mem would disturb bargraph of caller
+        view = memoryview(data)
+        block_size = self._stlink.maximum_transfer_size
+        for offset in range(0, len(data), block_size):
+            self._stlink.set_mem32(addr + offset, view[offset:offset + block_size], wait=False)
+
+    def get_mem(self, addr, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        block_size = self._stlink.maximum_transfer_size
+        for offset in range(0, size, block_size):
+            self._stlink.get_mem32(addr + offset, min(block_size, size - offset), view[offset:offset + block_size], wait=False)
+        self._stlink.sync()
+        return data
+
+    def run(self, *args):
+        # arguments are passed in R0, R1, ..., registers are also queued
+        regs = list(enumerate(args))
+        regs.append((lib.stm32.Stm32.REGISTERS.index('PC'), SramRoutine.CODE_ADDR))
+        regs.append((lib.stm32.Stm32.REGISTERS.index('PSR'), SramRoutine.PSR_THUMB_BIT))
+        for index, value in regs:
+            self._stlink.set_reg(index, value, wait=False)
+        self._driver.core_run_masked()
+
+    def stop(self):
+        # halt stuck routine and remove mask of interrupts
+        self._driver.core_halt_unmasked()
+
+    def restore(self):
+        # saved SRAM and registers are written back
+        if self._saved is None:
+            return
+        regs, data = self._saved
+        self.set_mem(SramRoutine.CODE_ADDR, data)
+        for index, value in regs:
+            self._stlink.set_reg(index, value, wait=False)
+        self._stlink.sync()
+        self._driver.invalidate_reg_cache()
+        self._saved = None
+
+
+# FLASH programming by routine running on target from SRAM
+#
+# two buffers follow routine, each buffer starts with descriptor (destination
+# address and count of units) followed by data. Routine is started with R0
+# address of FLASH status register and R1, R2 addresses of both buffers, it
+# waits until count in descriptor is not zero, programs buffer, clears count
+# and continues with other buffer. While target programs one buffer, host
+# loads the other one. Count LOADER_END stops routine on BKPT, on first error
+# it stops immediately.
+#
+# FLASH class provide routine in LOADER (list of Thumb half-words), size of
+# programmed unit in LOADER_UNIT and time for programming one unit in
+# LOADER_UNIT_TIME, FLASH must be unlocked and prepared for programming
+
+
+class FlashLoader(SramRoutine):
+    DESCRIPTOR = struct.Struct('<II')
+    LOADER_END = 0xffffffff
+    # bigger buffers only delay start of programming
+    MAX_BUFFER_SIZE = 16 * 1024
+    BUFFER_ALIGN = 256
+
+    def __init__(self, driver, stlink, dbg, flash, sram_size=None):
+        super().__init__(driver, stlink, dbg, flash.LOADER)
+        self._flash = flash
+        sram_size = (sram_size or FlashLoader.DEFAULT_SRAM_SIZE) * 1024
+        self._buffer_size = (sram_size - FlashLoader.CODE_SIZE) // 2 - FlashLoader.DESCRIPTOR.size
+        self._buffer_size -= self._buffer_size % FlashLoader.BUFFER_ALIGN
+        self._buffer_size = min(self._buffer_size, FlashLoader.MAX_BUFFER_SIZE)
+        self._buffers = [
+            FlashLoader.CODE_ADDR + FlashLoader.CODE_SIZE,
+            FlashLoader.CODE_ADDR + FlashLoader.CODE_SIZE + FlashLoader.DESCRIPTOR.size + self._buffer_size,
+        ]
+        self._dbg.debug('FlashLoader: buffers 2 x %d Bytes', self._buffer_size)
+        for buffer in self._buffers:
+            self._stlink.set_mem32(buffer, FlashLoader.DESCRIPTOR.pack(0, 0))
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    def load_buffer(self, addr, data):
+        # buffer is loaded by queued transfers, they are waited by next command
+        self.set_mem(addr, bytes(data) + bytes((0xff, )) * (-len(data) % 4))
+
+    def _wait_time(self, count):
+        # time is from data sheet, will be more safe to wait 2 time longer
+        return FlashLoader.MIN_WAIT_TIME + 2 * count * self._flash.LOADER_UNIT_TIME
+
+    @lib.stlinkstats.operation
+    def wait_buffer(self, buffer, count):
+        # wait until routine clears count of previously loaded buffer
+        wait_time = self._wait_time(count)
+        end_time = time.time() + wait_time
+        while True:
+            tr = self._stlink.transaction()
+            tr.get_debugreg32(buffer + 4)
+            tr.get_debugreg32(lib.stm32.Stm32.DHCSR_REG)
+            count, dhcsr = tr.flush()
+            if not count:
+                return
+            if dhcsr & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+                # routine stopped on error
+                self._flash.wait_for_breakpoint(wait_time)
+                raise lib.stlinkex.StlinkException('FLASH loader stopped at 0x%08x' % self._stlink.get_debugreg32(buffer))
+            if time.time() > end_time:
+                raise lib.stlinkex.StlinkException('FLASH loader timeout')
+            time.sleep(wait_time / 20)
+
+    @lib.stlinkstats.operation
+    def write(self, flash_sr_reg, addr, data):
+        # data are padded to LOADER_UNIT
+        self._dbg.debug('FlashLoader.write(0x%08x, [data:%dBytes])', addr, len(data))
+        unit = self._flash.LOADER_UNIT
+        # count of units loaded in each buffer and not yet programmed
+        pending = [0, 0]
+        buffer = 0
+        running = False
+        try:
+            # blank runs are not loaded at all
+            for offset, block in lib.stm32plan.program_chunks(data, self._buffer_size, unit):
+                if pending[buffer]:
+                    self.wait_buffer(self._buffers[buffer], pending[buffer])
+                pending[buffer] = len(block) // unit
+                self.load_buffer(self._buffers[buffer] + FlashLoader.DESCRIPTOR.size, block)
+                # descriptor is written after data and count after address
+                self._stlink.set_mem32(self._buffers[buffer], FlashLoader.DESCRIPTOR.pack(addr + offset, pending[buffer]), wait=False)
+                if not running:
+                    self.run(flash_sr_reg, self._buffers[0], self._buffers[1])
+                    running = True
+                buffer ^= 1
+                self._dbg.bargraph_update(value=addr + offset + len(block))
+            if not running:
+                return
+            if pending[buffer]:
+                self.wait_buffer(self._buffers[buffer], pending[buffer])
+            self._stlink.set_mem32(self._buffers[buffer], FlashLoader.DESCRIPTOR.pack(0, FlashLoader.LOADER_END))
+            self._flash.wait_for_breakpoint(self._wait_time(pending[buffer ^ 1]))
+        finally:
+            if running:
+                self.stop()
+
+
+# CRC32 of FLASH regions computed by routine running on target from SRAM
+#
+# CRC is same as in zlib, so host compute it from image and only digests are
+# transferred. Table follows routine and list of descriptors (address and
+# size of region) follows table. Routine is started with R0 address of first
+# descriptor, R1 count of descriptors and R2 address of table, it replaces
+# size in each descriptor by CRC of region and stops on BKPT.
+
+
+class Crc32Routine(SramRoutine):
+    CODE = [
+        0x25ff,  # 00:      movs r5, #0xff
+        0x2900,  # 02: next cmp r1, #0
+        0xd014,  # 04:      beq done
+        0x6806,  # 06:      ldr r6, [r0, #0]
+        0x6847,  # 08:      ldr r7, [r0, #4]
+        0x2300,  # 0a:      movs r3, #0
+        0x43db,  # 0c:      mvns r3, r3
+        0x2f00,  # 0e:      cmp r7, #0
+        0xd009,  # 10:      beq store
+        0x7834,  # 12: loop ldrb r4, [r6, #0]
+        0x405c,  # 14:      eors r4, r3
+        0x402c,  # 16:      ands r4, r5
+        0x00a4,  # 18:      lsls r4, r4, #2
+        0x5914,  # 1a:      ldr r4, [r2, r4]
+        0x0a1b,  # 1c:      lsrs r3, r3, #8
+        0x4063,  # 1e:      eors r3, r4
+        0x3601,  # 20:      adds r6, #1
+        0x3f01,  # 22:      subs r7, #1
+        0xd1f5,  # 24:      bne loop
+        0x43db,  # 26: store mvns r3, r3
+        0x6043,  # 28:      str r3, [r0, #4]
+        0x3008,  # 2a:      adds r0, #8
+        0x3901,  # 2c:      subs r1, #1
+        0xe7e8,  # 2e:      b next
+        0xbe00,  # 30: done bkpt
+    ]
+    POLYNOMIAL = 0xedb88320
+    TABLE_ADDR = SramRoutine.CODE_ADDR + SramRoutine.CODE_SIZE
+    DESCRIPTORS_ADDR = TABLE_ADDR + 256 * 4
+    DESCRIPTOR = struct.Struct('<II')
+    # time for one byte, core can run from slow reset clock (MSI on L0, L4),
+    # timeout only detects stuck routine, lockup is detected immediately
+    BYTE_TIME = 0.0001
+
+    def __init__(self, driver, stlink, dbg, sram_size=None, regions=None):
+        # SRAM used for count of regions (or whole SRAM) is saved
+        sram_size = (sram_size or Crc32Routine.DEFAULT_SRAM_SIZE) * 1024
+        self._max_regions = (Crc32Routine.CODE_ADDR + sram_size - Crc32Routine.DESCRIPTORS_ADDR) // Crc32Routine.DESCRIPTOR.size
+        if regions is not None:
+            regions = min(regions, self._max_regions)
+        else:
+            regions = self._max_regions
+        saved_size = Crc32Routine.DESCRIPTORS_ADDR - Crc32Routine.CODE_ADDR + regions * Crc32Routine.DESCRIPTOR.size
+        super().__init__(driver, stlink, dbg, Crc32Routine.CODE, saved_size=saved_size)
+        self.set_mem(Crc32Routine.TABLE_ADDR, Crc32Routine.table())
+
+    @staticmethod
+    def table():
+        table = []
+        for i in range(256):
+            crc = i
+            for _ in range(8):
+                crc = (crc >> 1) ^ (Crc32Routine.POLYNOMIAL if crc & 1 else 0)
+            table.append(crc)
+        return struct.pack('<256I', *table)
+
+    @lib.stlinkstats.operation
+    def wait_for_breakpoint(self, wait_time):
+        end_time = time.time() + wait_time
+        while True:
+            dhcsr = self._stlink.get_debugreg32(lib.stm32.Stm32.DHCSR_REG)
+            if dhcsr & lib.stm32.Stm32.DHCSR_STATUS_HALT_BIT:
+                return
+            if dhcsr & lib.stm32.Stm32.DHCSR_STATUS_LOCKUP_BIT:
+                raise lib.stlinkex.StlinkException('CRC routine fault')
+            if time.time() > end_time:
+                raise lib.stlinkex.StlinkException('CRC routine timeout')
+            time.sleep(min(wait_time / 20, 0.01))
+
+    @lib.stlinkstats.operation
+    def crc32(self, regions):
+        # list of (address, size) to list of CRC
+        self._dbg.debug('Crc32Routine.crc32([regions:%d])', len(regions))
+        crcs = []
+        for index in range(0, len(regions), self._max_regions):
+            batch = regions[index:index + self._max_regions]
+            descriptors = b''.join(Crc32Routine.DESCRIPTOR.pack(addr, size) for addr, size in batch)
+            self.set_mem(Crc32Routine.DESCRIPTORS_ADDR, descriptors)
+            self.run(Crc32Routine.DESCRIPTORS_ADDR, len(batch), Crc32Routine.TABLE_ADDR)
+            size = sum(size for addr, size in batch)
+            try:
+                self.wait_for_breakpoint(Crc32Routine.MIN_WAIT_TIME + size * Crc32Routine.BYTE_TIME)
+            finally:
+                self.stop()
+            descriptors = self.get_mem(Crc32Routine.DESCRIPTORS_ADDR, len(descriptors))
+            crcs.extend(crc for addr, crc in Crc32Routine.DESCRIPTOR.iter_unpack(bytes(descriptors)))
+        return crcs
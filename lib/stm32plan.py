@@ -0,0 +1,126 @@
+import re
+import lib.memimage
+
+
+# FLASH programming plan
+#
+# all segments of image are placed to sectors of FLASH, each sector is erased
+# only once and segments sharing a sector are programmed together. Program
+# stream is list of (address, data), when FLASH is erased, chunks cover whole
+# sectors and space between segments is padded by erased value, so erasing
+# sectors of chunk never destroys other chunk. Without known sectors or when
+# all sectors are erased, whole FLASH can be erased by mass erase.
+
+
+# skipped blank part must be longer than data transferred in time of one
+# more USB command
+BLANK_MIN_SIZE = 256
+
+
+def nonblank_runs(data, unit, erased=0xff, min_blank=BLANK_MIN_SIZE):
+    # list of (offset, size) of parts of data which are not erased, parts are
+    # aligned to programmed unit and shorter blank gaps are not skipped, size
+    # of data must be aligned to unit
+    blank = re.compile(b'%s{%d,}' % (re.escape(bytes((erased, ))), min_blank))
+    runs = []
+    start = 0
+    for match in blank.finditer(data):
+        blank_start = -(-match.start() // unit) * unit
+        blank_end = match.end() - match.end() % unit
+        if blank_end - blank_start < min_blank:
+            continue
+        if blank_start > start:
+            runs.append((start, blank_start - start))
+        start = blank_end
+    if start < len(data):
+        runs.append((start, len(data) - start))
+    return runs
+
+
+def pad(data, unit, erased=0xff):
+    # data with size aligned to unit, copied only if it is not aligned
+    if len(data) % unit:
+        return bytes(data) + bytes((erased, )) * (unit - len(data) % unit)
+    return data
+
+
+def chunks(data, chunk_size, start=0, end=None):
+    # iterator of (offset, memoryview) of data split to chunks of at most
+    # chunk_size, data are not copied
+    view = memoryview(data)
+    if end is None:
+        end = len(view)
+    for offset in range(start, end, chunk_size):
+        yield offset, view[offset:min(offset + chunk_size, end)]
+
+
+def program_chunks(data, chunk_size, unit, erased=0xff):
+    # iterator of (offset, memoryview) of parts of data to program, data are
+    # padded to unit, blank runs are skipped and chunks of at most chunk_size
+    # are aligned to unit
+    data = pad(data, unit, erased=erased)
+    chunk_size -= chunk_size % unit
+    for run_offset, run_size in nonblank_runs(data, unit, erased=erased):
+        yield from chunks(data, chunk_size, run_offset, run_offset + run_size)
+
+
+def transfer_size(data, unit, erased=0xff):
+    # count of Bytes transferred by program_chunks, blank runs are skipped
+    data = pad(data, unit, erased=erased)
+    return sum(run_size for run_offset, run_size in nonblank_runs(data, unit, erased=erased))
+
+
+class FlashPlan():
+    def __init__(self, segments, geometry, erased=0xff, erase=True, unit=4):
+        # segments are lib.memimage.MemoryImage or list of (address, data),
+        # geometry (lib.stm32geometry.FlashGeometry) is needed only for erase,
+        # unit is programmed by driver
+        self.geometry = geometry
+        self.erased = erased
+        self.unit = unit
+        self.mass_erase = False
+        if not isinstance(segments, lib.memimage.MemoryImage):
+            segments = lib.memimage.MemoryImage(segments)
+        self.image = segments
+        if erase and geometry is None:
+            # sector sizes are not known, FLASH can be only mass erased
+            self.mass_erase = True
+            self.erase = []
+            self.program = list(segments)
+        elif erase:
+            self.erase = self._sectors(segments, geometry)
+            # chunks cover whole sectors
+            self.program = list(segments.align(geometry, erased))
+        else:
+            self.erase = []
+            self.program = list(segments)
+
+    @staticmethod
+    def _sectors(segments, geometry):
+        sectors = []
+        for addr, data in segments:
+            for sector in geometry.sectors(addr, len(data)):
+                if not sectors or sectors[-1][0] < sector[0]:
+                    sectors.append(sector)
+        return sectors
+
+    def erases_all(self):
+        # all sectors of FLASH are erased
+        return self.geometry is not None and len(self.erase) == len(self.geometry)
+
+    def set_mass_erase(self):
+        self.mass_erase = True
+        self.erase = []
+
+    @property
+    def erase_sizes(self):
+        return self.geometry.erase_sizes if self.geometry else None
+
+    @property
+    def size(self):
+        return sum(len(data) for addr, data in self.program)
+
+    @property
+    def transfer_size(self):
+        # chunks are padded by erased sectors, their blank runs are skipped
+        return sum(transfer_size(data, self.unit, erased=self.erased) for addr, data in self.program)
@@ -0,0 +1,105 @@
+import json
+import time
+
+
+# Adaptive polling of FLASH operations
+#
+# expected duration of operation is time from data sheet until operation is
+# observed, then it is learned from measured durations. Status register is
+# polled sparsely far from expected end, tightly near it and interval grows
+# again when operation takes longer. Timeout is still given by data sheet.
+# Only operations with named key are learned, unrelated operations can have
+# same time in data sheet, so waits without key are polled at MIN_INTERVAL.
+# Learned durations can be stored to JSON file by device type.
+
+
+class BusyPoller():
+    # one poll is one USB command
+    MIN_INTERVAL = 0.001
+    # also maximal delay after end of operation
+    MAX_INTERVAL = 0.05
+    # weight of new measurement in learned duration
+    LEARN_WEIGHT = 0.25
+
+    def __init__(self):
+        self._durations = {}
+        # total time spent by operations, by key
+        self._spent = {}
+
+    def expected(self, key, wait_time):
+        return self._durations.get(key, wait_time)
+
+    def learned(self, key):
+        return self._durations.get(key)
+
+    def learn(self, key, duration):
+        learned = self._durations.get(key)
+        if learned is not None:
+            duration = learned + (duration - learned) * BusyPoller.LEARN_WEIGHT
+        self._durations[key] = duration
+
+    def done(self, key, duration):
+        self.learn(key, duration)
+        self._spent[key] = self._spent.get(key, 0) + duration
+
+    def spent(self, prefix):
+        # total time of operations with named key starting with prefix
+        return sum(spent for key, spent in self._spent.items() if isinstance(key, str) and key.startswith(prefix))
+
+    def load(self, filename, device):
+        try:
+            with open(filename) as f:
+                durations = json.load(f)
+        except FileNotFoundError:
+            return
+        self._durations.update(durations.get(device, {}))
+
+    def save(self, filename, device):
+        try:
+            with open(filename) as f:
+                durations = json.load(f)
+        except FileNotFoundError:
+            durations = {}
+        durations[device] = {key: duration for key, duration in self._durations.items() if isinstance(key, str)}
+        with open(filename, 'w') as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+
+    @staticmethod
+    def interval(expected, elapsed):
+        # half of time to expected end, after it quarter of overrun
+        if elapsed < expected:
+            interval = (expected - elapsed) / 2
+        else:
+            interval = (elapsed - expected) / 4
+        return min(max(interval, BusyPoller.MIN_INTERVAL), BusyPoller.MAX_INTERVAL)
+
+    def wait(self, wait_time, timeout, key=None):
+        return BusyWait(self, key, wait_time, timeout)
+
+
+class BusyWait():
+    def __init__(self, poller, key, wait_time, timeout):
+        self._poller = poller
+        self._key = key
+        self.expected = wait_time if key is None else poller.expected(key, wait_time)
+        self.start_time = time.time()
+        self._end_time = self.start_time + timeout
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def timeout(self):
+        return time.time() > self._end_time
+
+    def sleep(self):
+        # status is polled once more at timeout
+        if self._key is None:
+            interval = BusyPoller.MIN_INTERVAL
+        else:
+            interval = BusyPoller.interval(self.expected, self.elapsed)
+        time.sleep(max(0, min(interval, self._end_time - time.time())))
+
+    def done(self):
+        if self._key is not None:
+            self._poller.done(self._key, self.elapsed)
@@ -0,0 +1,75 @@
+# Timing model of FLASH operations
+#
+# erase time of sector by its size, time of mass erase and time of writing
+# one Byte (programming and USB transfer). Defaults are times from data sheet
+# which drivers also use for waiting, measured times learned by BusyPoller
+# (under keys from this model) replace them, so estimate is better after
+# every run. Learned times can be stored in JSON file by device type.
+
+
+class FlashTiming():
+    # writing memory by ST-Link/V2 is about 256KB/s
+    TRANSFER_TIME = 1 / (256 * 1024)
+    MASS_ERASE_KEY = 'mass_erase'
+    # starts with 'erase', so it is counted as erase time
+    BANK_ERASE_KEY = 'erase_bank'
+    WRITE_KEY = 'write'
+
+    def __init__(self, poller, erase_time, mass_erase_time, program_time, erase_times=None, mass_erases=1, transfer_time=TRANSFER_TIME, bank_erase_time=None):
+        # erase_time is for all sector sizes not in erase_times (by size in
+        # Bytes), mass erase is repeated mass_erases times (for each bank),
+        # program_time and transfer_time are per Byte, bank_erase_time is
+        # only for drivers which erase whole bank at once
+        self._poller = poller
+        self._erase_time = erase_time
+        self._erase_times = erase_times or {}
+        self._mass_erase_time = mass_erase_time
+        self._mass_erases = mass_erases
+        self._write_time = program_time + transfer_time
+        self._bank_erase_time = bank_erase_time
+
+    @staticmethod
+    def erase_key(size):
+        return 'erase_%d' % size
+
+    def _time(self, key, default):
+        learned = self._poller.learned(key)
+        return default if learned is None else learned
+
+    def erase_time(self, size):
+        return self._time(FlashTiming.erase_key(size), self._erase_times.get(size, self._erase_time))
+
+    def mass_erase_time(self):
+        return self._time(FlashTiming.MASS_ERASE_KEY, self._mass_erase_time) * self._mass_erases
+
+    def bank_erase_time(self):
+        return self._time(FlashTiming.BANK_ERASE_KEY, self._bank_erase_time)
+
+    def sectors_erase_time(self, sectors, geometry=None):
+        # sectors are list of (address, size), all sectors of bank of geometry
+        # are erased at once if driver has bank erase
+        erase_time = 0
+        if self._bank_erase_time is not None and geometry is not None:
+            sectors = set(sectors)
+            for bank in range(len(geometry.banks)):
+                bank_sectors = [geometry.sector(index) for index in geometry.bank_sectors(bank)]
+                if sectors.issuperset(bank_sectors):
+                    sectors.difference_update(bank_sectors)
+                    erase_time += self.bank_erase_time()
+        return erase_time + sum(self.erase_time(size) for addr, size in sectors)
+
+    def write_time(self, size):
+        return size * self._time(FlashTiming.WRITE_KEY, self._write_time)
+
+    def learn_write(self, size, duration):
+        if size:
+            self._poller.learn(FlashTiming.WRITE_KEY, duration / size)
+
+    def estimate(self, plan):
+        # dictionary of times in seconds for FlashPlan
+        if plan.mass_erase:
+            erase = self.mass_erase_time()
+        else:
+            erase = self.sectors_erase_time(plan.erase, plan.geometry)
+        write = self.write_time(plan.transfer_size)
+        return {'erase': erase, 'write': write, 'total': erase + write}
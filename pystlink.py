@@ -2,6 +2,9 @@ import sys
 import argparse
 import time
 import lib.stlinkusb
+import lib.stlinksim
+import lib.stlinktrace
+import lib.stlinkstats
 import lib.stlinkv2
 import lib.stm32
 import lib.stm32fp
@@ -12,6 +15,7 @@ import lib.stm32h7
 import lib.stm32devices
 import lib.stlinkex
 import lib.dbg
+import lib.memimage
 import lib.srec
 
 VERSION_STR = "pystlink v0.0.0 (ST-LinkV2)"
@@ -23,7 +27,7 @@ https://github.com/pavelrevak/pystlink
 
 ACTIONS_HELP_STR = """
 list of available actions:
-  dump:core              print all core registers (halt core)
+  dump:core              print all core and FPU registers (halt core)
   dump:{reg}             print core register (halt core)
   dump:{addr}:{size}     print content of memory
   dump:sram[:{size}]     print content of SRAM memory
@@ -51,6 +55,10 @@ list of available actions:
   flash[:erase][:verify][:{addr}]:{file} erase + flash binary file + verify
   flash:check:{file.srec}     verify flash against SREC file
   flash:check[:{addr}]:{file} verify flash {at addr} against binary file
+  flash:delta[:verify]:{file.srec}     flash only sectors different from SREC file
+  flash:delta[:verify][:{addr}]:{file} flash only sectors different from binary file
+  flash:plan[:erase]:{file.srec}       print plan and estimated time, FLASH is not changed
+  flash:plan[:erase][:{addr}]:{file}   print plan and estimated time for binary file
 
   reset                  reset core
   reset:halt             reset and halt core
@@ -85,6 +93,13 @@ class PyStlink():
         self._connector = None
         self._stlink = None
         self._driver = None
+        self._sim = None
+        self._swd_frequency = 4000000
+        self._record = None
+        self._replay = None
+        self._replay_scale = None
+        self._stats = False
+        self._timings = None
 
     def find_mcus_by_core(self):
         if (self._hard):
@@ -179,25 +194,34 @@ class PyStlink():
     def load_driver(self):
         flash_driver = self._mcus_by_devid['flash_driver']
         if flash_driver == 'STM32FP':
-            self._driver = lib.stm32fp.Stm32FP(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32fp.Stm32FP(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         elif flash_driver == 'STM32FPXL':
-            self._driver = lib.stm32fp.Stm32FPXL(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32fp.Stm32FPXL(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         elif flash_driver == 'STM32FS':
-            self._driver = lib.stm32fs.Stm32FS(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32fs.Stm32FS(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         elif flash_driver == 'STM32L0':
-            self._driver = lib.stm32l0.Stm32L0(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32l0.Stm32L0(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         elif flash_driver == 'STM32L4':
-            self._driver = lib.stm32l4.Stm32L4(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32l4.Stm32L4(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         elif flash_driver == 'STM32H7':
-            self._driver = lib.stm32h7.Stm32H7(self._stlink, dbg=self._dbg)
+            self._driver = lib.stm32h7.Stm32H7(self._stlink, dbg=self._dbg, sram_size=self._sram_size, flash_size=self._flash_size)
         else:
             self._driver = self._core
 
     def detect_cpu(self, expected_cpus, unmount=False):
-        self._connector = lib.stlinkusb.StlinkUsbConnector(dbg=self._dbg, serial=self._serial, index = self._index)
+        if self._replay:
+            self._connector = lib.stlinktrace.StlinkTraceReplayConnector(self._replay, dbg=self._dbg, time_scale=self._replay_scale)
+        elif self._sim:
+            self._connector = lib.stlinksim.StlinkSimConnector(dbg=self._dbg, cpu_type=self.fix_cpu_type(self._sim))
+        else:
+            self._connector = lib.stlinkusb.StlinkUsbConnector(dbg=self._dbg, serial=self._serial, index = self._index)
+        if self._record:
+            self._connector = lib.stlinktrace.StlinkTraceRecorder(self._connector, self._record)
+        if self._stats:
+            self._connector = lib.stlinkstats.StlinkStatsConnector(self._connector)
         if unmount:
             self._connector.unmount_discovery()
-        self._stlink = lib.stlinkv2.Stlink(self._connector, dbg=self._dbg)
+        self._stlink = lib.stlinkv2.Stlink(self._connector, dbg=self._dbg, swd_frequency=self._swd_frequency)
         self._dbg.info("DEVICE: ST-Link/%s" % self._stlink.ver_str)
         self._dbg.info("SUPPLY: %.2fV" % self._stlink.target_voltage)
         self._dbg.verbose("COREID: %08x" % self._stlink.coreid)
@@ -216,6 +240,9 @@ class PyStlink():
         self.find_sram_eeprom_size()
         self.load_driver()
 
+    def device_type(self):
+        return '/'.join([mcu['type'] for mcu in self._mcus])
+
     def print_buffer(self, addr, data, bytes_per_line=16):
         prev_chunk = []
         same_chunk = False
@@ -238,21 +265,26 @@ class PyStlink():
 
     def store_file(self, addr, data, filename):
         with open(filename, 'wb') as f:
-            f.write(bytes(data))
+            f.write(data)
             self._dbg.info("Saved %d Bytes into %s file" % (len(data), filename))
 
-    def read_file(self, filename):
+    def read_file(self, filename, addr=None):
+        # lib.memimage.MemoryImage, binary file is placed to addr
+        image = lib.memimage.MemoryImage()
         if filename.endswith('.srec'):
+            if addr is not None:
+                raise lib.stlinkex.StlinkException('Address for write is set by file')
             srec = lib.srec.Srec()
             srec.encode_file(filename)
-            size = sum([len(i[1]) for i in srec.buffers])
-            self._dbg.info("Loaded %d Bytes from %s file" % (size, filename))
-            return srec.buffers
-        with open(filename, 'rb') as f:
-            data = list(f.read())
-            self._dbg.info("Loaded %d Bytes from %s file" % (len(data), filename))
-            return [(None, data)]
-        raise lib.stlinkex.StlinkException("Error reading file")
+            for buffer_addr, data in srec.buffers:
+                image.merge(buffer_addr, data)
+        else:
+            if addr is None:
+                raise lib.stlinkex.StlinkExceptionBadParam('Address is not set')
+            with open(filename, 'rb') as f:
+                image.merge(addr, f.read())
+        self._dbg.info("Loaded %d Bytes from %s file" % (image.size, filename))
+        return image
 
     def dump_mem(self, addr, size):
         print("08x %d" % addr, size)
@@ -337,32 +369,34 @@ class PyStlink():
             raise lib.stlinkex.StlinkExceptionBadParam()
 
     def cmd_write(self, params):
-        mem = self.read_file(params[-1])
-        params = params[:-1]
-        if len(mem) == 1 and mem[0][0] is None:
-            data = mem[0][1]
-            if len(params) != 1:
-                raise lib.stlinkex.StlinkExceptionBadParam('Address is not set')
+        addr = None
+        if len(params) > 2:
+            raise lib.stlinkex.StlinkExceptionBadParam()
+        if len(params) == 2:
             if params[0] == 'sram':
                 addr = self._driver.SRAM_START
-                if len(data) > self._sram_size * 1024:
-                    raise lib.stlinkex.StlinkExceptionBadParam('Data are bigger than SRAM')
             else:
                 addr = int(params[0], 0)
-            self._driver.set_mem(addr, data)
-            return
-        if params:
-            raise lib.stlinkex.StlinkException('Address for write is set by file')
-        for addr, data in mem:
+        image = self.read_file(params[-1], addr)
+        if len(params) == 2 and params[0] == 'sram' and image.size > self._sram_size * 1024:
+            raise lib.stlinkex.StlinkExceptionBadParam('Data are bigger than SRAM')
+        for addr, data in image:
             self._driver.set_mem(addr, data)
 
     def cmd_flash(self, params):
         erase = False
         verify = False
         write = True
-        if params[0] == 'erase':
+        delta = False
+        plan = False
+        if params[0] == 'plan':
+            plan = True
             params = params[1:]
             if not params:
+                raise lib.stlinkex.StlinkExceptionBadParam('Missing argument')
+        if params[0] == 'erase':
+            params = params[1:]
+            if not params and not plan:
                 self._flash_size = self._stlink.get_debugreg16(self._mcus_by_devid['flash_size_reg'])
                 self._driver.flash_erase_all(self._flash_size)
                 return
@@ -371,29 +405,53 @@ class PyStlink():
             write = False
             verify = True
             params = params[1:]
-        mem = self.read_file(params[-1])
+        elif params[0] == 'delta':
+            delta = True
+            params = params[1:]
+        if not params:
+            raise lib.stlinkex.StlinkExceptionBadParam('Missing argument')
+        filename = params[-1]
         params = params[:-1]
         if params and params[0] == 'verify':
             verify = True
             params = params[1:]
-        start_addr = lib.stm32.Stm32.FLASH_START
-        if len(mem) == 1 and mem[0][0] is None:
-            if params:
-                start_addr = int(params[0], 0)
-                params = params[1:]
+        addr = None
+        if params:
+            addr = int(params[0], 0)
+            params = params[1:]
         if params:
             raise lib.stlinkex.StlinkExceptionBadParam('Address for write is set by file')
-        for addr, data in mem:
-            if addr is None:
-                addr = start_addr
-            if write:
-                self._driver.flash_write(addr, data, erase=erase, erase_sizes=self._mcus_by_devid['erase_sizes'])
-                self._driver.core_reset_halt()
-                time.sleep(0.1)
+        if addr is None and not filename.endswith('.srec'):
+            addr = lib.stm32.Stm32.FLASH_START
+        segments = self.read_file(filename, addr)
+        erase_sizes = self._mcus_by_devid['erase_sizes']
+        if plan:
+            self.print_flash_plan(self._driver.flash_plan(segments, erase=erase, erase_sizes=erase_sizes))
+            return
+        # FLASH is unlocked once for all segments, core is reset at the end
+        self._driver.core_halt()
+        with self._driver.flash_session() as session:
+            if delta:
+                for addr, data in segments:
+                    session.delta(addr, data, erase_sizes=erase_sizes)
+            elif write:
+                # segments sharing sector are erased and programmed together
+                session.program(segments, erase=erase, erase_sizes=erase_sizes)
             if verify:
-                self._driver.core_halt()
-                self._driver.flash_verify(addr, data)
+                for addr, data in segments:
+                    session.verify(addr, data, erase_sizes=erase_sizes)
         self._driver.core_run()
+
+    def print_flash_plan(self, plan):
+        estimate = self._driver.flash_estimate(plan)
+        if plan.mass_erase:
+            erase = 'mass erase'
+        else:
+            erase = '%d sectors, %d Bytes' % (len(plan.erase), sum(size for addr, size in plan.erase))
+        print('  erase:   %-28s %7.2fs' % (erase, estimate['erase']))
+        print('  program: %-28s %7.2fs' % ('%d chunks, %d Bytes' % (len(plan.program), plan.size), estimate['write']))
+        print('  total:   %-28s %7.2fs' % ('', estimate['total']))
+
     def cmd(self, param):
         cmd = param[0]
         params = param[1:]
@@ -451,6 +509,13 @@ class PyStlink():
         parser.add_argument('-s', '--serial', dest='serial', help='Use Stlink with given serial number')
         parser.add_argument('-n', '--num-index', type=int, dest='index', default=0, help='Use Stlink with given index')
         parser.add_argument('-H', '--hard', action='store_true', help='Reset device with NRST')
+        parser.add_argument('-F', '--swd-freq', dest='swd_freq', default=4000000, type=lambda freq: freq if freq == lib.stlinkv2.Stlink.SWD_FREQ_AUTO else int(freq, 0), help='SWD frequency in Hz or "auto" to select fastest reliable frequency (default 4000000)')
+        parser.add_argument('--sim', metavar='CPU', help='use simulated ST-Link with given CPU type instead of USB device [eg: STM32F407xG]')
+        parser.add_argument('--record', metavar='FILE', help='record all transfers to ST-Link into trace file')
+        parser.add_argument('--replay', metavar='FILE', help='replay recorded trace file instead of USB device')
+        parser.add_argument('--stats', action='store_true', help='print statistics of ST-Link commands and operations at end')
+        parser.add_argument('--replay-scale', metavar='SCALE', type=float, help='replay with recorded timing multiplied by SCALE (default is without delays)')
+        parser.add_argument('--timings', metavar='FILE', help='load and store learned FLASH timings of device type in JSON file')
         group_actions = parser.add_argument_group(title='actions')
         group_actions.add_argument('action', nargs='*', help='actions will be processed sequentially')
         args = parser.parse_args()
@@ -458,11 +523,20 @@ class PyStlink():
         self._serial = args.serial
         self._index = args.index
         self._hard = args.hard
+        self._sim = args.sim
+        self._swd_frequency = args.swd_freq
+        self._record = args.record
+        self._replay = args.replay
+        self._replay_scale = args.replay_scale
+        self._stats = args.stats
+        self._timings = args.timings
         runtime_status = 0
         try:
             self.detect_cpu(args.cpu, not args.no_unmount)
             if args.action and self._driver is None:
                 raise lib.stlinkex.StlinkExceptionCpuNotSelected()
+            if self._timings:
+                self._driver.load_flash_timings(self._timings, self.device_type())
             for action in args.action:
                 self._dbg.verbose('CMD: %s' % action)
                 try:
@@ -478,11 +552,14 @@ class PyStlink():
         except (ValueError, OverflowError, FileNotFoundError, Exception) as e:
             self._dbg.error('Parameter error: %s' % e)
             if args.verbosity >= 3:
+                self._dbg.dump_trace()
                 raise e
             runtime_status = 1
         if self._stlink:
             try:
                 if self._driver:
+                    if self._timings:
+                        self._driver.save_flash_timings(self._timings, self.device_type())
                     if not args.no_run:
                         self._driver.core_nodebug()
                     else:
@@ -493,6 +570,12 @@ class PyStlink():
                 self._dbg.error(e)
                 runtime_status = 1
             self._dbg.verbose('DONE in %0.2fs' % (time.time() - self._start_time))
+            if self._stats:
+                for line in self._stlink.stats.report():
+                    self._dbg.message(line)
+        if self._record and self._connector:
+            self._connector.close()
+        self._dbg.dump_trace()
         if runtime_status:
             sys.exit(runtime_status)
 
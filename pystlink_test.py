@@ -1,15 +1,38 @@
+import binascii
+import os
+import tempfile
+import time
 import unittest
 
 import pystlink
 import lib.stm32
 import lib.stlinkex
+import lib.dbg
+import lib.stlinkusb
+import lib.stlinksim
+import lib.stlinktrace
+import lib.stlinkstats
+import lib.stlinkv2
+import lib.stm32fp
+import lib.stm32fs
+import lib.stm32l0
+import lib.stm32l4
+import lib.stm32h7
+import lib.stm32loader
+import lib.stm32geometry
+import lib.memimage
+import lib.stm32plan
+import lib.stm32poll
+import lib.stm32timing
 
 
 class MockDbg():
     def __init__(self):
         pass
 
-    def debug(self, msg, level=2):
+    debug_enabled = False
+
+    def debug(self, msg, *args, level=3):
         pass
         # print(msg)
 
@@ -34,6 +57,7 @@ class MockDbg():
         pass
 
 
+
 class TestStm32(unittest.TestCase):
     def setUp(self):
         self._pystlink = pystlink.PyStlink()
@@ -257,17 +281,19 @@ class TestStm32(unittest.TestCase):
 class TestStm32_get_mem(unittest.TestCase):
     def setUp(self):
         class MockStlink():
-            STLINK_MAXIMUM_TRANSFER_SIZE = 1024
+            maximum_transfer_size = 1024
+            transfer_policy = lib.stlinkusb.TransferPolicyDarwin()
 
             def __init__(self, test):
                 self._test = test
                 self._pointer = None
                 self._index = 0
 
-            def get_mem32(self, addr, size):
+            def get_mem32(self, addr, size, buf, wait=True):
                 self._test.assertNotEqual(size, 0)
                 self._test.assertEqual(addr % 4, 0)
                 self._test.assertEqual(size % 4, 0)
+                self._test.assertEqual(len(buf), size)
                 if self._pointer is None:
                     self._pointer = addr
                 assert size <= 1024
@@ -275,10 +301,12 @@ class TestStm32_get_mem(unittest.TestCase):
                 self._pointer += size
                 old_index = self._index
                 self._index += size
-                return [i & 0xff for i in range(old_index, self._index)]
+                buf[:] = bytes([i & 0xff for i in range(old_index, self._index)])
+                return buf
 
-            def get_mem8(self, addr, size):
+            def get_mem8(self, addr, size, buf):
                 self._test.assertNotEqual(size, 0)
+                self._test.assertEqual(len(buf), size)
                 if self._pointer is None:
                     self._pointer = addr
                 assert size <= 64
@@ -286,13 +314,23 @@ class TestStm32_get_mem(unittest.TestCase):
                 self._pointer += size
                 old_index = self._index
                 self._index += size
-                return [i & 0xff for i in range(old_index, self._index)]
+                buf[:] = bytes([i & 0xff for i in range(old_index, self._index)])
+                return buf
+
+            def sync(self):
+                pass
+
+            def queue_rw_status(self, statuses):
+                pass
+
+            def check_rw_status(self, statuses=None):
+                return True
 
         self._driver = lib.stm32.Stm32(stlink=MockStlink(self), dbg=MockDbg())
 
     def _test_get_mem(self, addr, size):
         data = self._driver.get_mem(addr, size)
-        expected_data = [i & 0xff for i in range(0, size)]
+        expected_data = bytes([i & 0xff for i in range(0, size)])
         self.assertEqual(data, expected_data)
 
     def test_addr_0_size_0(self):
@@ -389,17 +427,24 @@ class TestStm32_get_mem(unittest.TestCase):
         self._test_get_mem(2, 1100)
 
 
+
+class TestStm32_get_mem_linux(TestStm32_get_mem):
+    def setUp(self):
+        super().setUp()
+        self._driver._stlink.transfer_policy = lib.stlinkusb.TransferPolicy()
+
 class TestStm32_set_mem(unittest.TestCase):
     def setUp(self):
         class MockStlink():
-            STLINK_MAXIMUM_TRANSFER_SIZE = 1024
+            maximum_transfer_size = 1024
+            transfer_policy = lib.stlinkusb.TransferPolicyDarwin()
 
             def __init__(self, test):
                 self._test = test
                 self._pointer = None
                 self._index = 0
 
-            def set_mem32(self, addr, data):
+            def set_mem32(self, addr, data, wait=True):
                 self._test.assertNotEqual(len(data), 0)
                 self._test.assertEqual(addr % 4, 0)
                 self._test.assertEqual(len(data) % 4, 0)
@@ -419,10 +464,19 @@ class TestStm32_set_mem(unittest.TestCase):
                 self._pointer += len(data)
                 self._index += len(data)
 
+            def sync(self):
+                pass
+
+            def queue_rw_status(self, statuses):
+                pass
+
+            def check_rw_status(self, statuses=None):
+                return True
+
         self._driver = lib.stm32.Stm32(stlink=MockStlink(self), dbg=MockDbg())
 
     def _test_set_mem(self, addr, size):
-        self._driver.set_mem(addr, [i & 0xff for i in range(0, size)])
+        self._driver.set_mem(addr, bytes([i & 0xff for i in range(0, size)]))
 
     def test_addr_0_size_0(self):
         self._test_set_mem(0, 0)
@@ -518,17 +572,24 @@ class TestStm32_set_mem(unittest.TestCase):
         self._test_set_mem(2, 1100)
 
 
+
+class TestStm32_set_mem_linux(TestStm32_set_mem):
+    def setUp(self):
+        super().setUp()
+        self._driver._stlink.transfer_policy = lib.stlinkusb.TransferPolicy()
+
 class TestStm32_fill_mem(unittest.TestCase):
     def setUp(self):
         class MockStlink():
-            STLINK_MAXIMUM_TRANSFER_SIZE = 1024
+            maximum_transfer_size = 1024
+            transfer_policy = lib.stlinkusb.TransferPolicyDarwin()
 
             def __init__(self, test):
                 self._test = test
                 self._pointer = None
                 self._index = 0
 
-            def set_mem32(self, addr, data):
+            def set_mem32(self, addr, data, wait=True):
                 self._test.assertNotEqual(len(data), 0)
                 self._test.assertEqual(addr % 4, 0)
                 self._test.assertEqual(len(data) % 4, 0)
@@ -548,6 +609,15 @@ class TestStm32_fill_mem(unittest.TestCase):
                 self._pointer += len(data)
                 self._index += len(data)
 
+            def sync(self):
+                pass
+
+            def queue_rw_status(self, statuses):
+                pass
+
+            def check_rw_status(self, statuses=None):
+                return True
+
         self._driver = lib.stm32.Stm32(stlink=MockStlink(self), dbg=MockDbg())
 
     def _test_fill_mem(self, addr, size):
@@ -647,5 +717,824 @@ class TestStm32_fill_mem(unittest.TestCase):
         self._test_fill_mem(2, 1100)
 
 
+
+class TestStm32_fill_mem_linux(TestStm32_fill_mem):
+    def setUp(self):
+        super().setUp()
+        self._driver._stlink.transfer_policy = lib.stlinkusb.TransferPolicy()
+
+
+class TestTransferPolicy(unittest.TestCase):
+    def test_split(self):
+        policy = lib.stlinkusb.TransferPolicy()
+        self.assertEqual(policy.split(0, 1024), ())
+        self.assertEqual(policy.split(3, 1024), ())
+        self.assertEqual(policy.split(7, 1024), (4, ))
+        self.assertEqual(policy.split(1100, 1024), (1024, ))
+
+    def test_split_darwin(self):
+        policy = lib.stlinkusb.TransferPolicyDarwin()
+        self.assertEqual(policy.split(7, 1024), ())
+        self.assertEqual(policy.split(60, 1024), (56, ))
+        self.assertEqual(policy.split(100, 1024), (48, 48))
+        self.assertEqual(policy.split(4096, 1024), (1024, 1024))
+
+
+class TestStlinkSim(unittest.TestCase):
+    def connect(self, cpu_type, driver_class, stats=False):
+        dbg = lib.dbg.Dbg(0)
+        self._connector = lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type=cpu_type, time_scale=0.01)
+        if stats:
+            self._stlink = lib.stlinkv2.Stlink(lib.stlinkstats.StlinkStatsConnector(self._connector), dbg=dbg)
+        else:
+            self._stlink = lib.stlinkv2.Stlink(self._connector, dbg=dbg)
+        self._driver = driver_class(self._stlink, dbg=dbg, flash_size=self._connector.target.flash_size)
+        self._driver.core_reset_halt()
+        return self._connector.target
+
+    def flash_write(self, cpu_type, driver_class):
+        target = self.connect(cpu_type, driver_class)
+        data = bytearray(range(256)) * 20 + b'\x5a\xa5\x5a\xa5\x12\x34\x56\x78'
+        self._driver.flash_write(None, data, erase=True, erase_sizes=target.erase_sizes)
+        self._driver.flash_verify(lib.stm32.Stm32.FLASH_START, data)
+        self.assertEqual(bytes(target.flash[:len(data)]), data)
+
+    def test_version(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self.assertEqual(self._stlink.ver_str, 'V2 V2J37S7')
+        self.assertEqual(self._stlink.coreid, 0x2ba01477)
+        self.assertAlmostEqual(self._stlink.target_voltage, 3.3)
+
+    def test_core_halt(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.core_run()
+        self.assertFalse(self._connector.target.halted)
+        self._driver.core_halt()
+        self.assertTrue(self._connector.target.halted)
+
+    def test_sram(self):
+        self.connect('STM32F051x8', lib.stm32fp.Stm32FP)
+        data = bytes(range(256)) * 4 + b'\x01\x02\x03'
+        self._driver.set_mem(lib.stm32.Stm32.SRAM_START + 1, data)
+        self.assertEqual(self._driver.get_mem(lib.stm32.Stm32.SRAM_START + 1, len(data)), data)
+
+    def test_get_reg_all(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.set_reg('R5', 0x12345678)
+        self._driver.set_reg('PSP', 0x20001000)
+        xfer_counter = self._connector.xfer_counter
+        regs = dict(self._driver.get_reg_all())
+        self.assertEqual(self._connector.xfer_counter - xfer_counter, 2)
+        self.assertEqual(list(regs), lib.stm32.Stm32.REGISTERS)
+        self.assertEqual(regs['R5'], 0x12345678)
+        self.assertEqual(regs['PSP'], 0x20001000)
+        self.assertEqual(regs['PSR'], 0x01000000)
+
+    def test_reg_cache(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.core_halt()
+        self._driver.get_reg('PC')
+        xfer_counter = self._connector.xfer_counter
+        self._driver.get_reg('PC')
+        self._driver.set_reg('R0', 0x1234)
+        self.assertEqual(self._driver.get_reg('R0'), 0x1234)
+        self.assertEqual(self._connector.xfer_counter - xfer_counter, 1)
+        self._connector.target.set_reg(0, 0x5678)
+        self._driver.core_step()
+        self.assertEqual(self._driver.get_reg('R0'), 0x5678)
+
+    def test_reg_cache_sp(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.get_reg_all()
+        self._connector.target.set_reg(17, 0x20000400)
+        self._driver.set_reg('SP', 0x20000400)
+        self.assertEqual(self._driver.get_reg('MSP'), 0x20000400)
+
+    def test_reg_cache_run(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.get_reg_all()
+        self._connector.target.set_reg(15, 0x08000200)
+        self._driver.core_run()
+        self._driver.core_halt()
+        self.assertEqual(self._driver.get_reg('PC'), 0x08000200)
+
+    def test_get_reg_all_fallback(self):
+        dbg = lib.dbg.Dbg(0)
+        connector = lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB', readallregs=False)
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg)
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=dbg)
+        driver.set_reg('PC', 0x08000100)
+        regs = dict(driver.get_reg_all())
+        self.assertEqual(regs['PC'], 0x08000100)
+        self.assertIsNone(stlink.read_all_regs())
+
+    def test_fpu_regs(self):
+        self.connect('STM32F407xG', lib.stm32fs.Stm32FS)
+        self.assertTrue(self._driver.is_reg('s31'))
+        self._driver.set_reg('S31', 0x3f800000)
+        self._driver.set_reg('FPSCR', 0x03000000)
+        regs = dict(self._driver.get_reg_all())
+        self.assertEqual(regs['S31'], 0x3f800000)
+        self.assertEqual(regs['FPSCR'], 0x03000000)
+        self.assertEqual(len(regs), len(lib.stm32.Stm32.REGISTERS) + 33)
+
+    def test_no_fpu_regs(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self.assertFalse(self._driver.is_reg('S0'))
+        self.assertEqual(len(self._driver.get_reg_all()), len(lib.stm32.Stm32.REGISTERS))
+
+    def test_swd_tune(self):
+        dbg = lib.dbg.Dbg(0)
+        connector = lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB', max_swd_freq=1000000)
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg, swd_frequency='auto')
+        self.assertEqual(stlink.swd_frequency, 950000)
+
+    def test_swd_tune_old_firmware(self):
+        class OldStlinkSimConnector(lib.stlinksim.StlinkSimConnector):
+            # firmware before J22 can not set SWD frequency
+            STLINK_VERSION = (2 << 12) | (21 << 6) | 7
+        dbg = lib.dbg.Dbg(0)
+        connector = OldStlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB')
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg, swd_frequency='auto')
+        self.assertEqual(stlink.get_swd_freqs(), [])
+        self.assertEqual(stlink.swd_frequency, 4000000)
+        # transfer errors are not reported as errors on lowest frequency
+        self.assertTrue(stlink.check_rw_status([bytearray(b'\x10\x00')]))
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=dbg)
+        data = bytes(range(256)) * 4
+        driver.set_mem(lib.stm32.Stm32.SRAM_START, data)
+        self.assertEqual(driver.get_mem(lib.stm32.Stm32.SRAM_START, len(data)), data)
+
+    def test_swd_downshift(self):
+        dbg = lib.dbg.Dbg(0)
+        connector = lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB')
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg, swd_frequency='auto')
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=dbg)
+        self.assertEqual(stlink.swd_frequency, 4000000)
+        data = bytes(range(256)) * 32
+        driver.set_mem(lib.stm32.Stm32.SRAM_START, data)
+        connector._max_swd_freq = 500000
+        self.assertEqual(driver.get_mem(lib.stm32.Stm32.SRAM_START, len(data)), data)
+        self.assertEqual(stlink.swd_frequency, 480000)
+
+    def test_rw_status_per_block(self):
+        dbg = lib.dbg.Dbg(0)
+        connector = lib.stlinkstats.StlinkStatsConnector(lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB'))
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg, swd_frequency='auto')
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=dbg)
+        driver.get_mem(lib.stm32.Stm32.SRAM_START, 8192)
+        commands = stlink.stats.commands
+        self.assertGreaterEqual(commands['GETLASTRWSTATUS']['calls'], commands['READMEM_32BIT']['calls'])
+        # error of first block is found although last block is OK
+        self.assertFalse(stlink.check_rw_status([bytearray(b'\x10\x00'), bytearray(b'\x80\x00')]))
+        self.assertLess(stlink.swd_frequency, 4000000)
+        stlink.check_rw_status = lambda statuses=None: False
+        with self.assertRaisesRegex(lib.stlinkex.StlinkException, 'failed %d times' % lib.stm32.Stm32.RW_RETRIES):
+            driver.get_mem(lib.stm32.Stm32.SRAM_START, 8192)
+
+    def test_flash_busy_poll(self):
+        target = lib.stlinksim.SimTarget('STM32F051x8', time_scale=1)
+        cr = lib.stlinksim.SimFlashFP.REG_BASE + lib.stlinksim.SimFlashFP.CR
+        sr = lib.stlinksim.SimFlashFP.REG_BASE + lib.stlinksim.SimFlashFP.SR
+        target.write32(lib.stlinksim.SimFlashFP.REG_BASE + lib.stlinksim.SimFlashFP.KEYR, 0x45670123)
+        target.write32(lib.stlinksim.SimFlashFP.REG_BASE + lib.stlinksim.SimFlashFP.KEYR, 0xcdef89ab)
+        for i in range(5):
+            target.write32(sr, lib.stlinksim.SimFlashFP.SR_EOP)
+            target.write32(lib.stlinksim.SimFlashFP.REG_BASE + lib.stlinksim.SimFlashFP.AR, lib.stm32.Stm32.FLASH_START)
+            target.write32(cr, lib.stlinksim.SimFlashFP.CR_PER | lib.stlinksim.SimFlashFP.CR_STRT)
+            # every status read across end of erase shows BSY or EOP
+            while True:
+                status = target.read32(sr)
+                self.assertTrue(status & (lib.stlinksim.SimFlashFP.SR_BSY | lib.stlinksim.SimFlashFP.SR_EOP))
+                if not status & lib.stlinksim.SimFlashFP.SR_BSY:
+                    break
+
+    def test_locked_flash(self):
+        self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._stlink.set_mem16(lib.stm32.Stm32.FLASH_START, b'\x00\x00')
+        self.assertEqual(self._driver.get_mem(lib.stm32.Stm32.FLASH_START, 4), b'\xff\xff\xff\xff')
+
+    def test_flash_write_fp(self):
+        self.flash_write('STM32F103xB', lib.stm32fp.Stm32FP)
+
+    def test_flash_write_fs(self):
+        self.flash_write('STM32F407xG', lib.stm32fs.Stm32FS)
+
+    def test_flash_write_l0(self):
+        self.flash_write('STM32L073xZ', lib.stm32l0.Stm32L0)
+
+    def test_flash_write_l4(self):
+        self.flash_write('STM32L476xG', lib.stm32l4.Stm32L4)
+
+    def test_flash_write_h7(self):
+        self.flash_write('STM32H743xI', lib.stm32h7.Stm32H7)
+
+    def test_core_run_breakpoint(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        # movs r0, #5; lsls r0, r0, #4; adds r0, #3; subs r1, r0, #1; bkpt #0
+        self._driver.set_mem(lib.stm32.Stm32.SRAM_START, bytes.fromhex('052000010330411e00be0000'))
+        self._driver.set_reg('PC', lib.stm32.Stm32.SRAM_START)
+        self._driver.core_run()
+        for i in range(100):
+            if target.halted:
+                break
+            time.sleep(0.01)
+        self.assertTrue(target.halted)
+        self.assertEqual(self._driver.get_reg('R0'), 0x53)
+        self.assertEqual(self._driver.get_reg('R1'), 0x52)
+        self.assertEqual(self._driver.get_reg('PC'), lib.stm32.Stm32.SRAM_START + 8)
+
+    def test_flash_loader_buffers(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver = lib.stm32fp.Stm32FP(self._stlink, dbg=lib.dbg.Dbg(0), sram_size=8)
+        flash = lib.stm32fp.Flash(self._driver, self._stlink, lib.dbg.Dbg(0))
+        loader = lib.stm32loader.FlashLoader(self._driver, self._stlink, lib.dbg.Dbg(0), flash, sram_size=8)
+        self.assertEqual(loader.buffer_size, 3840)
+        flash.lock()
+        # blank block between is skipped, but buffers still alternate
+        data = bytearray(range(256)) * 15 + b'\xff' * 3840 + bytearray(range(255, -1, -1)) * 20
+        self._driver.flash_write(None, data, erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[:len(data)]), data)
+
+    def test_flash_loader_error(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        self._driver.flash_write(None, bytearray(b'\x12\x34' * 8), erase=True, erase_sizes=target.erase_sizes)
+        # programming not erased half-word fails with PGERR
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            self._driver.flash_write(None, bytearray(b'\x56\x78' * 8))
+        self.assertEqual(bytes(target.flash[:4]), b'\x12\x34\x12\x34')
+
+    def test_crc32_routine(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        target.flash[:4096] = bytes(range(256)) * 16
+        routine = lib.stm32loader.Crc32Routine(self._driver, self._stlink, self._driver._dbg)
+        regions = [(lib.stm32.Stm32.FLASH_START, 1024), (lib.stm32.Stm32.FLASH_START + 1027, 5), (lib.stm32.Stm32.FLASH_START, 0)]
+        self.assertEqual(routine.crc32(regions), [binascii.crc32(target.flash[1024:2048]), binascii.crc32(target.flash[1027:1032]), 0])
+
+    def test_flash_verify_crc(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        data = bytearray(range(256)) * 24
+        target.flash[:len(data)] = data
+        self._driver.flash_verify(lib.stm32.Stm32.FLASH_START, data, erase_sizes=target.erase_sizes)
+        target.flash[5000] ^= 0x10
+        with self.assertRaisesRegex(lib.stlinkex.StlinkException, '0x08001388'):
+            self._driver.flash_verify(lib.stm32.Stm32.FLASH_START, data, erase_sizes=target.erase_sizes)
+
+    def test_flash_verify_restores_sram(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        data = bytearray(range(256)) * 24
+        target.flash[:len(data)] = data
+        sram = bytes(range(255, -1, -1)) * 8
+        self._driver.set_mem(lib.stm32.Stm32.SRAM_START, sram)
+        self._driver.set_reg('R0', 0x12345678)
+        self._driver.set_reg('PC', 0x08000100)
+        self._driver.flash_verify(lib.stm32.Stm32.FLASH_START, data, erase_sizes=target.erase_sizes)
+        # routine ran from SRAM, but application state is kept
+        self.assertEqual(bytes(self._driver.get_mem(lib.stm32.Stm32.SRAM_START, len(sram))), sram)
+        self.assertEqual(self._driver.get_reg('R0'), 0x12345678)
+        self.assertEqual(self._driver.get_reg('PC'), 0x08000100)
+
+    def test_sram_routine_masks_interrupts(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP)
+        data = bytearray(range(256)) * 24
+        target.flash[:len(data)] = data
+        # DHCSR of each start of core
+        started = []
+        core_run = target.core_run
+        def record_run():
+            started.append(target._dhcsr)
+            core_run()
+        target.core_run = record_run
+        self._driver.flash_verify(lib.stm32.Stm32.FLASH_START, data, erase_sizes=target.erase_sizes)
+        self.assertTrue(started)
+        for dhcsr in started:
+            self.assertTrue(dhcsr & lib.stm32.Stm32.DHCSR_MASKINTS_BIT)
+        self.assertTrue(target.halted)
+        self.assertFalse(target._dhcsr & lib.stm32.Stm32.DHCSR_MASKINTS_BIT)
+
+    def flash_delta(self, cpu_type, driver_class, data, new_data, erase_operation):
+        # returns count of erased sectors
+        target = self.connect(cpu_type, driver_class, stats=True)
+        self._driver.flash_write(None, bytearray(data), erase=True, erase_sizes=target.erase_sizes)
+        operations = self._stlink.stats.operations
+        erased = operations.get(erase_operation, {'calls': 0})['calls']
+        self._driver.flash_delta(None, new_data, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[:len(new_data)]), new_data)
+        return operations.get(erase_operation, {'calls': 0})['calls'] - erased
+
+    def test_flash_delta_fp(self):
+        data = bytes(range(256)) * 8 + b'\xff' * 2048 + bytes(range(256)) * 8
+        new_data = bytearray(data)
+        # erased page and zero half-word are only programmed, changed page is erased
+        new_data[2100:2104] = b'\x12\x34\x56\x78'
+        new_data[4100:4102] = b'\x00\x00'
+        new_data[5000] ^= 0x01
+        erased = self.flash_delta('STM32F103xB', lib.stm32fp.Stm32FP, data, new_data, 'Flash.erase_page')
+        self.assertEqual(erased, 1)
+        self.assertEqual(bytes(self._connector.target.flash[len(data):len(data) + 4]), b'\xff' * 4)
+
+    def test_flash_delta_fs(self):
+        data = bytes(range(256)) * 20
+        new_data = bytearray(data)
+        # clearing bits does not need erase
+        new_data[4000] &= 0x0f
+        new_data[4097] = 0
+        erased = self.flash_delta('STM32F407xG', lib.stm32fs.Stm32FS, data, new_data, 'Flash.erase_sector')
+        self.assertEqual(erased, 0)
+        new_data[10] = 0xff
+        self._driver.flash_delta(None, new_data, erase_sizes=self._connector.target.erase_sizes)
+        self.assertEqual(bytes(self._connector.target.flash[:len(new_data)]), new_data)
+
+    def test_flash_session(self):
+        target = self.connect('STM32F103xB', lib.stm32fp.Stm32FP, stats=True)
+        segments = [(lib.stm32.Stm32.FLASH_START + i * 2048, bytearray(range(i, i + 200))) for i in range(4)]
+        with self._driver.flash_session() as session:
+            for addr, data in segments:
+                session.write(addr, data, erase=True, erase_sizes=target.erase_sizes)
+                session.verify(addr, data)
+        # FLASH is unlocked and locked once, both reset core
+        self.assertEqual(self._stlink.stats.operations['Stm32.core_reset_halt']['calls'], 3)
+        self.assertEqual(self._stlink.stats.operations['Flash.lock']['calls'], 1)
+        for addr, data in segments:
+            offset = addr - lib.stm32.Stm32.FLASH_START
+            self.assertEqual(bytes(target.flash[offset:offset + len(data)]), data)
+        self.assertTrue(self._connector.target.read32(lib.stm32fp.Flash.FLASH_CR_REG) & lib.stm32fp.Flash.FLASH_CR_LOCK_BIT)
+
+    def test_flash_session_h7(self):
+        target = self.connect('STM32H743xI', lib.stm32h7.Stm32H7, stats=True)
+        segments = [(lib.stm32.Stm32.FLASH_START + i * 0x100000, bytearray(range(i, i + 64))) for i in range(2)]
+        with self._driver.flash_session() as session:
+            for addr, data in segments:
+                session.write(addr, data, erase=True, erase_sizes=target.erase_sizes)
+        # both banks are unlocked only when session is opened
+        self.assertEqual(self._stlink.stats.operations['Flash.unlock']['calls'], 2)
+        for addr, data in segments:
+            offset = addr - lib.stm32.Stm32.FLASH_START
+            self.assertEqual(bytes(target.flash[offset:offset + len(data)]), data)
+
+    def test_flash_write_h7_unaligned(self):
+        target = self.connect('STM32H743xI', lib.stm32h7.Stm32H7)
+        data = bytearray(range(100))
+        self._driver.flash_write(None, data, erase=True, erase_sizes=target.erase_sizes)
+        # data of caller are not padded, last FLASH word is padded by erased value
+        self.assertEqual(len(data), 100)
+        self.assertEqual(bytes(target.flash[:128]), bytes(range(100)) + b'\xff' * 28)
+
+    def test_flash_program_shared_sector(self):
+        target = self.connect('STM32F407xG', lib.stm32fs.Stm32FS)
+        segments = [(lib.stm32.Stm32.FLASH_START + 0x100, bytearray(b'\x11' * 256)), (lib.stm32.Stm32.FLASH_START, bytearray(b'\x22' * 16))]
+        with self._driver.flash_session() as session:
+            plan = session.program(segments, erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(plan.erase, [(lib.stm32.Stm32.FLASH_START, 16 * 1024)])
+        self.assertEqual(bytes(target.flash[:16]), b'\x22' * 16)
+        self.assertEqual(bytes(target.flash[0x100:0x200]), b'\x11' * 256)
+
+    def test_flash_plan_mass_erase(self):
+        target = self.connect('STM32F030x4', lib.stm32fp.Stm32FP)
+        data = bytearray(os.urandom(len(target.flash)))
+        plan = self._driver.flash_plan([(None, data)], erase=True, erase_sizes=target.erase_sizes)
+        self.assertTrue(plan.mass_erase)
+        self.assertEqual(plan.erase, [])
+        # one page is not erased
+        self.assertFalse(self._driver.flash_plan([(None, data[1024:])], erase=True, erase_sizes=target.erase_sizes).mass_erase)
+        self._driver.flash_execute(plan)
+        self.assertEqual(bytes(target.flash), data)
+
+    def test_flash_write_l0_unaligned(self):
+        target = self.connect('STM32L053x8', lib.stm32l0.Stm32L0)
+        data = bytearray(range(1, 200))
+        self._driver.flash_write(lib.stm32.Stm32.FLASH_START + 4, data, erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[4:4 + len(data) + 1]), data + b'\x00')
+
+    def test_flash_erase_l0_pages(self):
+        target = self.connect('STM32L053x8', lib.stm32l0.Stm32L0, stats=True)
+        target.flash[:0x400] = b'\x11' * 0x400
+        # region overlaps pages 1 and 2, others are preserved
+        self._driver.flash_write(lib.stm32.Stm32.FLASH_START + 0xf8, bytearray(b'\x5a' * 16), erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[0x70:0x80]), b'\x11' * 16)
+        self.assertEqual(bytes(target.flash[0x80:0x88]), bytes(8))
+        self.assertEqual(bytes(target.flash[0xf8:0x108]), b'\x5a' * 16)
+        self.assertEqual(bytes(target.flash[0x170:0x180]), bytes(16))
+        self.assertEqual(bytes(target.flash[0x180:0x190]), b'\x11' * 16)
+        self._driver.flash_erase_all(64)
+        self.assertEqual(bytes(target.flash), bytes(len(target.flash)))
+
+    def test_flash_write_blank_runs(self):
+        target = self.connect('STM32L476xG', lib.stm32l4.Stm32L4, stats=True)
+        data = bytearray(b'\x5a' * 60) + b'\xff' * 0x10000 + b'\xa5' * 60
+        self._driver.flash_write(None, data, erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[:len(data)]), data)
+        # blank run is not transferred
+        self.assertLess(self._stlink.stats.commands['WRITEMEM_32BIT']['tx_bytes'], 1024)
+
+    def test_flash_erase_h7_bank2(self):
+        target = self.connect('STM32H743xI', lib.stm32h7.Stm32H7)
+        target.flash[0x100000:0x140000] = bytes(0x40000)
+        self._driver.flash_write(lib.stm32.Stm32.FLASH_START + 0x120000, bytearray(b'\x5a' * 64), erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(bytes(target.flash[0x11fff0:0x120010]), bytes(16) + b'\x5a' * 16)
+        self.assertEqual(bytes(target.flash[0x120040:0x120050]), b'\xff' * 16)
+
+    def test_flash_erase_l4_pages(self):
+        # 512 KB device has banks of 128 pages
+        target = self.connect('STM32L476xE', lib.stm32l4.Stm32L4, stats=True)
+        target.flash[0x3f000:0x44000] = bytes(0x5000)
+        # region in second bank overlaps 2 pages
+        self._driver.flash_write(lib.stm32.Stm32.FLASH_START + 0x41000 - 8, bytearray(b'\x5a' * 16), erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(self._stlink.stats.operations['Flash.erase_page']['calls'], 2)
+        self.assertEqual(bytes(target.flash[0x3fff0:0x40010]), bytes(32))
+        self.assertEqual(bytes(target.flash[0x40ff8:0x41008]), b'\x5a' * 16)
+        self.assertEqual(bytes(target.flash[0x41008:0x41018]), b'\xff' * 16)
+        self.assertEqual(bytes(target.flash[0x41800:0x41810]), bytes(16))
+        # whole second bank is erased at once
+        self._driver.flash_write(lib.stm32.Stm32.FLASH_START + 0x40000, bytearray(b'\x5a' * 0x40000), erase=True, erase_sizes=target.erase_sizes)
+        self.assertEqual(self._stlink.stats.operations['Flash.erase_bank']['calls'], 1)
+        self.assertEqual(bytes(target.flash[0x3fff0:0x40010]), bytes(16) + b'\x5a' * 16)
+
+    def test_sectors(self):
+        driver = lib.stm32.Stm32(None, None, flash_size=64)
+        self.assertEqual(driver.flash_geometry((0x1000, 0x2000)).regions(0x08000100, 0x4000), [
+            (0x08000100, 0xf00), (0x08001000, 0x2000), (0x08003000, 0x1000), (0x08004000, 0x100)])
+        self.assertEqual(driver.flash_geometry().regions(0x08000000, 0x100), [(0x08000000, 0x100)])
+        self.assertIs(driver.flash_geometry((0x1000, 0x2000)), driver.flash_geometry((0x1000, 0x2000)))
+
+
+class TestFlashGeometry(unittest.TestCase):
+    FLASH_START = lib.stm32.Stm32.FLASH_START
+
+    def test_sectors(self):
+        geometry = lib.stm32geometry.FlashGeometry(self.FLASH_START, 1024 * 1024, (16 * 1024, ) * 4 + (64 * 1024, ) + (128 * 1024, ) * 7)
+        self.assertEqual(len(geometry), 12)
+        self.assertEqual(geometry.index(self.FLASH_START), 0)
+        self.assertEqual(geometry.index(self.FLASH_START + 0x13fff), 4)
+        self.assertEqual(geometry.index(self.FLASH_START + 0xfffff), 11)
+        self.assertEqual(geometry.indexes(self.FLASH_START + 0x3fff, 2), range(0, 2))
+        self.assertEqual(geometry.indexes(self.FLASH_START + 0x4000, 0x4000), range(1, 2))
+        self.assertEqual(geometry.sectors(self.FLASH_START + 0x10000, 0x10001), [(self.FLASH_START + 0x10000, 0x10000), (self.FLASH_START + 0x20000, 0x20000)])
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            geometry.index(self.FLASH_START + 0x100000)
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            geometry.sectors(self.FLASH_START - 4, 8)
+
+    def test_banks(self):
+        geometry = lib.stm32geometry.FlashGeometry(self.FLASH_START, 2048 * 1024, (128 * 1024, ), bank_size=1024 * 1024)
+        self.assertEqual(len(geometry), 16)
+        self.assertEqual(geometry.bank(self.FLASH_START + 0xfffff), 0)
+        self.assertEqual(geometry.bank(self.FLASH_START + 0x100000), 1)
+        self.assertEqual(geometry.bank_sector(9), (1, 1))
+        self.assertEqual(geometry.bank_sectors(1), range(8, 16))
+        self.assertEqual(geometry.bank_end(0), self.FLASH_START + 0x100000)
+
+
+class TestBusyPoller(unittest.TestCase):
+    def test_interval(self):
+        interval = lib.stm32poll.BusyPoller.interval
+        self.assertEqual(interval(16, 0), lib.stm32poll.BusyPoller.MAX_INTERVAL)
+        self.assertAlmostEqual(interval(16, 15.98), 0.01)
+        self.assertEqual(interval(16, 16), lib.stm32poll.BusyPoller.MIN_INTERVAL)
+        self.assertAlmostEqual(interval(16, 16.1), 0.025)
+        self.assertEqual(interval(0.001, 0), lib.stm32poll.BusyPoller.MIN_INTERVAL)
+
+    def test_learn(self):
+        poller = lib.stm32poll.BusyPoller()
+        self.assertEqual(poller.expected(2, 2), 2)
+        poller.learn(2, 1.0)
+        self.assertEqual(poller.expected(2, 2), 1.0)
+        poller.learn(2, 0.6)
+        self.assertAlmostEqual(poller.expected(2, 2), 0.9)
+        self.assertEqual(poller.wait(1, 4, key=2).expected, 0.9)
+        self.assertEqual(poller.wait(2, 4, key='other').expected, 2)
+
+    def test_unnamed_wait(self):
+        # waits without key share time from data sheet, so they are not learned
+        poller = lib.stm32poll.BusyPoller()
+        wait = poller.wait(0.001, 1)
+        wait.done()
+        self.assertIsNone(poller.learned(0.001))
+        self.assertEqual(poller.wait(0.001, 1).expected, 0.001)
+        self.assertEqual(poller.spent(''), 0)
+
+
+class TestFlashTiming(unittest.TestCase):
+    def test_estimate(self):
+        poller = lib.stm32poll.BusyPoller()
+        timing = lib.stm32timing.FlashTiming(poller, 1.0, 10.0, 0.0001, erase_times={0x1000: 0.5}, transfer_time=0.0001)
+        plan = lib.stm32plan.FlashPlan([(0x08000000, b'\x01' * 0x2000)], lib.stm32geometry.FlashGeometry(0x08000000, 0x10000, (0x1000, 0x1000, 0x2000)))
+        self.assertAlmostEqual(timing.estimate(plan)['erase'], 1.0)
+        self.assertAlmostEqual(timing.estimate(plan)['total'], 1.0 + 0x2000 * 0.0002)
+        poller.done(lib.stm32timing.FlashTiming.erase_key(0x1000), 0.1)
+        timing.learn_write(0x1000, 0.1)
+        self.assertAlmostEqual(timing.estimate(plan)['erase'], 0.2)
+        self.assertAlmostEqual(timing.write_time(0x2000), 0.2)
+        plan.set_mass_erase()
+        self.assertAlmostEqual(timing.estimate(plan)['erase'], 10.0)
+
+    def test_estimate_blank_runs(self):
+        poller = lib.stm32poll.BusyPoller()
+        timing = lib.stm32timing.FlashTiming(poller, 1.0, 10.0, 0.0001, transfer_time=0.0001)
+        # chunk is padded to whole sector, but only data are transferred
+        plan = lib.stm32plan.FlashPlan([(0x08000000, b'\x01' * 0x100), (0x08003f00, b'\x02' * 0x100)], lib.stm32geometry.FlashGeometry(0x08000000, 0x10000, (0x4000, )))
+        self.assertEqual(plan.size, 0x4000)
+        self.assertEqual(plan.transfer_size, 0x200)
+        self.assertAlmostEqual(timing.estimate(plan)['write'], 0x200 * 0.0002)
+
+    def test_estimate_bank_erase(self):
+        poller = lib.stm32poll.BusyPoller()
+        timing = lib.stm32timing.FlashTiming(poller, 1.0, 10.0, 0.0001, bank_erase_time=3.0)
+        geometry = lib.stm32geometry.FlashGeometry(0x08000000, 0x10000, (0x1000, ), bank_size=0x8000)
+        # second bank is erased at once
+        plan = lib.stm32plan.FlashPlan([(0x08007000, b'\x01' * 0x9000)], geometry)
+        self.assertAlmostEqual(timing.estimate(plan)['erase'], 4.0)
+        poller.done(lib.stm32timing.FlashTiming.BANK_ERASE_KEY, 2.0)
+        self.assertAlmostEqual(timing.estimate(plan)['erase'], 3.0)
+        self.assertEqual(poller.spent('erase'), 2.0)
+
+    def test_store(self):
+        poller = lib.stm32poll.BusyPoller()
+        poller.done(lib.stm32timing.FlashTiming.MASS_ERASE_KEY, 1.5)
+        poller.done(0.2, 0.1)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'timings.json')
+            poller.save(filename, 'STM32F103xB')
+            loaded = lib.stm32poll.BusyPoller()
+            loaded.load(filename, 'STM32F407xG')
+            self.assertIsNone(loaded.learned(lib.stm32timing.FlashTiming.MASS_ERASE_KEY))
+            loaded.load(filename, 'STM32F103xB')
+            self.assertEqual(loaded.learned(lib.stm32timing.FlashTiming.MASS_ERASE_KEY), 1.5)
+            self.assertIsNone(loaded.learned(0.2))
+
+
+class TestMemoryImage(unittest.TestCase):
+    def test_merge(self):
+        image = lib.memimage.MemoryImage([(0x100, b'\x03' * 4), (0x10, b'\x01' * 4), (0x14, b'\x02' * 4)])
+        self.assertEqual(list(image), [(0x10, b'\x01' * 4 + b'\x02' * 4), (0x100, b'\x03' * 4)])
+        # extent between joins both neighbours
+        image.merge(0x18, bytes(0xe8))
+        self.assertEqual(len(image), 1)
+        self.assertEqual((image.start, image.end, image.size), (0x10, 0x104, 0xf4))
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            image.merge(0x12, b'\x01\x01\x05')
+        image.overlay(0x12, b'\x01\x01\x05')
+        self.assertEqual(image.find(0x14), (0x10, b'\x01' * 4 + b'\x05\x02\x02\x02' + bytes(0xe8) + b'\x03' * 4))
+        self.assertIsNone(image.find(0x104))
+
+    def test_fill_gaps(self):
+        image = lib.memimage.MemoryImage([(0, b'\x01'), (4, b'\x02'), (0x100, b'\x03')])
+        image.fill_gaps(max_gap=16)
+        self.assertEqual(list(image), [(0, b'\x01\xff\xff\xff\x02'), (0x100, b'\x03')])
+        image.fill_gaps(value=0)
+        self.assertEqual(image.size, 0x101)
+
+    def test_align_slice(self):
+        geometry = lib.stm32geometry.FlashGeometry(0, 0x1000, (0x100, ))
+        image = lib.memimage.MemoryImage([(0x110, b'\x01' * 4), (0x1f0, b'\x02' * 0x20), (0x400, b'\x03')])
+        aligned = image.align(geometry)
+        self.assertEqual([(addr, len(data)) for addr, data in aligned], [(0x100, 0x200), (0x400, 0x100)])
+        self.assertEqual(bytes(aligned.find(0x100)[1][0x0f:0x15]), b'\xff' + b'\x01' * 4 + b'\xff')
+        self.assertEqual(list(image.slice(0x112, 0x100)), [(0x112, b'\x01' * 2), (0x1f0, b'\x02' * 0x20)])
+        self.assertEqual(image.slice(0x112, 0x100).digest(), lib.memimage.MemoryImage([(0x1f0, b'\x02' * 0x20), (0x112, b'\x01' * 2)]).digest())
+        self.assertNotEqual(image.digest(), aligned.digest())
+
+
+    def test_read_file(self):
+        cli = pystlink.PyStlink()
+        cli._dbg = lib.dbg.Dbg(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            srec_file = os.path.join(tmp, 'image.srec')
+            with open(srec_file, 'w') as f:
+                f.write('S30900000000112233444c\nS309000000045566778838\n')
+            self.assertEqual(list(cli.read_file(srec_file)), [(0, bytes.fromhex('1122334455667788'))])
+            with self.assertRaises(lib.stlinkex.StlinkException):
+                cli.read_file(srec_file, 0x20000000)
+            bin_file = os.path.join(tmp, 'image.bin')
+            with open(bin_file, 'wb') as f:
+                f.write(b'\x12\x34')
+            self.assertEqual(list(cli.read_file(bin_file, 0x20000000)), [(0x20000000, b'\x12\x34')])
+            with self.assertRaises(lib.stlinkex.StlinkExceptionBadParam):
+                cli.read_file(bin_file)
+
+    def test_flash_missing_argument(self):
+        cli = pystlink.PyStlink()
+        cli._dbg = lib.dbg.Dbg(0)
+        for params in (['plan'], ['plan', 'erase'], ['check'], ['delta']):
+            with self.assertRaises(lib.stlinkex.StlinkExceptionBadParam):
+                cli.cmd_flash(params)
+
+class TestFlashPlan(unittest.TestCase):
+    FLASH_START = lib.stm32.Stm32.FLASH_START
+    GEOMETRY = lib.stm32geometry.FlashGeometry(FLASH_START, 0x10000, (0x1000, ))
+
+    def test_shared_sector(self):
+        segments = [(self.FLASH_START + 0x1100, b'\x02' * 4), (self.FLASH_START + 0x1000, b'\x01' * 4), (self.FLASH_START + 0x3ffe, b'\x03' * 4)]
+        plan = lib.stm32plan.FlashPlan(segments, self.GEOMETRY)
+        self.assertEqual(plan.erase, [(self.FLASH_START + 0x1000, 0x1000), (self.FLASH_START + 0x3000, 0x1000), (self.FLASH_START + 0x4000, 0x1000)])
+        self.assertEqual([(addr, len(data)) for addr, data in plan.program], [(self.FLASH_START + 0x1000, 0x1000), (self.FLASH_START + 0x3000, 0x2000)])
+        chunk = plan.program[0][1]
+        self.assertEqual(bytes(chunk[:8]), b'\x01' * 4 + b'\xff' * 4)
+        self.assertEqual(bytes(chunk[0x100:0x108]), b'\x02' * 4 + b'\xff' * 4)
+        self.assertEqual(bytes(plan.program[1][1][0xffe:0x1002]), b'\x03' * 4)
+
+    def test_without_erase(self):
+        segments = [(self.FLASH_START + 4, b'\x02' * 4), (self.FLASH_START, b'\x01' * 4), (self.FLASH_START + 16, b'\x03')]
+        plan = lib.stm32plan.FlashPlan(segments, None, erase=False)
+        self.assertEqual(plan.erase, [])
+        self.assertEqual(plan.program, [(self.FLASH_START, b'\x01' * 4 + b'\x02' * 4), (self.FLASH_START + 16, b'\x03')])
+        self.assertEqual(plan.size, 9)
+
+    def test_nonblank_runs(self):
+        data = b'\x01' * 10 + b'\xff' * 300 + b'\x02' * 2
+        self.assertEqual(lib.stm32plan.nonblank_runs(data, 4), [(0, 12), (308, 4)])
+        # short blank gap is transferred with data
+        self.assertEqual(lib.stm32plan.nonblank_runs(data, 4, min_blank=512), [(0, 312)])
+        self.assertEqual(lib.stm32plan.nonblank_runs(b'\xff' * 1024, 8), [])
+        self.assertEqual(lib.stm32plan.nonblank_runs(b'\x00' * 1024, 8, erased=0), [])
+        self.assertEqual(lib.stm32plan.nonblank_runs(b'\xff' * 1024 + b'\x01' * 8, 32), [(1024, 8)])
+
+    def test_program_chunks(self):
+        data = bytearray(b'\x01' * 10 + b'\xff' * 300 + b'\x02' * 7)
+        chunks = [(offset, bytes(chunk)) for offset, chunk in lib.stm32plan.program_chunks(data, 10, 4)]
+        # chunks are aligned to unit, last one is padded and data are not changed
+        self.assertEqual(chunks, [(0, b'\x01' * 8), (8, b'\x01' * 2 + b'\xff' * 2), (308, b'\xff' * 2 + b'\x02' * 6), (316, b'\x02' + b'\xff' * 3)])
+        self.assertEqual(len(data), 317)
+        self.assertEqual([(offset, len(chunk)) for offset, chunk in lib.stm32plan.chunks(data, 100, 50)], [(50, 100), (150, 100), (250, 67)])
+
+    def test_overlap(self):
+        segments = [(self.FLASH_START, b'\x01\x02\x03'), (self.FLASH_START + 1, b'\x02\x03\x04')]
+        plan = lib.stm32plan.FlashPlan(segments, None, erase=False)
+        self.assertEqual(plan.program, [(self.FLASH_START, b'\x01\x02\x03\x04')])
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            lib.stm32plan.FlashPlan(segments + [(self.FLASH_START + 2, b'\x05')], self.GEOMETRY)
+
+
+class TestStlinkTrace(unittest.TestCase):
+    def setUp(self):
+        fd, self._filename = tempfile.mkstemp()
+        os.close(fd)
+        self._dbg = lib.dbg.Dbg(0)
+
+    def tearDown(self):
+        os.remove(self._filename)
+
+    def session(self, connector):
+        stlink = lib.stlinkv2.Stlink(connector, dbg=self._dbg)
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=self._dbg)
+        driver.core_reset_halt()
+        driver.set_mem(lib.stm32.Stm32.SRAM_START, bytes(range(200)))
+        return driver.get_mem(lib.stm32.Stm32.SRAM_START, 200)
+
+    def record(self):
+        connector = lib.stlinksim.StlinkSimConnector(dbg=self._dbg, cpu_type='STM32F103xB')
+        recorder = lib.stlinktrace.StlinkTraceRecorder(connector, self._filename)
+        data = self.session(recorder)
+        recorder.close()
+        return data, connector.xfer_counter
+
+    def test_reader(self):
+        data, xfer_counter = self.record()
+        trace = lib.stlinktrace.StlinkTraceReader(self._filename)
+        self.assertEqual(trace.version, 'V2')
+        self.assertEqual(trace.xfer_count, xfer_counter)
+        self.assertIsInstance(trace.transfer_policy, lib.stlinkusb.TransferPolicy)
+
+    def test_replay(self):
+        data, xfer_counter = self.record()
+        connector = lib.stlinktrace.StlinkTraceReplayConnector(self._filename)
+        self.assertEqual(self.session(connector), data)
+        self.assertEqual(connector.xfer_counter, xfer_counter)
+
+    def test_replay_mismatch(self):
+        self.record()
+        connector = lib.stlinktrace.StlinkTraceReplayConnector(self._filename)
+        stlink = lib.stlinkv2.Stlink(connector, dbg=self._dbg)
+        with self.assertRaises(lib.stlinkex.StlinkException):
+            stlink.get_mem32(lib.stm32.Stm32.SRAM_START, 4)
+
+
+class TestStlinkStats(unittest.TestCase):
+    def test_commands(self):
+        dbg = lib.dbg.Dbg(0)
+        connector = lib.stlinkstats.StlinkStatsConnector(lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB'))
+        stlink = lib.stlinkv2.Stlink(connector, dbg=dbg)
+        driver = lib.stm32fp.Stm32FP(stlink, dbg=dbg)
+        driver.set_mem(lib.stm32.Stm32.SRAM_START, bytes(2048))
+        stats = stlink.stats
+        self.assertEqual(stats.commands['WRITEMEM_32BIT']['calls'], 2)
+        self.assertEqual(stats.commands['WRITEMEM_32BIT']['tx_bytes'], 2048)
+        self.assertEqual(sum(stats.commands['WRITEMEM_32BIT']['histogram']), 2)
+        self.assertEqual(stats.operations['Stm32.set_mem']['calls'], 1)
+        self.assertEqual(stats.operations['Stlink.set_mem32']['xfers'], 2)
+        self.assertEqual(sum(s['calls'] for s in stats.commands.values()), connector.xfer_counter + stats.commands['SYNC']['calls'])
+
+    def test_queued_commands(self):
+        connector = lib.stlinkusb.StlinkUsbConnector.__new__(lib.stlinkusb.StlinkUsbConnector)
+        connector._pipeline = None
+        connector._pipeline_error = None
+        connector._xfer_observer = None
+        connector._xfer = lambda *request: time.sleep(0.01)
+        stats_connector = lib.stlinkstats.StlinkStatsConnector(connector)
+        stats = stats_connector.stats
+        cmd = bytes((lib.stlinkv2.Stlink.STLINK_DEBUG_COMMAND, lib.stlinkv2.Stlink.STLINK_DEBUG_WRITEMEM_32BIT))
+        stats.operation_enter('write')
+        for i in range(3):
+            stats_connector.xfer(cmd, data=bytes(64), wait=False)
+        stats.operation_leave()
+        stats_connector.sync()
+        command = stats.commands['WRITEMEM_32BIT']
+        self.assertEqual((command['calls'], command['tx_bytes']), (3, 192))
+        # transfers are timed when they are executed, not when queued
+        self.assertGreaterEqual(command['time'], 3 * 10000000)
+        self.assertEqual(stats.operations['write']['xfers'], 3)
+
+    def test_percentile(self):
+        histogram = [0] * (len(lib.stlinkstats.StlinkStats.HISTOGRAM_BUCKETS) + 1)
+        histogram[1] = 5
+        histogram[3] = 4
+        histogram[-1] = 1
+        self.assertEqual(lib.stlinkstats.StlinkStats.percentile(histogram, 50), 32000)
+        self.assertEqual(lib.stlinkstats.StlinkStats.percentile(histogram, 90), 128000)
+        self.assertIsNone(lib.stlinkstats.StlinkStats.percentile(histogram, 100))
+
+
+class TestStlinkUsbPipeline(unittest.TestCase):
+    def test_worker_error(self):
+        connector = lib.stlinkusb.StlinkUsbConnector.__new__(lib.stlinkusb.StlinkUsbConnector)
+        connector._pipeline = None
+        connector._pipeline_error = None
+        connector._xfer_observer = None
+        requests = []
+
+        def xfer(cmd, *args):
+            requests.append(cmd)
+            if cmd == b'\x01':
+                raise RuntimeError('unexpected')
+        connector._xfer = xfer
+        connector.xfer(b'\x01', wait=False)
+        with self.assertRaises(RuntimeError):
+            connector.sync()
+        # worker is still running after error
+        connector.xfer(b'\x02', wait=False)
+        connector.sync()
+        self.assertEqual(requests, [b'\x01', b'\x02'])
+
+
+class TestStlinkTransaction(unittest.TestCase):
+    def setUp(self):
+        dbg = lib.dbg.Dbg(0)
+        self._connector = lib.stlinkstats.StlinkStatsConnector(lib.stlinksim.StlinkSimConnector(dbg=dbg, cpu_type='STM32F103xB'))
+        self._stlink = lib.stlinkv2.Stlink(self._connector, dbg=dbg)
+        self._stats = self._stlink.stats
+
+    def calls(self, name):
+        return self._stats.commands.get(name, {'calls': 0})['calls']
+
+    def test_merge_consecutive(self):
+        tr = self._stlink.transaction()
+        tr.set_debugreg32(lib.stm32.Stm32.SRAM_START, 0x11111111)
+        tr.set_debugreg32(lib.stm32.Stm32.SRAM_START + 4, 0x22222222)
+        tr.set_debugreg32(lib.stm32.Stm32.SRAM_START + 8, 0x33333333)
+        tr.get_debugreg32(lib.stm32.Stm32.SRAM_START + 4)
+        tr.get_debugreg32(lib.stm32.Stm32.SRAM_START + 8)
+        tr.get_debugreg32(lib.stm32.Stm32.SRAM_START)
+        self.assertEqual(tr.flush(), [0x22222222, 0x33333333, 0x11111111])
+        self.assertEqual(self.calls('WRITEMEM_32BIT'), 1)
+        self.assertEqual(self.calls('WRITEDEBUGREG'), 0)
+        self.assertEqual(self.calls('READMEM_32BIT'), 1)
+        self.assertEqual(self.calls('READDEBUGREG'), 1)
+
+    def test_same_address_not_merged(self):
+        with self._stlink.transaction() as tr:
+            tr.set_debugreg32(lib.stm32fp.Flash.FLASH_KEYR_REG, 0x45670123)
+            tr.set_debugreg32(lib.stm32fp.Flash.FLASH_KEYR_REG, 0xcdef89ab)
+        self.assertEqual(self.calls('WRITEDEBUGREG'), 2)
+        self.assertEqual(self.calls('WRITEMEM_32BIT'), 0)
+        self.assertFalse(self._connector._connector.target.read32(lib.stm32fp.Flash.FLASH_CR_REG) & lib.stm32fp.Flash.FLASH_CR_LOCK_BIT)
+
+    def test_flash_unlock(self):
+        driver = lib.stm32fp.Stm32FP(self._stlink, dbg=lib.dbg.Dbg(0))
+        lib.stm32fp.Flash(driver, self._stlink, lib.dbg.Dbg(0))
+        # SR and CR are read by one transfer (accounted to get_mem32), then
+        # clear SR, two keys and check of CR, both batches are synced once
+        self.assertEqual(self.calls('READMEM_32BIT'), 1)
+        self.assertEqual(self._stats.operations['Flash.unlock']['xfers'], 6)
+
+
+class TestDbg(unittest.TestCase):
+    class NotFormatted():
+        def __str__(self):
+            raise AssertionError('message was formatted')
+
+    def test_debug_disabled(self):
+        dbg = lib.dbg.Dbg(2)
+        self.assertFalse(dbg.debug_enabled)
+        dbg.debug('value %s', self.NotFormatted())
+        self.assertEqual(len(dbg._trace), 0)
+
+    def test_debug_trace(self):
+        dbg = lib.dbg.Dbg(3, trace_length=3)
+        self.assertTrue(dbg.debug_enabled)
+        for i in range(5):
+            dbg.debug('value %d', i)
+        self.assertEqual(list(dbg._trace), ['value 2', 'value 3', 'value 4'])
+
+
 if __name__ == '__main__':
     unittest.main()